@@ -0,0 +1,389 @@
+"""Times each stage of the etaetaprime pipeline on synthetic data
+
+Each stage runs in its own process, so the peak memory reported is that of
+the stage alone. Results are written as JSON and may be compared against a
+stored baseline, e.g.
+
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --baseline results.json
+    python benchmarks/run_benchmarks.py --sweep --output sweep.json
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import Queue
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import itertools
+import multiprocessing
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                "..")))
+
+import synthetic
+from etaetaprime import correlators, fileio, fitting
+
+class _TwoPoint(object):
+    """A stand-in for the pyQCD TwoPoint object, holding a single correlator
+    under the attribute naming used by the measurements module"""
+
+    def __init__(self, name, correlator):
+        self.T = correlator.size
+        setattr(self, "{}_px0_py0_pz0".format(name), correlator)
+
+def _load_data(params, directory):
+    synthetic.write_ensemble(directory, 1, params["num_timeslices"],
+                             params["num_sources"], connected=True)
+    filename = os.path.join(directory, "sloppy", "data.0")
+
+    return lambda: fileio.load_data(filename, 4)
+
+def _load_data_gzip(params, directory):
+    synthetic.write_ensemble(directory, 1, params["num_timeslices"],
+                             params["num_sources"], connected=True)
+    filename = os.path.join(directory, "sloppy", "data.0")
+
+    with open(filename, "rb") as f:
+        contents = f.read()
+    with gzip.GzipFile(filename + ".gz", "wb") as f:
+        f.write(contents)
+
+    return lambda: fileio.load_data(filename + ".gz", 4)
+
+def _combine_traces(params, directory):
+    random_state = np.random.RandomState(0)
+    exact_data, sloppy_data \
+      = synthetic.trace_data(params["num_timeslices"], params["exact_density"],
+                             random_state)
+    first_timeslices, second_timeslices, first_traces, second_traces \
+      = fileio.split_traces(exact_data[:, [0, 1, 3]])
+
+    return lambda: correlators.combine_traces(first_traces, second_traces,
+                                              first_timeslices,
+                                              second_timeslices,
+                                              params["num_timeslices"])
+
+def _parse_connected(params, directory):
+    exact_folder, sloppy_folder \
+      = synthetic.write_ensemble(directory, 1, params["num_timeslices"],
+                                 params["num_sources"], connected=True)
+    exact_data = fileio.load_correlators(os.path.join(exact_folder, "data.0"))
+    sloppy_data = fileio.load_correlators(os.path.join(sloppy_folder,
+                                                       "data.0"))
+
+    return lambda: correlators.parse_connected(exact_data, sloppy_data)
+
+def _parse_disconnected(params, directory):
+    exact_folder, sloppy_folder \
+      = synthetic.write_ensemble(directory, 1, params["num_timeslices"],
+                                 exact_density=params["exact_density"])
+    exact_data = fileio.load_traces(os.path.join(exact_folder, "data.0"))
+    sloppy_data = fileio.load_traces(os.path.join(sloppy_folder, "data.0"))
+
+    return lambda: correlators.parse_disconnected(exact_data, sloppy_data,
+                                                  params["num_timeslices"])
+
+def _run_all(params, directory):
+    exact_folder, sloppy_folder \
+      = synthetic.write_ensemble(directory, params["num_configs"],
+                                 params["num_timeslices"],
+                                 exact_density=params["exact_density"])
+    output_prefix = os.path.join(directory, "out")
+
+    def run():
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                correlators.run_all(exact_folder, sloppy_folder, "data",
+                                    output_prefix, 0,
+                                    params["num_configs"] - 1, 1,
+                                    params["num_timeslices"],
+                                    workers=params["workers"])
+            finally:
+                sys.stdout = stdout
+
+    return run
+
+def _variable_projection_fit(params, directory):
+    num_timeslices = params["num_timeslices"]
+    samples = synthetic.two_point_samples(params["num_configs"],
+                                          num_timeslices)
+    fit_range = np.arange(2, num_timeslices // 2)
+    err = samples.std(axis=0)[fit_range]
+
+    return lambda: fitting.variable_projection_fit(fit_range,
+                                                   samples[:, fit_range], err,
+                                                   (0.3, 0.9), num_timeslices)
+
+def _constrained_two_state_fit(params, directory):
+    # Imported here as the measurements module requires scipy
+    from etaetaprime import measurements
+
+    num_timeslices = params["num_timeslices"]
+    samples = synthetic.two_point_samples(params["num_configs"],
+                                          num_timeslices)
+    twopoint = _TwoPoint("pseudoscalar", samples.mean(axis=0))
+    stddev = samples.std(axis=0)
+    fit_range = [2, num_timeslices // 2]
+
+    return lambda: measurements.constrained_two_state_fit(
+        twopoint, "pseudoscalar", fit_range, [1.0, 0.3, 0.5, 0.9],
+        stddev=stddev)
+
+# The stages, each with a setup function returning the callable to time,
+# and the parameters on which the stage depends
+stages = [
+    ("load_data", _load_data, ("num_timeslices", "num_sources")),
+    ("load_data_gzip", _load_data_gzip, ("num_timeslices", "num_sources")),
+    ("combine_traces", _combine_traces, ("num_timeslices", "exact_density")),
+    ("parse_connected", _parse_connected, ("num_timeslices", "num_sources")),
+    ("parse_disconnected", _parse_disconnected,
+     ("num_timeslices", "exact_density")),
+    ("run_all", _run_all,
+     ("num_timeslices", "exact_density", "num_configs", "workers")),
+    ("variable_projection_fit", _variable_projection_fit,
+     ("num_timeslices", "num_configs")),
+    ("constrained_two_state_fit", _constrained_two_state_fit,
+     ("num_timeslices", "num_configs")),
+]
+
+def _peak_memory():
+    """Returns the peak resident memory of the current process in bytes"""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, OS X bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def _time_stage(job, queue):
+    """Sets up and times a single stage, putting the timings along with the
+    peak memory before and after the stage has run on the supplied queue, or
+    the exception raised if the stage fails"""
+
+    name, params, warmup, repeats = job
+    setup = dict((stage[0], stage[1]) for stage in stages)[name]
+    directory = tempfile.mkdtemp(prefix="etaetaprime-benchmark-")
+
+    try:
+        function = setup(params, directory)
+        memory_before = _peak_memory()
+
+        for i in xrange(warmup):
+            function()
+
+        times = []
+        for i in xrange(repeats):
+            start = time.time()
+            function()
+            times.append(time.time() - start)
+
+        queue.put((times, memory_before, _peak_memory()))
+    except Exception as e:
+        queue.put(e)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def benchmark(name, params, warmup=1, repeats=5, timeout=None):
+    """Times the specified stage in a fresh process, raising a RuntimeError
+    if the process dies without reporting or runs for longer than timeout
+
+    :param name: The name of the stage to time
+    :type name: :class:`str`
+    :param params: The parameters of the synthetic data, of which only those the stage depends on are used
+    :type params: :class:`dict`
+    :param warmup: The number of untimed runs before timing
+    :type warmup: :class:`int`
+    :param repeats: The number of timed runs
+    :type repeats: :class:`int`
+    :param timeout: The number of seconds after which to give up on the stage
+    :type timeout: :class:`float`
+    :returns: :class:`dict` describing the timings and peak memory
+    """
+
+    params = _stage_parameters(name, params)
+
+    # A fresh process per stage keeps the peak memory of one stage from
+    # masking that of another. It mustn't be a daemon, as run_all may start
+    # workers of its own
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_time_stage,
+                                      args=((name, params, warmup, repeats),
+                                            queue))
+    process.start()
+    start = time.time()
+    outcome = None
+    try:
+        # A process killed outright, e.g. for running out of memory, never
+        # puts anything on the queue, so poll it while the process is alive
+        while outcome is None:
+            try:
+                outcome = queue.get(timeout=1)
+            except Queue.Empty:
+                if not process.is_alive():
+                    # The outcome may have been put just before exiting
+                    try:
+                        outcome = queue.get(timeout=1)
+                    except Queue.Empty:
+                        process.join()
+                        raise RuntimeError("The process timing {} exited "
+                                           "with code {}"
+                                           .format(name, process.exitcode))
+                elif timeout is not None and time.time() - start > timeout:
+                    raise RuntimeError("{} took longer than {} s"
+                                       .format(name, timeout))
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+    if isinstance(outcome, Exception):
+        raise outcome
+    times, memory_before, memory_after = outcome
+
+    return {"stage": name, "parameters": params, "times": times,
+            "median": float(np.median(times)), "min": min(times),
+            "mean": float(np.mean(times)), "std": float(np.std(times)),
+            "peak_memory": memory_after,
+            "memory_increase": memory_after - memory_before}
+
+def _stage_parameters(name, params):
+    """Restricts the supplied parameters to those the stage depends on"""
+
+    dependencies = dict((stage[0], stage[2]) for stage in stages)[name]
+
+    return dict((key, params[key]) for key in dependencies)
+
+def _key(name, params):
+    return (name, json.dumps(params, sort_keys=True))
+
+def compare(results, baseline, threshold=0.2):
+    """Compares the median times of the supplied results with those in a
+    baseline, returning those that have slowed down by more than the
+    supplied fraction
+
+    :param results: The benchmark results
+    :type results: :class:`list` of :class:`dict`
+    :param baseline: The baseline benchmark results
+    :type baseline: :class:`list` of :class:`dict`
+    :param threshold: The fractional slow-down regarded as a regression
+    :type threshold: :class:`float`
+    :returns: :class:`list` of :class:`tuple` s: stage, parameters, baseline median, median
+    """
+
+    baseline = dict((_key(result["stage"], result["parameters"]), result)
+                    for result in baseline)
+    regressions = []
+
+    for result in results:
+        reference = baseline.get(_key(result["stage"], result["parameters"]))
+        if reference is None:
+            continue
+
+        if result["median"] > (1 + threshold) * reference["median"]:
+            regressions.append((result["stage"], result["parameters"],
+                                reference["median"], result["median"]))
+
+    return regressions
+
+def _metadata(args):
+    return {"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__, "platform": platform.platform(),
+            "processors": multiprocessing.cpu_count(),
+            "warmup": args.warmup, "repeats": args.repeats}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stages", nargs="+", default=[s[0] for s in stages],
+                        choices=[s[0] for s in stages])
+    parser.add_argument("--num-timeslices", type=int, default=96)
+    parser.add_argument("--num-sources", type=int, default=4)
+    parser.add_argument("--exact-density", type=float, default=0.25)
+    parser.add_argument("--num-configs", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--timeout", type=float,
+                        help="Seconds after which a stage is reported failed")
+    parser.add_argument("--sweep", action="store_true",
+                        help="Scan over the temporal extent and ensemble size")
+    parser.add_argument("--sweep-timeslices", type=int, nargs="+",
+                        default=[32, 64, 96, 128])
+    parser.add_argument("--sweep-configs", type=int, nargs="+",
+                        default=[8, 32, 128])
+    parser.add_argument("--output", help="File in which to write the results")
+    parser.add_argument("--baseline", help="Results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Fractional slow-down regarded as a regression")
+    args = parser.parse_args(argv)
+
+    params = {"num_timeslices": args.num_timeslices,
+              "num_sources": args.num_sources,
+              "exact_density": args.exact_density,
+              "num_configs": args.num_configs, "workers": args.workers}
+
+    if args.sweep:
+        grid = list(itertools.product(args.sweep_timeslices,
+                                      args.sweep_configs))
+    else:
+        grid = [(args.num_timeslices, args.num_configs)]
+
+    results = []
+    failures = []
+    seen = set()
+    for name, (num_timeslices, num_configs) in itertools.product(args.stages,
+                                                                  grid):
+        params.update(num_timeslices=num_timeslices, num_configs=num_configs)
+
+        # Stages independent of the ensemble size are only timed once per T
+        key = _key(name, _stage_parameters(name, params))
+        if key in seen:
+            continue
+        seen.add(key)
+
+        try:
+            result = benchmark(name, params, args.warmup, args.repeats,
+                               args.timeout)
+        except Exception as e:
+            # Report the stage and carry on with the rest
+            failures.append({"stage": name,
+                             "parameters": _stage_parameters(name, params),
+                             "error": "{}: {}".format(type(e).__name__, e)})
+            print("{:<26} {:<60} FAILED: {}".format(
+                name, json.dumps(failures[-1]["parameters"], sort_keys=True),
+                failures[-1]["error"]))
+            continue
+        results.append(result)
+
+        print("{:<26} {:<60} {:>10.3g} s {:>8.1f} MB".format(
+            name, json.dumps(result["parameters"], sort_keys=True),
+            result["median"], result["peak_memory"] / 2.0**20))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"metadata": _metadata(args), "results": results,
+                       "failures": failures}, f, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+        regressions = compare(results, baseline, args.threshold)
+        for name, parameters, reference, median in regressions:
+            print("Regression in {} {}: {:.3g} s -> {:.3g} s".format(
+                name, json.dumps(parameters, sort_keys=True), reference,
+                median))
+
+        return 1 if regressions or failures else 0
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+# Generators of synthetic exact and sloppy data in the formats read by
+# etaetaprime.fileio, for benchmarking
+import os
+import numpy as np
+
+def _correlator(num_timeslices, energy=0.3, excited_energy=0.9):
+    """A periodic two-state correlator with realistic magnitudes"""
+    
+    t = np.arange(num_timeslices)
+    
+    return 1e10 * (np.exp(-energy * t) + np.exp(-energy * (num_timeslices - t))
+                   + 0.5 * np.exp(-excited_energy * t)
+                   + 0.5 * np.exp(-excited_energy * (num_timeslices - t)))
+
+def connected_data(num_timeslices, num_sources, random_state, noise=0.02):
+    """Generates exact and sloppy connected correlators, with num_sources
+    exact sources and a sloppy source on every timeslice
+    
+    :param num_timeslices: The temporal extent of the lattice
+    :type num_timeslices: :class:`int`
+    :param num_sources: The number of exact sources
+    :type num_sources: :class:`int`
+    :param random_state: The random number generator to use
+    :type random_state: :class:`numpy.random.RandomState`
+    :param noise: The relative size of the noise on the correlators
+    :type noise: :class:`float`
+    :returns: :class:`tuple` of the exact and sloppy data, with four columns
+    """
+    
+    correlator = _correlator(num_timeslices)
+    
+    def rows(sources):
+        data = np.zeros((sources.size * num_timeslices, 4))
+        data[:, 0] = np.repeat(sources, num_timeslices)
+        data[:, 1] = np.tile(np.arange(num_timeslices), sources.size)
+        data[:, 2] = np.tile(correlator, sources.size) \
+          * (1 + noise * random_state.randn(data.shape[0]))
+        data[:, 3] = 1e-8 * random_state.randn(data.shape[0])
+        return data
+    
+    exact_sources = np.sort(random_state.choice(num_timeslices, num_sources,
+                                                replace=False))
+    
+    return rows(exact_sources), rows(np.arange(num_timeslices))
+
+def trace_data(num_timeslices, exact_density, random_state):
+    """Generates exact and sloppy traces, with the exact traces computed on
+    a fraction exact_density of the timeslices and the sloppy traces on all
+    of them
+    
+    :param num_timeslices: The temporal extent of the lattice
+    :type num_timeslices: :class:`int`
+    :param exact_density: The fraction of timeslices with exact traces
+    :type exact_density: :class:`float`
+    :param random_state: The random number generator to use
+    :type random_state: :class:`numpy.random.RandomState`
+    :returns: :class:`tuple` of the exact and sloppy data, with five columns
+    """
+    
+    stride = max(int(round(1 / exact_density)), 1)
+    
+    exact_data = np.zeros((num_timeslices, 5))
+    exact_data[:, 0] = np.arange(num_timeslices)
+    exact_data[::stride, 1:5] = random_state.randn(exact_data[::stride].shape[0],
+                                                   4)
+    
+    sloppy_data = np.zeros((num_timeslices, 5))
+    sloppy_data[:, 0] = np.arange(num_timeslices)
+    sloppy_data[:, 1:5] = random_state.randn(num_timeslices, 4)
+    
+    return exact_data, sloppy_data
+
+def write_ensemble(directory, num_configs, num_timeslices=96, num_sources=4,
+                   exact_density=0.25, connected=False, prefix="data",
+                   seed=0):
+    """Writes an ensemble of synthetic exact and sloppy files, in the layout
+    expected by correlators.run_all, to the exact and sloppy subdirectories
+    of the supplied directory
+    
+    :param directory: The directory in which to write the ensemble
+    :type directory: :class:`str`
+    :param num_configs: The number of configurations to write
+    :type num_configs: :class:`int`
+    :param num_timeslices: The temporal extent of the lattice
+    :type num_timeslices: :class:`int`
+    :param num_sources: The number of exact sources, for connected correlators
+    :type num_sources: :class:`int`
+    :param exact_density: The fraction of timeslices with exact traces, for disconnected correlators
+    :type exact_density: :class:`float`
+    :param connected: Whether to write connected correlators rather than traces
+    :type connected: :class:`bool`
+    :param prefix: The prefix of the data files
+    :type prefix: :class:`str`
+    :param seed: The seed for the random number generator
+    :type seed: :class:`int`
+    :returns: :class:`tuple` of the exact and sloppy directories
+    """
+    
+    random_state = np.random.RandomState(seed)
+    folders = [os.path.join(directory, "exact"),
+               os.path.join(directory, "sloppy")]
+    
+    for folder in folders:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+            
+    for config in xrange(num_configs):
+        if connected:
+            data = connected_data(num_timeslices, num_sources, random_state)
+        else:
+            data = trace_data(num_timeslices, exact_density, random_state)
+        for folder, array in zip(folders, data):
+            np.savetxt(os.path.join(folder, "{}.{}".format(prefix, config)),
+                       array, fmt="%.10e")
+            
+    return tuple(folders)
+
+def two_point_samples(num_samples, num_timeslices, b=(1.0, 0.3, 0.5, 0.9),
+                      noise=0.02, seed=0):
+    """Generates noisy samples of a periodic two-state correlator for
+    benchmarking fits
+    
+    :param num_samples: The number of samples
+    :type num_samples: :class:`int`
+    :param num_timeslices: The temporal extent of the lattice
+    :type num_timeslices: :class:`int`
+    :param b: The amplitudes and energies of the two states
+    :type b: :class:`tuple`
+    :param noise: The relative size of the noise
+    :type noise: :class:`float`
+    :param seed: The seed for the random number generator
+    :type seed: :class:`int`
+    :returns: :class:`numpy.ndarray` shaped (num_samples, num_timeslices)
+    """
+    
+    random_state = np.random.RandomState(seed)
+    t = np.arange(num_timeslices)
+    correlator = b[0] * (np.exp(-b[1] * t) + np.exp(-b[1] * (num_timeslices - t))) \
+      + b[2] * (np.exp(-b[3] * t) + np.exp(-b[3] * (num_timeslices - t)))
+    
+    return correlator * (1 + noise * random_state.randn(num_samples,
+                                                        num_timeslices))
@@ -1,4 +1,13 @@
 import ama
+import cache
 import correlators
-from correlators import run_one, run_all
+import effmass
+import ensemble
+from correlators import run_one, run_all, iter_ama
 import fileio
+import fitting
+import gevp
+import instrumentation
+import manifest
+import resampling
+import sinks
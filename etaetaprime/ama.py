@@ -53,3 +53,175 @@ def read2pt(exact_data, sloppy_data, time_extent, num_src):
     
     return exact_source_average, sloppy_source_average, \
       residual_source_average, ama_source_average
+
+def _group_average(values, groups, num_groups):
+    """Averages the blocks along axis 1 of values that share a group"""
+    
+    weights = np.float64(groups == np.arange(num_groups)[:, np.newaxis])
+    weights /= weights.sum(axis=1)[:, np.newaxis]
+    
+    return np.einsum('gb,cbt->cgt', weights, values)
+
+def _three_point_blocks(data, time_extent):
+    """Splits three-point data into blocks of time_extent rows, returning the
+    source-sink separation and sink of each block and the complex values
+    for the five currents, shaped (5, num_blocks, time_extent)"""
+    
+    blocks = np.reshape(data, (-1, time_extent, data.shape[1]))
+    
+    separations = np.int64(blocks[:, 0, 0])
+    sinks = np.int64(blocks[:, 0, 1])
+    values = blocks[:, :, 3:13:2] + 1j * blocks[:, :, 4:13:2]
+    
+    return separations, sinks, np.transpose(values, (2, 0, 1))
+
+def read3pt(exact_data, sloppy_data, time_extent, num_separations, num_src,
+            return_separations=False):
+    """Does the AMA for three-point functions with the five current
+    insertions V_x, V_y, V_z, V_t and S, as read3pt in readAMA.c does
+    
+    Each row of the data holds the source-sink separation, the sink
+    timeslice, the operator insertion timeslice and then the real and
+    imaginary parts of the five currents. The exact data should contain
+    blocks of time_extent rows for num_src sources at each of
+    num_separations separations, whilst the sloppy data should contain
+    blocks for every sink at each separation.
+    
+    :param exact_data: The array containing the exact results
+    :type exact_data: :class:`numpy.ndarray`
+    :param sloppy_data: The array containing the sloppy results
+    :type sloppy_data: :class:`numpy.ndarray`
+    :param time_extent: The correlator time extent
+    :type time_extent: :class:`int`
+    :param num_separations: The number of source-sink separations
+    :type num_separations: :class:`int`
+    :param num_src: The number of exact sources for each separation
+    :type num_src: :class:`int`
+    :param return_separations: Determines whether to also return the separations, in the order they appear in the output
+    :type return_separations: :class:`bool`
+    
+    :returns: :class:`numpy.ndarray` with shape (4, 5, num_separations, time_extent) holding the exact, sloppy, residual and AMA source averages
+    """
+    
+    exact_data = np.asarray(exact_data)
+    sloppy_data = np.asarray(sloppy_data)
+    
+    if exact_data.shape[0] != time_extent * num_separations * num_src:
+        raise IOError("Expected {} rows in exact data file, found {}"
+                      .format(time_extent * num_separations * num_src,
+                              exact_data.shape[0]))
+    if sloppy_data.shape[0] % time_extent != 0:
+        raise IOError("Expected a multiple of {} rows in sloppy data file, "
+                      "found {}".format(time_extent, sloppy_data.shape[0]))
+    
+    exact_separations, exact_sinks, exact_values \
+      = _three_point_blocks(exact_data, time_extent)
+    sloppy_separations, sloppy_sinks, sloppy_values \
+      = _three_point_blocks(sloppy_data, time_extent)
+      
+    # The output is ordered by the first appearance of each separation in
+    # the exact data
+    separations, first_blocks = np.unique(exact_separations,
+                                          return_index=True)
+    separations = separations[np.argsort(first_blocks)]
+    
+    if separations.size != num_separations:
+        raise IOError("Expected {} source-sink separations in exact data "
+                      "file, found {}".format(num_separations,
+                                              separations.size))
+    
+    missing = np.setdiff1d(separations, sloppy_separations)
+    if missing.size > 0:
+        raise IOError("No sloppy data for source-sink separations {}"
+                      .format(list(missing)))
+    
+    group_lookup = -np.ones(exact_separations.max() + 1, dtype=np.int64)
+    group_lookup[separations] = np.arange(num_separations)
+    exact_groups = group_lookup[exact_separations]
+    
+    sloppy_blocks = np.in1d(sloppy_separations, separations)
+    sloppy_groups = group_lookup[sloppy_separations[sloppy_blocks]]
+    
+    exact_average = _group_average(exact_values, exact_groups,
+                                   num_separations)
+    sloppy_average = _group_average(sloppy_values[:, sloppy_blocks],
+                                    sloppy_groups, num_separations)
+    
+    # Subtract each sloppy block from the first exact block with the same
+    # source and sink, if there is one
+    exact_keys = exact_separations * time_extent + exact_sinks
+    sloppy_keys = sloppy_separations * time_extent + sloppy_sinks
+    key_lookup = -np.ones(max(exact_keys.max(), sloppy_keys.max()) + 1,
+                          dtype=np.int64)
+    key_lookup[exact_keys[::-1]] = np.arange(exact_keys.size)[::-1]
+    matches = key_lookup[sloppy_keys]
+    matched = matches >= 0
+    
+    residuals = exact_values.copy()
+    np.subtract.at(residuals, (slice(None), matches[matched]),
+                   sloppy_values[:, matched])
+    residual_average = _group_average(residuals, exact_groups,
+                                      num_separations)
+    
+    ama_average = residual_average + sloppy_average
+    
+    out = np.array([exact_average, sloppy_average, residual_average,
+                    ama_average])
+    
+    if return_separations:
+        return out, separations
+    else:
+        return out
+
+def write3pt(filename, averages, separations):
+    """Writes the three-point function averages computed by read3pt in the
+    ten-column format printed by readAMA.c
+    
+    :param filename: The file to write the averages to
+    :type filename: :class:`str`
+    :param averages: The exact, sloppy, residual and AMA averages returned by read3pt
+    :type averages: :class:`numpy.ndarray`
+    :param separations: The source-sink separations returned by read3pt
+    :type separations: :class:`numpy.ndarray`
+    """
+    
+    num_separations, time_extent = averages.shape[2:]
+    
+    # Each current insertion has a block of rows with the line number
+    # running over the separations
+    columns = np.zeros((5, num_separations, time_extent, 10))
+    columns[:, :, :, 0] = np.arange(num_separations * time_extent) \
+      .reshape((num_separations, time_extent))
+    columns[:, :, :, 1] = separations[:, np.newaxis]
+    columns[:, :, :, 2::2] = np.transpose(averages.real, (1, 2, 3, 0))
+    columns[:, :, :, 3::2] = np.transpose(averages.imag, (1, 2, 3, 0))
+    
+    np.savetxt(filename, columns.reshape((-1, 10)),
+               fmt=["%2d", "%2d"] + ["%+e"] * 8)
+
+def run3pt(exact_file, sloppy_file, time_extent, num_separations, num_src,
+           cache=None):
+    """Loads the three-point functions in the specified files and does the
+    AMA, for use with the drivers in correlators
+    
+    :param exact_file: The file containing the exact three-point functions
+    :type exact_file: :class:`str`
+    :param sloppy_file: The file containing the sloppy three-point functions
+    :type sloppy_file: :class:`str`
+    :param time_extent: The correlator time extent
+    :type time_extent: :class:`int`
+    :param num_separations: The number of source-sink separations
+    :type num_separations: :class:`int`
+    :param num_src: The number of exact sources for each separation
+    :type num_src: :class:`int`
+    :param cache: The cache in which to keep the parsed input files
+    :type cache: :class:`cache.FileCache`
+    
+    :returns: :class:`numpy.ndarray` with shape (4, 5, num_separations, time_extent)
+    """
+    
+    exact_data = fileio.load_three_point(exact_file, cache)
+    sloppy_data = fileio.load_three_point(sloppy_file, cache)
+    
+    return read3pt(exact_data, sloppy_data, time_extent, num_separations,
+                   num_src)
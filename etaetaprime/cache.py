@@ -0,0 +1,180 @@
+import os
+import json
+import hashlib
+import numpy as np
+import fileio
+
+class FileCache(object):
+    """A size-bounded cache of parsed data files, kept as binary .npy files
+    in the specified directory and loaded through memory maps
+    
+    Cached arrays are keyed on the path of the source file and the function
+    used to load it, along with the size, modification time and content
+    hash of the file. An entry is reused while the file has the same
+    content hash as when it was cached, so touching a file doesn't
+    invalidate it, while a change that keeps the size and modification time
+    does. A hit reads the file only to hash it, and a file that has changed
+    size is hashed from the bytes read to parse it, so either is read once.
+    When the cache grows beyond max_size bytes the least recently used
+    entries are removed.
+    
+    :param directory: The directory in which to keep the cache
+    :type directory: :class:`str`
+    :param max_size: The maximum total size of the cached arrays in bytes
+    :type max_size: :class:`int`
+    """
+    
+    def __init__(self, directory, max_size=2**30):
+        
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+        
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process may have created the directory
+                if not os.path.isdir(directory):
+                    raise
+        
+    def _paths(self, filename, loader):
+        """Returns the array and metadata paths for the supplied file"""
+        
+        key = "{}:{}".format(os.path.abspath(filename), loader.__name__)
+        root = os.path.join(self.directory,
+                            hashlib.sha1(key.encode("utf-8")).hexdigest())
+        
+        return root + ".npy", root + ".json"
+    
+    def load(self, filename, loader):
+        """Loads the array produced by applying loader to the supplied file,
+        using the cached copy if it is up to date
+        
+        :param filename: The file to load
+        :type filename: :class:`str`
+        :param loader: The function used to load the file on a cache miss
+        :type loader: :class:`function`
+        :returns: :class:`numpy.ndarray`
+        """
+        
+        array_path, meta_path = self._paths(filename, loader)
+        
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            meta = None
+            
+        # A file of another size has changed, so only a file of the same
+        # size is hashed to find out whether the entry is still up to date
+        if meta is not None and "sha1" in meta \
+          and os.path.exists(array_path) \
+          and meta["size"] == os.path.getsize(filename):
+            fingerprint = fileio.fingerprint(filename)
+            if fingerprint["sha1"] == meta["sha1"]:
+                # The file may have been touched without changing
+                if fingerprint["mtime"] != meta["mtime"]:
+                    self._write_meta(meta_path, fingerprint)
+                # Record the access for the LRU eviction
+                os.utime(array_path, None)
+                return np.load(array_path, mmap_mode="c")
+            
+        # Hash the file as it is parsed, rather than reading it again,
+        # unless the loader reads it some other way
+        with fileio.recording() as fingerprints:
+            data = loader(filename)
+        fingerprint = fingerprints.get(os.path.abspath(filename)) \
+          or fileio.fingerprint(filename)
+        self._store(data, array_path, meta_path, fingerprint)
+        
+        return data
+    
+    def _write_meta(self, meta_path, meta):
+        """Atomically writes the supplied fingerprint to the metadata file"""
+        
+        tmp_path = "{}.{}.tmp".format(meta_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.rename(tmp_path, meta_path)
+        
+    def _store(self, data, array_path, meta_path, meta):
+        """Saves the supplied array to the cache, evicting old entries if
+        the cache is full"""
+        
+        # A stale entry for the same file is replaced, so its size no longer
+        # counts towards that of the cache
+        try:
+            old_size = os.path.getsize(array_path)
+        except OSError:
+            old_size = 0
+        
+        # Write to temporary files first so other processes never see
+        # partially written entries
+        tmp_path = "{}.{}.tmp.npy".format(array_path[:-4], os.getpid())
+        np.save(tmp_path, data)
+        os.rename(tmp_path, array_path)
+        self._write_meta(meta_path, meta)
+        
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += os.path.getsize(array_path) - old_size
+            
+        if self._size > self.max_size:
+            self.evict()
+            
+    def _entries(self):
+        """Returns a list of (last access, size, path) for the cached arrays"""
+        
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npy") or ".tmp" in name:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            
+        return entries
+            
+    def size(self):
+        """Computes the total size of the cached arrays in bytes
+        
+        :returns: :class:`int`
+        """
+        
+        return sum(entry[1] for entry in self._entries())
+    
+    def evict(self):
+        """Removes the least recently used entries until the cache is no
+        larger than max_size"""
+        
+        entries = sorted(self._entries())
+        total_size = sum(entry[1] for entry in entries)
+        
+        for last_access, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            for entry_path in [path, path[:-4] + ".json"]:
+                try:
+                    os.remove(entry_path)
+                except OSError:
+                    pass
+            total_size -= size
+            
+        self._size = total_size
+        
+    def clear(self):
+        """Removes every entry from the cache"""
+        
+        for last_access, size, path in self._entries():
+            for entry_path in [path, path[:-4] + ".json"]:
+                try:
+                    os.remove(entry_path)
+                except OSError:
+                    pass
+                
+        self._size = 0
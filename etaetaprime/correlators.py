@@ -1,12 +1,72 @@
+import os
+import time
+import collections
+import multiprocessing
+import multiprocessing.pool
 import numpy as np
 import fileio
+import sinks
+import instrumentation
 import itertools
-import pyximport
-pyximport.install(reload_support=True)
 from fastfunctions import combinatorics
 
+def cross_correlate(first, second):
+    """Computes the circular cross-correlation of the supplied arrays over
+    their last axis using FFTs, i.e. the sum over t of
+    first[..., t] * second[..., t - d] for each separation d
+    
+    :param first: The first array, with timeslices along the last axis
+    :type first: :class:`numpy.ndarray`
+    :param second: The second array, with timeslices along the last axis
+    :type second: :class:`numpy.ndarray`
+    
+    :returns: :class:`numpy.ndarray` indexed by separation along the last axis
+    """
+    
+    instrumentation.count("kernel.cross_correlate")
+    
+    num_timeslices = first.shape[-1]
+    # The T * ifft of the second array is the fft of the time-reversed array,
+    # so the product below is the transform of the cross-correlation
+    out = np.fft.ifft(np.fft.fft(first, axis=-1)
+                      * np.fft.ifft(second, axis=-1) * num_timeslices,
+                      axis=-1)
+    
+    if np.iscomplexobj(first) or np.iscomplexobj(second):
+        return out
+    else:
+        return out.real
+
+def scatter_trace(trace, timeslices, num_timeslices):
+    """Places the supplied trace onto the full set of lattice timeslices,
+    returning the dense trace and the occupancy of each timeslice
+    
+    :param trace: The trace values
+    :type trace: :class:`numpy.ndarray`
+    :param timeslices: The timeslices on which the trace values live
+    :type timeslices: :class:`numpy.ndarray`
+    :param num_timeslices: The lattice temporal extent
+    :type num_timeslices: :class:`int`
+    
+    :returns: :class:`tuple` of :class:`numpy.ndarray` s: dense trace and occupancy
+    """
+    
+    timeslices = np.int64(np.asarray(timeslices).real) % num_timeslices
+    trace = np.asarray(trace)
+    
+    # Use bincount so that repeated timeslices accumulate, just as they do
+    # in the outer product of the direct method
+    dense_trace = np.bincount(timeslices, trace.real, num_timeslices)
+    if np.iscomplexobj(trace):
+        dense_trace = dense_trace \
+          + 1j * np.bincount(timeslices, trace.imag, num_timeslices)
+    occupancy = np.bincount(timeslices, minlength=num_timeslices)
+    
+    return dense_trace, occupancy
+
+@instrumentation.timed()
 def combine_traces(first_trace, second_trace, first_timeslices=None,
-                   second_timeslices=None, num_timeslices=None):
+                   second_timeslices=None, num_timeslices=None, method="fft"):
     """Computes a correlator from a pair of traces and
     their corresponding timeslices
     
@@ -22,39 +82,111 @@ def combine_traces(first_trace, second_trace, first_timeslices=None,
     :type first_timeslices: :class:`numpy.ndarray` or :class:`list`
     :param num_timeslices: The lattice temporal extent
     :type num_timeslices: :class:`int`
+    :param method: The combination method, either "fft" or "direct"
+    :type method: :class:`str`
     
     :returns: :class:`numpy.ndarray` containing timeslices and correlator values
     """
     
     # If no timeslices are given, assume the form they take
-    if first_timeslices == None:
+    if first_timeslices is None:
         first_timeslices = np.arange(first_trace.size)
-    if second_timeslices == None:
+    if second_timeslices is None:
         second_timeslices = np.arange(second_trace.size)
         
     # Make sure the supplied timeslices are in int64 format
-    first_timeslices = np.int64(first_timeslices.real)
-    second_timeslices = np.int64(second_timeslices.real)
+    first_timeslices = np.int64(np.asarray(first_timeslices).real)
+    second_timeslices = np.int64(np.asarray(second_timeslices).real)
     
-    if num_timeslices == None:
+    if num_timeslices is None:
         num_timeslices = max(np.max(first_timeslices),
                              np.max(second_timeslices)) + 1
+        
+    if method == "direct":
+        return _combine_traces_direct(first_trace, second_trace,
+                                      first_timeslices, second_timeslices,
+                                      num_timeslices)
+    elif method != "fft":
+        raise ValueError("Unknown trace combination method: {}"
+                         .format(method))
+    
+    return _combine_transformed(
+        _TransformedTrace(first_trace, first_timeslices, num_timeslices),
+        _TransformedTrace(second_trace, second_timeslices, num_timeslices))
+
+class _TransformedTrace(object):
+    """A trace placed onto the full set of lattice timeslices, along with the
+    Fourier transforms used to cross-correlate it. The transforms are
+    computed on first use and kept, so a trace combined with several others
+    is only transformed once"""
+    
+    def __init__(self, trace, timeslices, num_timeslices):
+        
+        self.dense, self.occupancy \
+          = scatter_trace(trace, timeslices, num_timeslices)
+        self.num_timeslices = num_timeslices
+        self._transforms = {}
+        
+    def transform(self, function, occupancy=False):
+        """Returns np.fft.fft or np.fft.ifft applied to the dense trace, or to
+        the occupancy of each timeslice"""
+        
+        key = (function.__name__, occupancy)
+        
+        if key not in self._transforms:
+            instrumentation.count("kernel.fft")
+            self._transforms[key] \
+              = function(self.occupancy if occupancy else self.dense)
+            
+        return self._transforms[key]
+    
+def _combine_transformed(first, second):
+    """Computes a correlator from a pair of transformed traces, in the same
+    way as cross_correlate and combine_traces"""
+    
+    instrumentation.count("kernel.cross_correlate")
+    
+    num_timeslices = first.num_timeslices
+    sums = np.fft.ifft(first.transform(np.fft.fft)
+                       * second.transform(np.fft.ifft) * num_timeslices)
+    if not (np.iscomplexobj(first.dense) or np.iscomplexobj(second.dense)):
+        sums = sums.real
     
-    # Get all possible differences between the various timeslice pairings
-    # (This works like an outer product, returning a 2d array)
-    diffs = combinatorics.diff(first_timeslices, second_timeslices,
-                               num_timeslices)
+    # If both traces live on every timeslice exactly once then every
+    # separation is made from num_timeslices products, otherwise correlate the
+    # occupancies to count the products contributing to each separation
+    if (first.occupancy == 1).all() and (second.occupancy == 1).all():
+        frequency = num_timeslices * np.ones(num_timeslices, dtype=np.int64)
+    else:
+        frequency = np.fft.ifft(first.transform(np.fft.fft, True)
+                                * second.transform(np.fft.ifft, True)
+                                * num_timeslices)
+        frequency = np.int64(np.rint(frequency.real))
+    
+    timeslices = frequency.nonzero()[0]
+    correlator = sums[timeslices] / frequency[timeslices]
+    
+    return np.array([timeslices, correlator])
 
-    # Get the products of all the correlators
-    prods = np.outer(first_trace, second_trace)
-    # Get the output timeslices by determining the uniqe list of diffs
-    timeslices = np.unique(diffs)
-    
-    # Now loop over the unique timeslices and sum the corresponding products
-    correlator = combinatorics.av_prods(timeslices, diffs, prods)
-    # Turn the result into a numpy array
+def _combine_traces_direct(first_trace, second_trace, first_timeslices,
+                           second_timeslices, num_timeslices):
+    """Computes a correlator from a pair of traces by averaging over the
+    products of all pairs of trace elements"""
+    
+    instrumentation.count("kernel.bin_prods")
+    
+    # Sum the products of the traces by separation in a single pass
+    sums, frequency = combinatorics.bin_prods(first_trace, second_trace,
+                                              first_timeslices,
+                                              second_timeslices,
+                                              num_timeslices)
+    
+    timeslices = frequency.nonzero()[0]
+    correlator = sums[timeslices] / frequency[timeslices]
+    
     return np.array([timeslices, correlator])
 
+@instrumentation.timed()
 def parse_connected(exact_data, sloppy_data):
     """Takes the exact and sloppy connected correlators and generates the
     correlators required for the AMA process
@@ -99,9 +231,13 @@ def parse_connected(exact_data, sloppy_data):
     
     return exact_source_average, sloppy_restr_corr_src_av, sloppy_source_average
 
-def parse_disconnected(exact_data, sloppy_data, num_timeslices, order="ls"):
+@instrumentation.timed()
+def parse_disconnected(exact_data, sloppy_data, num_timeslices, order="ls",
+                       method="fft"):
     """Takes the exact and sloppy traces supplied by load_traces and creates
-    the required correlators for the AMA
+    the required correlators for the AMA. Several orderings may be requested
+    at once, in which case each trace is only transformed once and the
+    transforms are shared between the orderings.
     
     :param exact_data: An array of exact traces loaded by the load_traces function in fileio
     :type exact_data: :class:`numpy.ndarray`
@@ -109,10 +245,17 @@ def parse_disconnected(exact_data, sloppy_data, num_timeslices, order="ls"):
     :type sloppy_data: :class:`numpy.ndarray`
     :param num_timeslices: The temporal extent of the lattice
     :type num_timeslices: :class:`int`
+    :param order: The trace ordering to combine, one of "ll", "ss" or "ls", or a list of them
+    :type order: :class:`str` or :class:`list`
+    :param method: The trace combination method passed to combine_traces
+    :type method: :class:`str`
     
-    :returns: :class:`tuple` of :class:`numpy.ndarray`
+    :returns: :class:`tuple` of :class:`numpy.ndarray`, or :class:`collections.OrderedDict` of them keyed by ordering if a list of orderings is given
     """
-
+    
+    single = isinstance(order, basestring)
+    orders = [order] if single else list(order)
+    
     # We *should* have traces for all sloppy timeslices, so don't need
     # to bother with the split here
     sloppy_timeslices = np.int64(sloppy_data[:, 0].real)
@@ -121,75 +264,62 @@ def parse_disconnected(exact_data, sloppy_data, num_timeslices, order="ls"):
     
     exact_timeslices_l, exact_timeslices_s, exact_trace_l, exact_trace_s \
       = fileio.split_traces(exact_data)
-
-    if order == "ss":
-        # Now do the combinatorics for the traces, starting with exact
-        exact_correlator = combine_traces(exact_trace_s,
-                                          exact_trace_s,
-                                          exact_timeslices_s,
-                                          exact_timeslices_s,
-                                          num_timeslices)
-    
-        sloppy_trace_s_r = sloppy_trace_s[exact_timeslices_s]
-    
-        sloppy_restricted_correlator = combine_traces(sloppy_trace_s_r,
-                                                      sloppy_trace_s,
-                                                      exact_timeslices_s,
-                                                      exact_timeslices_s,
-                                                      num_timeslices)
-    
-        sloppy_correlator = combine_traces(sloppy_trace_s,
-                                           sloppy_trace_s,
-                                           sloppy_timeslices,
-                                           sloppy_timeslices,
-                                           num_timeslices)
-        
-    elif order == "ll":
-        # Now do the combinatorics for the traces, starting with exact
-        exact_correlator = combine_traces(exact_trace_l,
-                                          exact_trace_l,
-                                          exact_timeslices_l,
-                                          exact_timeslices_l,
-                                          num_timeslices)
-    
-        sloppy_trace_l_r = sloppy_trace_l[exact_timeslices_l]
-    
-        sloppy_restricted_correlator = combine_traces(sloppy_trace_l_r,
-                                                      sloppy_trace_l_r,
-                                                      exact_timeslices_l,
-                                                      exact_timeslices_l,
-                                                      num_timeslices)
-    
-        sloppy_correlator = combine_traces(sloppy_trace_l,
-                                           sloppy_trace_l,
-                                           sloppy_timeslices,
-                                           sloppy_timeslices,
-                                           num_timeslices)
+    
+    # The exact, sloppy restricted and sloppy traces of each kind, along
+    # with their timeslices
+    exact_s = (exact_trace_s, exact_timeslices_s)
+    sloppy_s = (sloppy_trace_s, sloppy_timeslices)
+    traces = {"l": [(exact_trace_l, exact_timeslices_l),
+                    (sloppy_trace_l[exact_timeslices_l], exact_timeslices_l),
+                    (sloppy_trace_l, sloppy_timeslices)],
+              "s": [exact_s,
+                    (sloppy_trace_s[exact_timeslices_s], exact_timeslices_s),
+                    sloppy_s],
+              # Where the strange trace comes second in the "ss" and "ls"
+              # orderings, the sloppy restricted correlator has always paired
+              # the first len(exact_timeslices_s) sloppy strange values with
+              # the exact timeslices, rather than the values on them. The two
+              # agree whenever the exact strange traces cover every timeslice
+              "s_second": [exact_s,
+                           (sloppy_trace_s[:exact_timeslices_s.size],
+                            exact_timeslices_s),
+                           sloppy_s]}
+    
+    pairs = [("l", "l") if name == "ll"
+             else ("s" if name == "ss" else "l", "s_second")
+             for name in orders]
+    
+    if method == "fft":
+        # Scatter and transform each trace used only once, sharing those
+        # common to several kinds
+        transformed = {}
+        for kind in set(kind for pair in pairs for kind in pair):
+            for trace in traces[kind]:
+                if id(trace) not in transformed:
+                    transformed[id(trace)] \
+                      = _TransformedTrace(trace[0], trace[1], num_timeslices)
+        traces = dict((kind, [transformed.get(id(trace))
+                              for trace in kind_traces])
+                      for kind, kind_traces in traces.items())
+        combine = _combine_transformed
     else:
-        # Now do the combinatorics for the traces, starting with exact
-        exact_correlator = combine_traces(exact_trace_l,
-                                          exact_trace_s,
-                                          exact_timeslices_l,
-                                          exact_timeslices_s,
-                                          num_timeslices)
-    
-        sloppy_trace_l_r = sloppy_trace_l[exact_timeslices_l]
-    
-        sloppy_restricted_correlator = combine_traces(sloppy_trace_l_r,
-                                                      sloppy_trace_s,
-                                                      exact_timeslices_l,
-                                                      exact_timeslices_s,
-                                                      num_timeslices)
-    
-        sloppy_correlator = combine_traces(sloppy_trace_l,
-                                           sloppy_trace_s,
-                                           sloppy_timeslices,
-                                           sloppy_timeslices,
-                                           num_timeslices)        
-
-    # Return the timeslices for the sloppy restricted for use by ama
-    return exact_correlator[1], sloppy_restricted_correlator, sloppy_correlator[1]
+        combine = lambda first, second: \
+          combine_traces(first[0], second[0], first[1], second[1],
+                         num_timeslices, method)
+    
+    results = collections.OrderedDict()
+    
+    for name, (first, second) in zip(orders, pairs):
+        exact_correlator, sloppy_restricted_correlator, sloppy_correlator \
+          = [combine(x, y) for x, y in zip(traces[first], traces[second])]
+        
+        # Return the timeslices for the sloppy restricted for use by ama
+        results[name] = (exact_correlator[1], sloppy_restricted_correlator,
+                         sloppy_correlator[1])
+        
+    return results[order] if single else results
 
+@instrumentation.timed()
 def ama(exact_correlator, sloppy_restricted_correlator, sloppy_correlator):
     """Takes the three correlators required for the ama and does the
     subtraction
@@ -213,7 +343,152 @@ def ama(exact_correlator, sloppy_restricted_correlator, sloppy_correlator):
     else:
         return sloppy_correlator + exact_correlator - sloppy_restricted_correlator
 
-def run_one(exact_file, sloppy_file, num_timeslices=96, connected=False, order="ls"):
+@instrumentation.timed()
+def combine_traces_batch(first_traces, second_traces, first_masks=None,
+                         second_masks=None):
+    """Computes the correlators for a stack of configurations at once, where
+    the traces for each configuration live on all lattice timeslices, with
+    masks marking which timeslices are occupied
+    
+    :param first_traces: The first traces, shaped (n_configs, T)
+    :type first_traces: :class:`numpy.ndarray`
+    :param second_traces: The second traces, shaped (n_configs, T)
+    :type second_traces: :class:`numpy.ndarray`
+    :param first_masks: Boolean masks of the occupied first trace timeslices
+    :type first_masks: :class:`numpy.ndarray`
+    :param second_masks: Boolean masks of the occupied second trace timeslices
+    :type second_masks: :class:`numpy.ndarray`
+    
+    :returns: :class:`tuple` of :class:`numpy.ndarray` s: correlators and the number of products contributing to each separation, both shaped (n_configs, T)
+    """
+    
+    first_traces = np.asarray(first_traces)
+    second_traces = np.asarray(second_traces)
+    num_timeslices = first_traces.shape[-1]
+    
+    if first_masks is not None:
+        first_traces = np.where(first_masks, first_traces, 0)
+    if second_masks is not None:
+        second_traces = np.where(second_masks, second_traces, 0)
+        
+    sums = cross_correlate(first_traces, second_traces)
+    
+    if first_masks is None and second_masks is None:
+        frequency = num_timeslices * np.ones(sums.shape, dtype=np.int64)
+    else:
+        if first_masks is None:
+            first_masks = np.ones(first_traces.shape)
+        if second_masks is None:
+            second_masks = np.ones(second_traces.shape)
+        frequency = np.int64(np.rint(cross_correlate(np.int64(first_masks),
+                                                     np.int64(second_masks))))
+        
+    # Separations without any contributing products are marked with nans
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlators = np.where(frequency > 0, sums / frequency, np.nan)
+        
+    return correlators, frequency
+
+@instrumentation.timed()
+def ama_batch(exact_first, exact_second, sloppy_first, sloppy_second,
+              first_masks, second_masks, sloppy_restricted_second=None):
+    """Applies the AMA to a stack of configurations in a single vectorized
+    pass over the trace arrays
+    
+    :param exact_first: The first exact traces, shaped (n_configs, T)
+    :type exact_first: :class:`numpy.ndarray`
+    :param exact_second: The second exact traces, shaped (n_configs, T)
+    :type exact_second: :class:`numpy.ndarray`
+    :param sloppy_first: The first sloppy traces, shaped (n_configs, T)
+    :type sloppy_first: :class:`numpy.ndarray`
+    :param sloppy_second: The second sloppy traces, shaped (n_configs, T)
+    :type sloppy_second: :class:`numpy.ndarray`
+    :param first_masks: Boolean masks of the first exact trace timeslices
+    :type first_masks: :class:`numpy.ndarray`
+    :param second_masks: Boolean masks of the second exact trace timeslices
+    :type second_masks: :class:`numpy.ndarray`
+    :param sloppy_restricted_second: The second sloppy traces for the sloppy restricted correlators, if they differ from sloppy_second
+    :type sloppy_restricted_second: :class:`numpy.ndarray`
+    
+    :returns: :class:`tuple` of :class:`numpy.ndarray` s: AMA, exact, sloppy restricted and sloppy correlators, each shaped (n_configs, T)
+    """
+    
+    if sloppy_restricted_second is None:
+        sloppy_restricted_second = sloppy_second
+    
+    exact_correlators, frequency \
+      = combine_traces_batch(exact_first, exact_second,
+                             first_masks, second_masks)
+    sloppy_restricted_correlators, frequency \
+      = combine_traces_batch(sloppy_first, sloppy_restricted_second,
+                             first_masks, second_masks)
+    sloppy_correlators, sloppy_frequency \
+      = combine_traces_batch(sloppy_first, sloppy_second)
+    
+    # The residual only contributes on separations covered by the exact traces
+    with np.errstate(invalid="ignore"):
+        residual = np.where(frequency > 0,
+                            exact_correlators - sloppy_restricted_correlators,
+                            0)
+    ama_correlators = sloppy_correlators + residual
+    
+    return ama_correlators, exact_correlators, \
+      sloppy_restricted_correlators, sloppy_correlators
+
+@instrumentation.timed()
+def parse_disconnected_batch(exact_data, sloppy_data, order="ls"):
+    """Applies the AMA to a stack of exact and sloppy trace arrays, as loaded
+    by the load_traces function in fileio, for many configurations at once
+    
+    :param exact_data: The stacked exact traces, shaped (n_configs, T, 3)
+    :type exact_data: :class:`numpy.ndarray`
+    :param sloppy_data: The stacked sloppy traces, shaped (n_configs, T, 3)
+    :type sloppy_data: :class:`numpy.ndarray`
+    :param order: The trace ordering to combine, one of "ll", "ss" or "ls"
+    :type order: :class:`str`
+    
+    :returns: :class:`tuple` of :class:`numpy.ndarray` s: AMA, exact, sloppy restricted and sloppy correlators, each shaped (n_configs, T)
+    """
+    
+    exact_data = np.asarray(exact_data)
+    sloppy_data = np.asarray(sloppy_data)
+    num_timeslices = exact_data.shape[1]
+    
+    # The rows of each trace array must correspond to consecutive timeslices
+    timeslices = np.arange(num_timeslices)
+    for data in [exact_data, sloppy_data]:
+        if (np.int64(data[:, :, 0].real) != timeslices).any():
+            raise ValueError("Expected trace rows ordered by timeslice "
+                             "0 to {}".format(num_timeslices - 1))
+    
+    # As in split_traces, the exact traces live where they are non-zero
+    exact_masks = exact_data[:, :, 1:3] != 0
+    
+    if order == "ss":
+        first, second = 2, 2
+    elif order == "ll":
+        first, second = 1, 1
+    else:
+        first, second = 1, 2
+        
+    sloppy_restricted_second = sloppy_data[:, :, second]
+    if second == 2:
+        # As in parse_disconnected, the nth exact strange timeslice pairs
+        # with the nth sloppy strange value in the sloppy restricted
+        # correlator
+        masks = exact_masks[:, :, 1]
+        ranks = np.maximum(np.cumsum(masks, axis=1) - 1, 0)
+        sloppy_restricted_second \
+          = np.take_along_axis(sloppy_restricted_second, ranks, axis=1)
+        
+    return ama_batch(exact_data[:, :, first], exact_data[:, :, second],
+                     sloppy_data[:, :, first], sloppy_data[:, :, second],
+                     exact_masks[:, :, first - 1],
+                     exact_masks[:, :, second - 1], sloppy_restricted_second)
+
+@instrumentation.timed()
+def run_one(exact_file, sloppy_file, num_timeslices=96, connected=False, order="ls",
+            cache=None):
     """Applied the AMA procedure to the correlators or traces in the specified files
     
     :param exact_file: The file containing the exact correlators or traces
@@ -222,13 +497,17 @@ def run_one(exact_file, sloppy_file, num_timeslices=96, connected=False, order="
     :type sloppy_file: :class:`str`
     :param connected: Determines whether diagram is connected or not
     :type connected: :class:`bool`
+    :param order: The trace ordering to combine for disconnected diagrams, or a list of them to compute from the one load of the traces
+    :type order: :class:`str` or :class:`list`
+    :param cache: The cache in which to keep the parsed input files
+    :type cache: :class:`cache.FileCache`
     
-    :returns: :class:`numpy.ndarray` containing the correlator
+    :returns: :class:`list` containing the AMA, exact, sloppy restricted and sloppy correlators, or :class:`collections.OrderedDict` of these lists keyed by ordering if a list of orderings is given
     """
     
     if connected:
-        exact_data = fileio.load_correlators(exact_file)
-        sloppy_data = fileio.load_correlators(sloppy_file)
+        exact_data = fileio.load_correlators(exact_file, cache)
+        sloppy_data = fileio.load_correlators(sloppy_file, cache)
         
         correlators = parse_connected(exact_data, sloppy_data)
         # Pass the tuple result from the previous function as an *args expression
@@ -238,18 +517,189 @@ def run_one(exact_file, sloppy_file, num_timeslices=96, connected=False, order="
         return [correlator_ama] + list(correlators)
     
     else:
-        exact_data = fileio.load_traces(exact_file)
-        sloppy_data = fileio.load_traces(sloppy_file)
+        exact_data = fileio.load_traces(exact_file, cache)
+        sloppy_data = fileio.load_traces(sloppy_file, cache)
         
         correlators = parse_disconnected(exact_data, sloppy_data, num_timeslices, order)
-        correlator_ama = ama(*correlators)
         
-        return [correlator_ama] + list(correlators)
+        if isinstance(order, basestring):
+            return [ama(*correlators)] + list(correlators)
+        
+        return collections.OrderedDict(
+            (name, [ama(*results)] + list(results))
+            for name, results in correlators.items())
+        
+def _run_config(args):
+    """Applies run_one, or the supplied function, to a single configuration,
+    returning None in place of the correlators if the input files are
+    missing, along with the input file fingerprints if requested and the
+    instrumentation records if instrumented"""
+    
+    config, exact_file, sloppy_file, function, function_args, fingerprint, \
+      instrument = args
+    
+    if not instrument:
+        return _run_function(config, exact_file, sloppy_file, function,
+                             function_args, fingerprint) + (None,)
+    
+    # Collect the records for this configuration apart from any others, so
+    # that they can be passed back from a worker process and merged
+    instrumentation.enable()
+    with instrumentation.capture(merge=False) as records:
+        with instrumentation.timer("config"):
+            result = _run_function(config, exact_file, sloppy_file, function,
+                                   function_args, fingerprint)
+            
+    return result + (records,)
+    
+def _run_function(config, exact_file, sloppy_file, function, function_args,
+                  fingerprint):
+    """Applies the supplied function to the files for one configuration"""
+    
+    try:
+        if not fingerprint:
+            return config, function(exact_file, sloppy_file,
+                                    *function_args), None
+
+        # Fingerprint the inputs from the bytes read to process them, rather
+        # than reading them a second time, so the fingerprints match the
+        # data processed even if the files change during processing
+        with fileio.recording() as recorded:
+            result = function(exact_file, sloppy_file, *function_args)
+        # Functions that don't read the files through fileio leave them to
+        # be hashed here
+        fingerprints = [recorded.get(os.path.abspath(filename))
+                        or fileio.fingerprint(filename)
+                        for filename in [exact_file, sloppy_file]]
+
+        return config, result, fingerprints
+    except IOError:
+        return config, None, None
+        
+def _iter_results(tasks, workers=1, chunk_size=None, read_ahead=None):
+    """Applies _run_config to the supplied tasks, yielding the results in
+    task order. If read_ahead is given, no more than read_ahead tasks are
+    processed ahead of the task being yielded"""
+    
+    if workers <= 1 and read_ahead is None:
+        for task in tasks:
+            yield _run_config(task)
+        return
+    
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+    else:
+        # Use a thread so a single worker can read ahead in the background
+        pool = multiprocessing.pool.ThreadPool(1)
+        
+    try:
+        if read_ahead is None:
+            if chunk_size is None:
+                chunk_size = max(1, len(tasks) // (4 * workers))
+            # imap returns the results in configuration order, so the output
+            # is written the same way regardless of the number of workers
+            for result in pool.imap(_run_config, tasks, chunk_size):
+                yield result
+        else:
+            pending = collections.deque()
+            tasks = iter(tasks)
+            
+            for task in itertools.islice(tasks, read_ahead + 1):
+                pending.append(pool.apply_async(_run_config, (task,)))
+            while pending:
+                result = pending.popleft().get()
+                for task in itertools.islice(tasks, 1):
+                    pending.append(pool.apply_async(_run_config, (task,)))
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        
+def iter_ama(exact_folder, sloppy_folder, input_prefix, configs,
+             num_timeslices=96, connected=False, order="ls", cache=None,
+             workers=1, read_ahead=None, skipped=None, function=None,
+             function_args=None):
+    """Lazily applies the all-mode average to the supplied configurations,
+    yielding the results one configuration at a time. Configurations with
+    missing results are passed over.
+    
+    :param exact_folder: The folder containing the exact results
+    :type exact_folder: :class:`str`
+    :param sloppy_folder: The folder containing the sloppy results
+    :type sloppy_folder: :class:`str`
+    :param input_prefix: The common prefix used for the input data files in each folder
+    :type input_prefix: :class:`str`
+    :param configs: The configuration numbers used at the end of the input filenames
+    :type configs: :class:`list`
+    :param num_timeslices: The temporal extent of the lattice
+    :type num_timeslices: :class:`int`
+    :param connected: Determines whether the associated diagram is connected
+    :type connected: :class:`bool`
+    :param order: The trace ordering to combine for disconnected diagrams
+    :type order: :class:`str`
+    :param cache: The cache in which to keep the parsed input files
+    :type cache: :class:`cache.FileCache`
+    :param workers: The number of processes over which to spread the configurations
+    :type workers: :class:`int`
+    :param read_ahead: The maximum number of configurations to process ahead of the one last yielded
+    :type read_ahead: :class:`int`
+    :param skipped: A list to which the configurations with missing results are appended
+    :type skipped: :class:`list`
+    :param function: A module-level function to apply to the exact and sloppy files in place of run_one, such as ama.run3pt
+    :type function: :class:`function`
+    :param function_args: The arguments passed to function after the file names
+    :type function_args: :class:`tuple`
+    
+    :returns: generator of :class:`tuple` s of the configuration number and the correlators returned by run_one
+    """
+    
+    if function is None:
+        function = run_one
+        function_args = (num_timeslices, connected, order, cache)
+    else:
+        function_args = tuple(function_args or ())
+    
+    tasks = ((i,
+              "{}/{}.{}".format(exact_folder, input_prefix, i),
+              "{}/{}.{}".format(sloppy_folder, input_prefix, i),
+              function, function_args, False, instrumentation.enabled)
+             for i in configs)
+    
+    # Only the process pool needs the tasks up front, to size its chunks
+    if workers > 1 and read_ahead is None:
+        tasks = list(tasks)
+    
+    for i, correlator, fingerprints, records \
+      in _iter_results(tasks, workers, read_ahead=read_ahead):
+        if records is not None:
+            instrumentation.records().merge(records)
+        if correlator is None:
+            if skipped is not None:
+                skipped.append(i)
+        else:
+            yield i, correlator
+            
+def _results_exist(config, output_prefix, store):
+    """Determines whether the results for the supplied configuration have
+    already been written"""
+    
+    if store is not None:
+        return config in store and store.filled[store.index(config)]
+    else:
+        # Several orderings are saved together in a .npz file
+        return any(os.path.exists("{}{}{}".format(output_prefix, config,
+                                                  extension))
+                   for extension in [".npy", ".npz"])
         
 def run_all(exact_folder, sloppy_folder, input_prefix, output_prefix, start, stop, step,
-            num_timeslices=96, connected=False, order="ls"):
+            num_timeslices=96, connected=False, order="ls", cache=None,
+            workers=1, chunk_size=None, store=None, manifest=None,
+            function=None, function_args=None, instrument=False,
+            report=None, num_sources=None):
     """Applies the all-mode average to all files in the specified directories
-    and saves the results in a set of numpy binaries
+    and saves the results in a set of numpy binaries. If several trace
+    orderings are requested, each configuration's traces are loaded once and
+    all of the orderings saved together in a single .npz file
     
     :param exact_folder: The folder containing the exact results
     :type exact_folder: :class:`str`
@@ -269,16 +719,134 @@ def run_all(exact_folder, sloppy_folder, input_prefix, output_prefix, start, sto
     :type num_timeslices: :class:`int`
     :param connected: Determines whether the associated diagram is connected
     :type connected: :class:`bool`
+    :param order: The trace ordering to combine for disconnected diagrams, or a list of them
+    :type order: :class:`str` or :class:`list`
+    :param cache: The cache in which to keep the parsed input files
+    :type cache: :class:`cache.FileCache`
+    :param workers: The number of processes over which to spread the configurations
+    :type workers: :class:`int`
+    :param chunk_size: The number of configurations handed to a worker at a time
+    :type chunk_size: :class:`int`
+    :param store: An ensemble store to write the results into, in place of the per-configuration numpy binaries
+    :type store: :class:`ensemble.EnsembleStore`
+    :param manifest: A manifest used to skip configurations that are up to date, making the run incremental
+    :type manifest: :class:`manifest.Manifest`
+    :param function: A module-level function to apply to the exact and sloppy files in place of run_one, such as ama.run3pt
+    :type function: :class:`function`
+    :param function_args: The arguments passed to function after the file names
+    :type function_args: :class:`tuple`
+    :param instrument: Whether to record the time spent in each stage, along with the bytes read, rows parsed and kernel calls, and print a summary at the end of the run. Also done if instrumentation is enabled
+    :type instrument: :class:`bool`
+    :param report: A file in which to save the instrumentation records as JSON
+    :type report: :class:`str`
+    :param num_sources: The number of sources used for the correlators, recorded in the store along with the temporal extent, ordering and connectedness
+    :type num_sources: :class:`int` or :class:`dict`
+    
+    :returns: :class:`list` of the configurations skipped because their results are missing
     """
     
-    for i in xrange(start, stop + step, step):
-        try:
-            correlator \
-              = run_one("{}/{}.{}".format(exact_folder, input_prefix, i),
-                        "{}/{}.{}".format(sloppy_folder, input_prefix, i),
-                        num_timeslices, connected, order)
-        
-            np.save("{}{}".format(output_prefix, i), correlator)
+    start_time = time.time()
+    
+    was_enabled = instrumentation.enabled
+    instrument = instrument or report is not None or was_enabled
+    
+    if not isinstance(order, basestring):
+        # Keep the orderings as a list, as they are once read from a manifest
+        order = list(order)
+        if store is not None and not connected and function is None:
+            raise ValueError("An ensemble store holds a single trace "
+                             "ordering, but {} were requested".format(order))
+    
+    # Check before any configurations are processed, rather than failing
+    # on the first write
+    if store is not None and function not in (None, run_one):
+        raise ValueError("An ensemble store holds the two point correlators "
+                         "returned by run_one, so can't hold the results of "
+                         "{}".format(function.__name__))
+    # A store reopened to append to must hold results computed the same way,
+    # and a new one records how its results are computed
+    if store is not None:
+        store.check_attributes(num_timeslices=num_timeslices,
+                               connected=connected,
+                               order=None if connected else order,
+                               num_sources=num_sources)
+    
+    parameters = {"num_timeslices": num_timeslices, "connected": connected,
+                  "order": order}
+    
+    if function is None:
+        function = run_one
+        function_args = (num_timeslices, connected, order, cache)
+    else:
+        function_args = tuple(function_args or ())
+        # Record the simple arguments in the manifest, along with the types
+        # of any others, such as caches
+        parameters = {"function": function.__name__,
+                      "function_args": [arg if isinstance(arg, (int, float, str))
+                                        else type(arg).__name__
+                                        for arg in function_args]}
+    
+    tasks = [(i,
+              "{}/{}.{}".format(exact_folder, input_prefix, i),
+              "{}/{}.{}".format(sloppy_folder, input_prefix, i),
+              function, function_args, manifest is not None, instrument)
+             for i in xrange(start, stop + step, step)]
+    
+    num_up_to_date = 0
+    
+    if manifest is not None:
+        # Skip configurations processed from the same inputs with the same
+        # parameters, provided their results are still there
+        pending = [task for task in tasks
+                   if not (manifest.is_current(task[0], task[1:3], parameters)
+                           and _results_exist(task[0], output_prefix, store))]
+        num_up_to_date = len(tasks) - len(pending)
+        tasks = pending
+    
+    sink = store if store is not None else sinks.NpySink(output_prefix)
+    skipped = []
+    
+    if instrument:
+        instrumentation.enable()
+    
+    try:
+        with instrumentation.capture() as records:
+            for i, correlator, fingerprints, config_records \
+              in _iter_results(tasks, workers, chunk_size):
+                # Each configuration's records come back from the worker
+                # that processed it
+                if config_records is not None:
+                    records.merge(config_records)
+                    
+                if correlator is None:
+                    skipped.append(i)
+                    continue
+                
+                with instrumentation.timer("write"):
+                    sink.write(i, correlator)
+                    
+                if manifest is not None:
+                    if store is not None:
+                        store.flush()
+                    manifest.record(i, fingerprints, parameters)
+    finally:
+        sink.close()
+        if not was_enabled:
+            instrumentation.disable()
             
-        except IOError:
-            print("Results for configuration {} missing; skipping.".format(i))
+    elapsed = time.time() - start_time
+    num_processed = len(tasks) - len(skipped)
+    print("Processed {} configurations in {:.2f} s ({:.1f} configurations "
+          "per second); skipped {} with missing results and {} up to date."
+          .format(num_processed, elapsed,
+                  num_processed / elapsed if elapsed > 0 else 0.0,
+                  len(skipped), num_up_to_date))
+    
+    if instrument:
+        print(records.table())
+        
+        if report is not None:
+            with open(report, "w") as f:
+                f.write(records.json())
+    
+    return skipped
@@ -0,0 +1,139 @@
+import numpy as np
+import resampling
+
+def _time_arguments(num_timeslices, num_times):
+    """Computes the arguments T/2 - t and T/2 - t - 1 of the hyperbolic
+    functions in the periodic effective mass equations"""
+    
+    t = np.arange(num_times - 1, dtype=np.float64)
+    
+    return num_timeslices / 2.0 - t, num_timeslices / 2.0 - t - 1
+
+def _newton(function, m, max_iterations, tolerance):
+    """Solves function(m) = 0 element-wise with Newton's method, where
+    function returns the value and its derivative. Elements that fail to
+    converge are set to NaN"""
+    
+    converged = np.zeros(m.shape, dtype=bool)
+    
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        for iteration in xrange(max_iterations):
+            value, derivative = function(m)
+            step = value / derivative
+            new_m = m - step
+            # Keep the masses positive by halving rather than overshooting
+            new_m = np.where(new_m > 0, new_m, m / 2)
+            converged = np.abs(new_m - m) <= tolerance * np.abs(m)
+            m = new_m
+            if converged[np.isfinite(m)].all():
+                break
+            
+    return np.where(converged & np.isfinite(m), m, np.nan)
+
+def effmass(correlators, kind="log", num_timeslices=None, max_iterations=50,
+            tolerance=1e-12):
+    """Computes the effective mass of any number of correlators at once.
+    The log variant is log(C(t) / C(t + 1)), while the cosh and sinh
+    variants solve C(t) / C(t + 1) = f(m (T/2 - t)) / f(m (T/2 - t - 1)) for
+    f = cosh or sinh using Newton's method. The effective mass is NaN
+    wherever it is undefined, including the last timeslice, for which there
+    is no C(t + 1)
+    
+    :param correlators: The correlators, with time along the last axis
+    :type correlators: :class:`numpy.ndarray`
+    :param kind: The kind of effective mass, one of "log", "cosh" or "sinh"
+    :type kind: :class:`str`
+    :param num_timeslices: The temporal extent of the lattice, if it differs from the length of the correlators
+    :type num_timeslices: :class:`int`
+    :param max_iterations: The maximum number of Newton iterations
+    :type max_iterations: :class:`int`
+    :param tolerance: The relative tolerance in the Newton iterations
+    :type tolerance: :class:`float`
+    :returns: :class:`numpy.ndarray` with the same shape as correlators
+    """
+    
+    correlators = np.asarray(correlators, dtype=np.float64)
+    num_times = correlators.shape[-1]
+    
+    if num_timeslices is None:
+        num_timeslices = num_times
+        
+    masses = np.empty(correlators.shape)
+    masses[..., -1] = np.nan
+    
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_ratios = np.log(correlators[..., :-1] / correlators[..., 1:])
+        
+    if kind == "log":
+        masses[..., :-1] = log_ratios
+        return masses
+    
+    first, second = _time_arguments(num_timeslices, num_times)
+    
+    if kind == "cosh":
+        def function(m):
+            return (np.log(np.cosh(m * first)) - np.log(np.cosh(m * second))
+                    - log_ratios,
+                    first * np.tanh(m * first) - second * np.tanh(m * second))
+    elif kind == "sinh":
+        def function(m):
+            return (np.log(np.abs(np.sinh(m * first)))
+                    - np.log(np.abs(np.sinh(m * second))) - log_ratios,
+                    first / np.tanh(m * first) - second / np.tanh(m * second))
+    else:
+        raise ValueError("Unknown effective mass kind: {}".format(kind))
+    
+    masses[..., :-1] = _newton(function, np.abs(log_ratios), max_iterations,
+                               tolerance)
+    
+    if kind == "sinh":
+        # The sinh equation is singular where either argument vanishes
+        masses[..., :-1][..., (first == 0) | (second == 0)] = np.nan
+        
+    return masses
+
+def subtract_ground_state(correlators, amplitude, energy, num_timeslices=None):
+    """Subtracts the ground state A e^{-E t}, or A (e^{-E t} + e^{-E (T - t)})
+    for periodic correlators, from each correlator, with one amplitude and
+    energy per correlator or shared between them
+    
+    :param correlators: The correlators, shaped (n_samples, T)
+    :type correlators: :class:`numpy.ndarray`
+    :param amplitude: The ground state amplitude, scalar or shaped (n_samples,)
+    :type amplitude: :class:`float` or :class:`numpy.ndarray`
+    :param energy: The ground state energy, scalar or shaped (n_samples,)
+    :type energy: :class:`float` or :class:`numpy.ndarray`
+    :param num_timeslices: The temporal extent of the lattice, for periodic correlators
+    :type num_timeslices: :class:`int`
+    :returns: :class:`numpy.ndarray`
+    """
+    
+    correlators = np.asarray(correlators, dtype=np.float64)
+    t = np.arange(correlators.shape[-1], dtype=np.float64)
+    amplitude = np.asarray(amplitude, dtype=np.float64)[..., np.newaxis]
+    energy = np.asarray(energy, dtype=np.float64)[..., np.newaxis]
+    
+    ground_state = np.exp(-energy * t)
+    if num_timeslices is not None:
+        ground_state += np.exp(-energy * (num_timeslices - t))
+        
+    return correlators - amplitude * ground_state
+
+def jackknife_effmass(samples, kind="log", num_timeslices=None, **kwargs):
+    """Computes the effective mass of the jackknife samples of a correlator
+    along with its jackknife error
+    
+    :param samples: The jackknife samples of the correlator, shaped (n_samples, T)
+    :type samples: :class:`numpy.ndarray`
+    :param kind: The kind of effective mass, one of "log", "cosh" or "sinh"
+    :type kind: :class:`str`
+    :param num_timeslices: The temporal extent of the lattice, if it differs from the length of the correlators
+    :type num_timeslices: :class:`int`
+    :returns: :class:`tuple` of the effective mass of the mean correlator and its error
+    """
+    
+    samples = np.asarray(samples, dtype=np.float64)
+    central = effmass(samples.mean(axis=0), kind, num_timeslices, **kwargs)
+    masses = effmass(samples, kind, num_timeslices, **kwargs)
+    
+    return central, resampling.jackknife_error(masses)
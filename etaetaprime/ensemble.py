@@ -0,0 +1,313 @@
+import os
+import json
+import numpy as np
+
+quantities = ["ama", "exact", "sloppy_restricted", "sloppy"]
+
+def dense_correlators(correlators, num_timeslices):
+    """Places the correlators returned by run_one onto the full set of
+    timeslices, so that every correlator has num_timeslices entries.
+    Timeslices on which the exact and sloppy restricted correlators are not
+    defined are set to nan
+    
+    :param correlators: The AMA, exact, sloppy restricted and sloppy correlators
+    :type correlators: :class:`list` of :class:`numpy.ndarray`
+    :param num_timeslices: The temporal extent of the lattice
+    :type num_timeslices: :class:`int`
+    :returns: :class:`numpy.ndarray` with shape (4, num_timeslices)
+    """
+    
+    # Three point functions and several trace orderings have no place in
+    # the (4, num_timeslices) layout
+    if isinstance(correlators, dict) or len(correlators) != 4 \
+      or np.ndim(correlators[0]) != 1:
+        raise ValueError("Expected the AMA, exact, sloppy restricted and "
+                         "sloppy two point correlators returned by run_one "
+                         "for a single trace ordering")
+    
+    ama_correlator, exact_correlator, sloppy_restricted_correlator, \
+      sloppy_correlator = correlators
+    
+    out = np.zeros((4, num_timeslices), dtype=np.complex)
+    out[0] = ama_correlator
+    out[3] = sloppy_correlator
+    
+    # The disconnected sloppy restricted correlator also carries the
+    # timeslices on which it and the exact correlator are defined
+    if len(np.shape(sloppy_restricted_correlator)) > 1:
+        timeslices = np.int64(sloppy_restricted_correlator[0].real)
+        out[1:3] = np.nan
+        out[1, timeslices] = exact_correlator
+        out[2, timeslices] = sloppy_restricted_correlator[1]
+    else:
+        out[1] = exact_correlator
+        out[2] = sloppy_restricted_correlator
+        
+    return out
+
+class EnsembleStore(object):
+    """An ensemble of AMA results kept on disk as one memory-mapped array
+    per quantity, each shaped (n_configs, T), alongside an index of the
+    configuration numbers and a set of attributes
+    
+    New stores are made with EnsembleStore.create. Opening a store with
+    mode "r" gives read-only, zero-copy access to the arrays, whilst mode
+    "r+" allows configurations to be written as they are processed.
+    
+    :param path: The directory containing the store
+    :type path: :class:`str`
+    :param mode: The mode with which to open the arrays, either "r" or "r+"
+    :type mode: :class:`str`
+    """
+    
+    def __init__(self, path, mode="r"):
+        
+        self.path = path
+        self.mode = mode
+        
+        with open(os.path.join(path, "attributes.json")) as f:
+            self.attributes = json.load(f)
+            
+        self._open()
+        
+    @staticmethod
+    def _write_attributes(path, attributes):
+        """Atomically writes the supplied attributes to the store"""
+
+        attributes_path = os.path.join(path, "attributes.json")
+        tmp_path = "{}.{}.tmp".format(attributes_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(attributes, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, attributes_path)
+
+    def check_attributes(self, **attributes):
+        """Checks that the supplied attributes match those of the store,
+        recording any that the store doesn't have yet. A ValueError is
+        raised if any of them differ. Attributes given as None aren't
+        checked
+        """
+
+        missing = {}
+
+        for name, value in sorted(attributes.items()):
+            if value is None:
+                continue
+            if self.attributes.get(name) is None:
+                missing[name] = value
+            elif self.attributes[name] != value:
+                raise ValueError("Ensemble store {} holds results with {} "
+                                 "{!r}, not {!r}".format(self.path, name,
+                                                         self.attributes[name],
+                                                         value))
+
+        if missing:
+            if self.mode == "r":
+                raise IOError("Ensemble store {} is read-only"
+                              .format(self.path))
+            self.attributes.update(missing)
+            self._write_attributes(self.path, self.attributes)
+
+    def _open(self):
+        """Memory maps the arrays in the store"""
+        
+        self._arrays = dict((quantity,
+                             np.load(self._file(quantity), mmap_mode=self.mode))
+                            for quantity in quantities + ["configs", "filled"])
+        self._index = dict((config, i) for i, config
+                           in enumerate(self._arrays["configs"])
+                           if config >= 0)
+        
+    def _file(self, name):
+        """Returns the path of the array with the supplied name"""
+        
+        return os.path.join(self.path, "{}.npy".format(name))
+    
+    @classmethod
+    def create(cls, path, configs, num_timeslices, order=None,
+               connected=False, num_sources=None, dtype=np.complex,
+               **attributes):
+        """Creates a new store with space for the supplied configurations
+        
+        :param path: The directory in which to create the store
+        :type path: :class:`str`
+        :param configs: The configuration numbers to allocate space for
+        :type configs: :class:`list`
+        :param num_timeslices: The temporal extent of the lattice
+        :type num_timeslices: :class:`int`
+        :param order: The trace ordering of disconnected correlators
+        :type order: :class:`str`
+        :param connected: Determines whether the associated diagram is connected
+        :type connected: :class:`bool`
+        :param num_sources: The number of sources used for the correlators
+        :type num_sources: :class:`int` or :class:`dict`
+        :param dtype: The data type of the correlators
+        :type dtype: :class:`numpy.dtype`
+        :returns: :class:`EnsembleStore` opened with mode "r+"
+        """
+        
+        if not os.path.isdir(path):
+            os.makedirs(path)
+            
+        configs = np.int64(configs)
+        if np.unique(configs).size != configs.size:
+            raise ValueError("Duplicate configurations supplied to ensemble "
+                             "store {}".format(path))
+        # Memory maps can't be empty, so always leave room for one config
+        if configs.size == 0:
+            configs = -np.ones(1, dtype=np.int64)
+        
+        attributes.update({"num_timeslices": num_timeslices, "order": order,
+                           "connected": connected, "num_sources": num_sources,
+                           "dtype": np.dtype(dtype).str})
+        cls._write_attributes(path, attributes)
+            
+        cls._allocate(path, configs, np.zeros(configs.size, dtype=bool),
+                      num_timeslices, dtype)
+        
+        return cls(path, "r+")
+    
+    @staticmethod
+    def _allocate(path, configs, filled, num_timeslices, dtype):
+        """Writes the index and preallocates the arrays for the quantities"""
+        
+        for quantity in quantities:
+            array = np.lib.format.open_memmap(
+                os.path.join(path, "{}.npy".format(quantity)), mode="w+",
+                dtype=dtype, shape=(configs.size, num_timeslices))
+            array[:] = np.nan
+            del array
+        
+        np.save(os.path.join(path, "configs.npy"), configs)
+        np.save(os.path.join(path, "filled.npy"), filled)
+        
+    @property
+    def configs(self):
+        """The configuration numbers in the store"""
+        return self._arrays["configs"][:len(self._index)]
+    
+    @property
+    def filled(self):
+        """Flags indicating which configurations have been written"""
+        return self._arrays["filled"][:len(self._index)]
+    
+    @property
+    def num_timeslices(self):
+        """The temporal extent of the lattice"""
+        return self.attributes["num_timeslices"]
+    
+    def __getitem__(self, quantity):
+        """Returns the memory-mapped array for the supplied quantity, one of
+        "ama", "exact", "sloppy_restricted" or "sloppy"
+        """
+        
+        return self._arrays[quantity][:len(self._index)]
+    
+    def __len__(self):
+        return len(self._index)
+    
+    def __contains__(self, config):
+        return config in self._index
+    
+    def index(self, config):
+        """Returns the row of the arrays holding the supplied configuration
+        
+        :param config: The configuration number
+        :type config: :class:`int`
+        :returns: :class:`int`
+        """
+        
+        return self._index[config]
+    
+    def write(self, config, correlators):
+        """Writes the results of run_one for the supplied configuration into
+        the store, making room for the configuration if it isn't in the index
+        
+        :param config: The configuration number
+        :type config: :class:`int`
+        :param correlators: The AMA, exact, sloppy restricted and sloppy correlators
+        :type correlators: :class:`list` of :class:`numpy.ndarray`
+        """
+        
+        if self.mode == "r":
+            raise IOError("Ensemble store {} is read-only".format(self.path))
+        
+        if config not in self._index:
+            self._append_config(config)
+            
+        row = self._index[config]
+        values = dense_correlators(correlators, self.num_timeslices)
+        
+        for quantity, value in zip(quantities, values):
+            array = self._arrays[quantity]
+            array[row] = value if np.iscomplexobj(array) else value.real
+            
+        self._arrays["filled"][row] = True
+        
+    def _append_config(self, config):
+        """Adds a configuration to the index, doubling the capacity of the
+        arrays if they are full"""
+        
+        configs = self._arrays["configs"]
+        num_configs = len(self._index)
+        
+        if num_configs == configs.size:
+            self.flush()
+            capacity = max(2 * configs.size, 1)
+            
+            # The index is replaced last, so that if the growth is
+            # interrupted the arrays still have a row for every config in it
+            for quantity in quantities:
+                self._grow(quantity, capacity, np.nan)
+            self._grow("filled", capacity, False)
+            self._grow("configs", capacity, -1)
+
+            self._open()
+            configs = self._arrays["configs"]
+            
+        configs[num_configs] = config
+        self._index[config] = num_configs
+        
+    def _grow(self, name, capacity, fill_value, chunk_size=2**24):
+        """Copies the named array into a new file with room for capacity
+        rows, a chunk at a time, and renames it over the original. Writing
+        a new file leaves the original intact until the copy is complete,
+        and memory maps of it open elsewhere keep the old file
+
+        :param name: The name of the array
+        :type name: :class:`str`
+        :param capacity: The number of rows in the new array
+        :type capacity: :class:`int`
+        :param fill_value: The value of the new rows
+        :type fill_value: :class:`float`
+        :param chunk_size: The number of bytes to copy at a time
+        :type chunk_size: :class:`int`
+        """
+
+        array = self._arrays[name]
+        tmp_path = "{}.{}.tmp.npy".format(self._file(name)[:-4], os.getpid())
+
+        grown = np.lib.format.open_memmap(tmp_path, mode="w+",
+                                          dtype=array.dtype,
+                                          shape=(capacity,) + array.shape[1:])
+        rows = max(chunk_size // max(array[:1].nbytes, 1), 1)
+        for start in xrange(0, array.shape[0], rows):
+            stop = min(start + rows, array.shape[0])
+            grown[start:stop] = array[start:stop]
+        grown[array.shape[0]:] = fill_value
+        grown.flush()
+        del grown
+
+        os.rename(tmp_path, self._file(name))
+
+    def flush(self):
+        """Writes any changes to the memory-mapped arrays to disk"""
+        
+        for array in self._arrays.values():
+            if isinstance(array, np.memmap):
+                array.flush()
+                
+    def close(self):
+        """Flushes the store, so that it can be used as a sink for iter_ama"""
+        
+        if self.mode != "r":
+            self.flush()
@@ -0,0 +1,47 @@
+# The kernels in this package are loaded lazily from the fastest backend
+# available, so importing the package never compiles or loads anything. The
+# cython extensions are built ahead of time with
+#
+#     python setup.py build_ext --inplace
+#
+# and the pure numpy versions are used if they have not been built.
+import importlib
+
+class _Backend(object):
+    """Stands in for a kernel module, importing the first of the candidate
+    modules that is available on first use"""
+    
+    def __init__(self, *candidates):
+        self._candidates = candidates
+        self._module = None
+        
+    @property
+    def module(self):
+        """The module providing the kernels"""
+        
+        if self._module is None:
+            for candidate in self._candidates:
+                try:
+                    self._module = importlib.import_module(
+                        "." + candidate, __name__)
+                    break
+                except ImportError:
+                    continue
+            else:
+                raise ImportError("None of {} could be imported"
+                                  .format(", ".join(self._candidates)))
+            
+        return self._module
+    
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.module, name)
+    
+    def __repr__(self):
+        if self._module is None:
+            return "<lazy backend for {}>".format(", ".join(self._candidates))
+        return "<backend {}>".format(self._module.__name__)
+
+combinatorics = _Backend("combinatorics", "numpy_combinatorics")
+converters = _Backend("converters", "numpy_converters")
@@ -41,3 +41,41 @@ def av_prods(ts, diffs, prods):
                     frequency[i] += 1
                     
     return new / frequency
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def bin_prods(a, b, ta, tb, T):
+    cdef int j, k, d, h = a.size, w = b.size, num_t = T
+    
+    cdef np.ndarray[np.float64_t, ndim=1] a_re \
+      = np.ascontiguousarray(a.real, dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=1] a_im \
+      = np.ascontiguousarray(np.imag(a), dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=1] b_re \
+      = np.ascontiguousarray(b.real, dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=1] b_im \
+      = np.ascontiguousarray(np.imag(b), dtype=np.float64)
+    
+    cdef np.ndarray[np.int_t, ndim=1] ta_c \
+      = np.ascontiguousarray(ta, dtype=np.int) % T
+    cdef np.ndarray[np.int_t, ndim=1] tb_c \
+      = np.ascontiguousarray(tb, dtype=np.int) % T
+    
+    cdef np.ndarray[np.float64_t, ndim=1] sums_re = np.zeros(T)
+    cdef np.ndarray[np.float64_t, ndim=1] sums_im = np.zeros(T)
+    
+    cdef np.ndarray[np.int_t, ndim=1] frequency \
+      = np.zeros(T, dtype=np.int)
+    
+    # Accumulate each product into the bin for its separation in one pass
+    for j in xrange(h):
+        for k in xrange(w):
+            d = ta_c[j] - tb_c[k]
+            if d < 0:
+                d = d + num_t
+            sums_re[d] += a_re[j] * b_re[k] - a_im[j] * b_im[k]
+            sums_im[d] += a_re[j] * b_im[k] + a_im[j] * b_re[k]
+            frequency[d] += 1
+            
+    return sums_re + 1j * sums_im, frequency
@@ -0,0 +1,40 @@
+# Pure numpy equivalents of the functions in combinatorics.pyx, for use when
+# the cython extension cannot be built
+import numpy as np
+
+def diff(a, b, T):
+    """Computes the differences between all pairs of elements in a and b,
+    modulo T"""
+    
+    return np.subtract.outer(np.asarray(a), np.asarray(b)) % T
+
+def av_prods(ts, diffs, prods):
+    """Averages the products corresponding to each of the differences in ts"""
+    
+    ts = np.asarray(ts)
+    diffs = np.ravel(diffs)
+    prods = np.ravel(prods)
+    
+    matches = diffs == ts[:, np.newaxis]
+    
+    return np.dot(matches, np.complex128(prods)) / np.sum(matches, axis=1)
+
+def bin_prods(a, b, ta, tb, T):
+    """Sums the products of the elements in a and b according to the
+    separation of their timeslices ta and tb, modulo T, returning the sums and
+    the number of products contributing to each separation"""
+    
+    ta = np.asarray(ta, dtype=np.int64)
+    tb = np.asarray(tb, dtype=np.int64)
+    
+    # The separation and product of every pair, flattened for bincount
+    separations = ((ta[:, np.newaxis] - tb[np.newaxis, :]) % T).ravel()
+    prods = np.outer(np.complex128(a), np.complex128(b)).ravel()
+    
+    # Bin the real parts into the first T bins and the imaginary parts into
+    # the next T, so the complex sums take a single pass
+    sums = np.bincount(np.concatenate([separations, separations + T]),
+                       np.concatenate([prods.real, prods.imag]), 2 * T)
+    frequency = np.bincount(separations, minlength=T)
+    
+    return sums[:T] + 1j * sums[T:], frequency
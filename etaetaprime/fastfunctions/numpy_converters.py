@@ -0,0 +1,9 @@
+# Pure numpy equivalent of the function in converters.pyx, for use when the
+# cython extension has not been built
+import numpy as np
+
+def toarr(xy):
+    """Converts the supplied compound list to a two-dimensional float64
+    array"""
+    
+    return np.array(xy, dtype=np.float64)
@@ -1,8 +1,259 @@
-# Use cython to speed up the conversion to a numpy array from a list
-import pyximport
+import os
+import bz2
+import gzip
+import hashlib
+import threading
 import numpy as np
-pyximport.install()
+import instrumentation
+# Use cython, if built, to speed up the conversion to a numpy array from a list
 from fastfunctions import converters
+# xz support is in the standard library from python 3.3, and available
+# before that from the backports.lzma package
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# The fingerprints being recorded by each thread, kept apart as for the
+# instrumentation records
+_local = threading.local()
+
+# The magic bytes at the start of each kind of compressed file
+_magic_bytes = [("gzip", b"\x1f\x8b"), ("bz2", b"BZh"), ("xz", b"\xfd7zXZ\x00"),
+                ("zstd", b"\x28\xb5\x2f\xfd")]
+
+def compression(filename):
+    """Determines how the supplied file is compressed from the magic bytes at
+    its start
+    
+    :param filename: The file to examine
+    :type filename: :class:`str`
+    :returns: :class:`str`, one of "gzip", "bz2", "xz" or "zstd", or None if the file isn't compressed
+    """
+    
+    with open(filename, "rb") as f:
+        start = f.read(6)
+        
+    for name, magic in _magic_bytes:
+        if start.startswith(magic):
+            return name
+        
+    return None
+
+class _DecompressedFile(object):
+    """Wraps a file object decompressing the supplied file, raising a
+    ValueError if the compressed data turns out to be corrupt or truncated.
+    The codecs raise IOError or EOFError, which would otherwise be taken for
+    a missing file, as run_all does
+    
+    :param f: The file object doing the decompression
+    :type f: file object
+    :param filename: The compressed file
+    :type filename: :class:`str`
+    :param kind: The kind of compression, as returned by compression
+    :type kind: :class:`str`
+    """
+    
+    _errors = (IOError, EOFError) + ((lzma.LZMAError,) if lzma else ())
+    
+    def __init__(self, f, filename, kind, raw=None):
+        self._file = f
+        self.filename = filename
+        self.kind = kind
+        self._raw = raw
+        
+    def _call(self, method, *args):
+        try:
+            return getattr(self._file, method)(*args)
+        except self._errors as e:
+            raise ValueError("The {}-compressed file {} is corrupt or "
+                             "truncated: {}".format(self.kind, self.filename,
+                                                    e))
+        
+    def read(self, *args):
+        return self._call("read", *args)
+    
+    def readlines(self, *args):
+        return self._call("readlines", *args)
+    
+    def close(self):
+        self._file.close()
+        # The decompressors don't close the file objects they are given
+        if self._raw is not None:
+            self._raw.close()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+class _HashedFile(object):
+    """Wraps a file object, hashing the bytes read from it. Whatever hasn't
+    been read when the file is closed is hashed then, so the hash covers the
+    whole file. The gzip module seeks back to reread the end of each member,
+    so bytes are only hashed the first time they are read
+
+    :param f: The file object to read
+    :type f: file object
+    :param sha1: The hash to update with the bytes read
+    :type sha1: :class:`hashlib.sha1`
+    """
+
+    def __init__(self, f, sha1):
+        self._file = f
+        self.name = f.name
+        self.sha1 = sha1
+        self._hashed = 0
+
+    def read(self, size=-1):
+        position = self._file.tell()
+        if position > self._hashed:
+            # Hash any bytes that were seeked over
+            self._file.seek(self._hashed)
+            self.sha1.update(self._file.read(position - self._hashed))
+            self._hashed = position
+
+        data = self._file.read(size)
+        if position + len(data) > self._hashed:
+            self.sha1.update(data[self._hashed - position:])
+            self._hashed = position + len(data)
+
+        return data
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def readlines(self):
+        return self.read().splitlines(True)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.seek(self._hashed)
+            for chunk in iter(lambda: self.read(2**20), b""):
+                pass
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class _BZ2Reader(object):
+    """Decompresses the bz2 data read from a file object, for python 2,
+    where BZ2File only opens files by name. Like BZ2File there, only the
+    first stream in the file is read
+
+    :param f: The file object holding the compressed data
+    :type f: file object
+    :param chunk_size: The number of compressed bytes to read at a time
+    :type chunk_size: :class:`int`
+    """
+
+    def __init__(self, f, chunk_size=2**16):
+        self._file = f
+        self._chunk_size = chunk_size
+        self._decompressor = bz2.BZ2Decompressor()
+        self._buffer = b""
+        self._finished = False
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        num_bytes = len(self._buffer)
+
+        while (size < 0 or num_bytes < size) and not self._finished:
+            data = self._file.read(self._chunk_size)
+            # The decompressor raises an EOFError once the end of the stream
+            # has been found, even when given nothing to decompress
+            try:
+                chunks.append(self._decompressor.decompress(data))
+            except EOFError:
+                self._finished = True
+                break
+            if not data:
+                raise EOFError("Compressed file ended before the "
+                               "end-of-stream marker was reached")
+            num_bytes += len(chunks[-1])
+            self._finished = bool(self._decompressor.unused_data)
+
+        out = b"".join(chunks)
+        if size < 0:
+            size = len(out)
+        self._buffer = out[size:]
+
+        return out[:size]
+
+    def readlines(self):
+        return self.read().splitlines(True)
+
+    def close(self):
+        self._buffer = b""
+
+def _open_bz2(f):
+    """Opens a BZ2File on the supplied file object where python allows it"""
+
+    try:
+        return bz2.BZ2File(f, "rb")
+    except TypeError:
+        return _BZ2Reader(f)
+
+def open_data(filename, sha1=None):
+    """Opens the supplied file for reading in binary mode, decompressing
+    gzip, bz2 and xz files as they are read. Reading a corrupt or truncated
+    compressed file raises a ValueError
+    
+    :param filename: The file to open
+    :type filename: :class:`str`
+    :param sha1: A hash to update with the (compressed) bytes of the file as they are read
+    :type sha1: :class:`hashlib.sha1`
+    :returns: file object
+    """
+    
+    kind = compression(filename)
+    
+    # Files that can't be read fall through to the errors below
+    readable = [None, "gzip", "bz2"] + (["xz"] if lzma is not None else [])
+
+    if sha1 is not None and kind in readable:
+        # Decompress from the hashed file object, so that the file is only
+        # read the once
+        raw = _HashedFile(open(filename, "rb"), sha1)
+        if kind is None:
+            return raw
+        elif kind == "gzip":
+            return _DecompressedFile(gzip.GzipFile(fileobj=raw, mode="rb"),
+                                     filename, kind, raw)
+        elif kind == "bz2":
+            return _DecompressedFile(_open_bz2(raw), filename, kind, raw)
+        else:
+            return _DecompressedFile(lzma.LZMAFile(raw, "rb"), filename,
+                                     kind, raw)
+
+    if kind is None:
+        return open(filename, "rb")
+    elif kind == "gzip":
+        return _DecompressedFile(gzip.GzipFile(filename, "rb"), filename,
+                                 kind)
+    elif kind == "bz2":
+        return _DecompressedFile(bz2.BZ2File(filename, "rb"), filename, kind)
+    elif kind == "xz":
+        if lzma is None:
+            raise ImportError("Reading the xz-compressed file {} requires "
+                              "the lzma or backports.lzma module"
+                              .format(filename))
+        return _DecompressedFile(lzma.LZMAFile(filename, "rb"), filename,
+                                 kind)
+    else:
+        raise ValueError("The {}-compressed file {} can't be read; "
+                         "recompress it with gzip, bz2 or xz"
+                         .format(kind, filename))
 
 def file_to_list(filename):
     """Reads the supplied file into a compound list
@@ -12,31 +263,211 @@ def file_to_list(filename):
     :returns: Compound :class:`list`
     """
     
-    with open(filename) as f:
+    with open_data(filename) as f:
         out = [[float(x) for x in line.split()] for line in f.readlines()]
         
     return out
 
-def load_data(filename):
-    """Reads the supplied file into a numpy array, using cython to
-    speed up the numpy array conversion
+# The bytes np.fromstring skips as whitespace between numbers
+_whitespace = np.zeros(256, dtype=bool)
+_whitespace[[9, 10, 11, 12, 13, 32]] = True
+
+def _fields_per_line(buf):
+    """Counts the whitespace-separated fields on each line of the supplied
+    bytes, without splitting them into python strings
+
+    :param buf: The bytes to examine
+    :type buf: :class:`bytes`
+    :returns: :class:`numpy.ndarray` with the number of fields on each line
+    """
+
+    chars = np.frombuffer(buf, dtype=np.uint8)
+    space = _whitespace[chars]
+    # A field starts at each non-whitespace byte following whitespace
+    starts = ~space
+    starts[1:] &= space[:-1]
+    lines = np.cumsum(chars == ord("\n"))
+
+    return np.bincount(lines[starts], minlength=lines[-1] + 1)
+
+@instrumentation.timed()
+def parse_columns(filename, num_columns=None, chunk_size=2**20):
+    """Parses the whitespace-separated columns of numbers in the supplied file
+    straight into a float64 array, reading the file in chunks. Compressed
+    files are decompressed a chunk at a time as they are parsed
+    
+    :param filename: The file to parse
+    :type filename: :class:`str`
+    :param num_columns: The number of columns in the file, determined from the first line if not given
+    :type num_columns: :class:`int`
+    :param chunk_size: The number of (decompressed) bytes to read from the file at a time
+    :type chunk_size: :class:`int`
+    :returns: :class:`numpy.ndarray`
+    """
+    
+    # When recording fingerprints, hash the bytes as they are read rather
+    # than reading the file a second time
+    recording_fingerprints = getattr(_local, "fingerprints", None) is not None
+    sha1 = hashlib.sha1() if recording_fingerprints else None
+
+    with open_data(filename, sha1) as f:
+        # The size of a compressed file underestimates the number of rows,
+        # so the output array may need to grow as the file is parsed
+        stat = os.stat(filename)
+        file_size = stat.st_size
+        
+        out = None
+        num_rows = 0
+        num_bytes = 0
+        remainder = b""
+        
+        while True:
+            chunk = f.read(chunk_size)
+            num_bytes += len(chunk)
+            
+            # Only parse up to the last complete line, carrying the rest
+            # over to the next chunk
+            if chunk:
+                buf = remainder + chunk
+                end = buf.rfind(b"\n") + 1
+                buf, remainder = buf[:end], buf[end:]
+            else:
+                buf, remainder = remainder, b""
+                
+            if num_columns is None and buf.strip():
+                num_columns = len(buf.lstrip().split(b"\n", 1)[0].split())
+                
+            if buf.strip():
+                # fromstring tokenizes and converts the numbers in C, so no
+                # python float objects are created
+                values = np.fromstring(buf, dtype=np.float64, sep=" ")
+
+                # Every line that isn't blank must hold a full row, so that
+                # ragged rows are caught even when their total divides into
+                # whole rows
+                fields = _fields_per_line(buf)
+                fields = fields[fields > 0]
+                rows = fields.size
+                ragged = np.flatnonzero(fields != num_columns)
+                if ragged.size > 0 or values.size != rows * num_columns:
+                    row = num_rows + (ragged[0] if ragged.size > 0 else 0)
+                    raise ValueError("Expected {} columns in file {} after "
+                                     "row {}".format(num_columns, filename,
+                                                     row))
+
+                if out is None:
+                    # Estimate the number of rows from the size of the file
+                    row_bytes = max(len(buf) // max(rows, 1), 1)
+                    out = np.empty((file_size // row_bytes + 1, num_columns))
+                if num_rows + rows > out.shape[0]:
+                    out.resize((2 * (num_rows + rows), num_columns),
+                               refcheck=False)
+                    
+                out[num_rows:num_rows + rows] \
+                  = values.reshape((rows, num_columns))
+                num_rows += rows
+                
+            if not chunk:
+                break
+            
+    # The whole file has been hashed once it is closed
+    if sha1 is not None:
+        _record(_fingerprint(filename, stat, sha1))
+
+    instrumentation.count("bytes_read", num_bytes)
+    instrumentation.count("rows_parsed", num_rows)
+            
+    if out is None:
+        return np.empty((0, num_columns or 0))
+            
+    # Shrinking in place releases the unused rows without a copy, which
+    # would double the peak memory
+    out.resize((num_rows, num_columns), refcheck=False)
+    
+    return out
+
+def load_data(filename, num_columns=None):
+    """Reads the supplied file into a numpy array, parsing the file contents
+    directly into a preallocated array
     
     :param filename: The file to import
     :type filename: :class:`str`
+    :param num_columns: The number of columns in the file
+    :type num_columns: :class:`int`
     :returns: :class:`numpy.ndarray`
     """
 
-    return converters.toarr(file_to_list(filename))
+    return parse_columns(filename, num_columns)
 
-def load_correlators(filename):
+def _fingerprint(filename, stat, sha1):
+    """Returns the fingerprint dict for the supplied file stat and hash"""
+
+    return {"path": os.path.abspath(filename), "size": stat.st_size,
+            "mtime": stat.st_mtime, "sha1": sha1.hexdigest()}
+
+def _record(fingerprint):
+    """Adds the supplied fingerprint to the current recording, if any"""
+
+    fingerprints = getattr(_local, "fingerprints", None)
+    if fingerprints is not None:
+        fingerprints[fingerprint["path"]] = fingerprint
+
+def fingerprint(filename, chunk_size=2**20):
+    """Computes the size, modification time and content hash of the
+    supplied file, adding it to the current recording, if any
+    
+    :param filename: The file to fingerprint
+    :type filename: :class:`str`
+    :param chunk_size: The number of bytes to hash at a time
+    :type chunk_size: :class:`int`
+    :returns: :class:`dict` with keys path, size, mtime and sha1
+    """
+    
+    sha1 = hashlib.sha1()
+    
+    with open(filename, "rb") as f:
+        stat = os.fstat(f.fileno())
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+            
+    result = _fingerprint(filename, stat, sha1)
+    _record(result)
+
+    return result
+
+class recording(object):
+    """A context manager that records the fingerprints of the files read
+    within it, returning a dict of them keyed by absolute path on entry.
+    The files parsed are hashed from the bytes read to parse them, so they
+    aren't read a second time. On exit the fingerprints are added to those
+    of any enclosing recording
+    """
+
+    def __enter__(self):
+        self._outer = getattr(_local, "fingerprints", None)
+        self.fingerprints = {}
+        _local.fingerprints = self.fingerprints
+        return self.fingerprints
+
+    def __exit__(self, *exc_info):
+        _local.fingerprints = self._outer
+        if self._outer is not None:
+            self._outer.update(self.fingerprints)
+
+def load_correlators(filename, cache=None):
     """Loads the connected two point function in the specified file
     
     :param filename: The file from which to load the correlators
     :type filename: :class:`str`
+    :param cache: The cache in which to keep the parsed correlators
+    :type cache: :class:`cache.FileCache`
     :returns: :class:`numpy.ndarray`
     """
     
-    raw_data = load_data(filename)
+    if cache is not None:
+        return cache.load(filename, load_correlators)
+    
+    raw_data = load_data(filename, 4)
     out = np.zeros((raw_data.shape[0], 3), dtype=np.complex)
     
     out[:, 0:2] = raw_data[:, 0:2]
@@ -44,15 +475,20 @@ def load_correlators(filename):
     
     return out.real
 
-def load_traces(filename):
+def load_traces(filename, cache=None):
     """Loads the two traces in the specified file
     
     :param filename: The file from which to load the traces
     :type filename: :class:`str`
+    :param cache: The cache in which to keep the parsed traces
+    :type cache: :class:`cache.FileCache`
     :returns: :class:`numpy.ndarray`
     """
     
-    raw_data = load_data(filename)
+    if cache is not None:
+        return cache.load(filename, load_traces)
+    
+    raw_data = load_data(filename, 5)
     out = np.zeros((raw_data.shape[0], 3), dtype=np.complex)
     
     out[:, 0] = raw_data[:, 0]
@@ -61,6 +497,22 @@ def load_traces(filename):
 
     return out.real
 
+def load_three_point(filename, cache=None):
+    """Loads the three point functions in the specified file
+    
+    :param filename: The file from which to load the three point functions
+    :type filename: :class:`str`
+    :param cache: The cache in which to keep the parsed three point functions
+    :type cache: :class:`cache.FileCache`
+    :returns: :class:`numpy.ndarray`
+    """
+    
+    if cache is not None:
+        return cache.load(filename, load_three_point)
+    
+    return load_data(filename, 13)
+
+@instrumentation.timed()
 def split_traces(traces):
     """Splits the supplied trace array into traces and timeslices
     depending on which elements are non-zero
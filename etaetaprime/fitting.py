@@ -0,0 +1,720 @@
+import math
+import multiprocessing
+import numpy as np
+import resampling
+import instrumentation
+
+def _exponentials(energies, t, num_timeslices=None):
+    """Computes e^{-E t}, or e^{-E t} + e^{-E (T - t)} for periodic
+    correlators, along with its derivative with respect to E"""
+    
+    energies = energies[..., np.newaxis]
+    
+    if num_timeslices is None:
+        exponential = np.exp(-energies * t)
+        derivative = -t * exponential
+    else:
+        forward = np.exp(-energies * t)
+        backward = np.exp(-energies * (num_timeslices - t))
+        exponential = forward + backward
+        derivative = -t * forward - (num_timeslices - t) * backward
+        
+    return exponential, derivative
+
+def two_state_model(b, t, num_timeslices=None):
+    """Evaluates the two-state model b[0] e^{-b[1] t} + b[2] e^{-b[3] t}, or
+    its cosh variant if num_timeslices is given, for any number of parameter
+    vectors at once
+    
+    :param b: The parameters, with the four parameters along the last axis
+    :type b: :class:`numpy.ndarray`
+    :param t: The times at which to evaluate the model
+    :type t: :class:`numpy.ndarray`
+    :param num_timeslices: The temporal extent of the lattice, for periodic correlators
+    :type num_timeslices: :class:`int`
+    :returns: :class:`numpy.ndarray` shaped b.shape[:-1] + t.shape
+    """
+    
+    b = np.asarray(b, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+    
+    ground_state = _exponentials(b[..., 1], t, num_timeslices)[0]
+    excited_state = _exponentials(b[..., 3], t, num_timeslices)[0]
+    
+    return b[..., 0, np.newaxis] * ground_state \
+      + b[..., 2, np.newaxis] * excited_state
+
+def two_state_jacobian(b, t, num_timeslices=None):
+    """Evaluates the analytic derivatives of the two-state model with respect
+    to each of the parameters
+    
+    :param b: The parameters, with the four parameters along the last axis
+    :type b: :class:`numpy.ndarray`
+    :param t: The times at which to evaluate the derivatives
+    :type t: :class:`numpy.ndarray`
+    :param num_timeslices: The temporal extent of the lattice, for periodic correlators
+    :type num_timeslices: :class:`int`
+    :returns: :class:`numpy.ndarray` shaped b.shape[:-1] + t.shape + (4,)
+    """
+    
+    b = np.asarray(b, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+    
+    ground_state, ground_derivative \
+      = _exponentials(b[..., 1], t, num_timeslices)
+    excited_state, excited_derivative \
+      = _exponentials(b[..., 3], t, num_timeslices)
+      
+    return np.stack([ground_state,
+                     b[..., 0, np.newaxis] * ground_derivative,
+                     excited_state,
+                     b[..., 2, np.newaxis] * excited_derivative], axis=-1)
+
+def whitening_matrix(covariance):
+    """Computes the inverse of the Cholesky factor L of the supplied
+    covariance matrix, so that the correlated chi-squared of residuals r is
+    the sum of squares of L^{-1} r
+    
+    :param covariance: The covariance matrix
+    :type covariance: :class:`numpy.ndarray`
+    :returns: :class:`numpy.ndarray`
+    """
+    
+    cholesky = np.linalg.cholesky(np.asarray(covariance, dtype=np.float64))
+    
+    return np.linalg.solve(cholesky, np.eye(cholesky.shape[0]))
+
+class CovarianceWindows(object):
+    """Caches the whitening matrices of the diagonal sub-blocks of a
+    covariance matrix, so each fit window is only factorized once"""
+    
+    def __init__(self, covariance):
+        """Constructor
+        
+        :param covariance: The covariance matrix of the full correlator
+        :type covariance: :class:`numpy.ndarray`
+        """
+        
+        self.covariance = np.asarray(covariance, dtype=np.float64)
+        self._whitening = {}
+        
+    def whitening(self, fit_range):
+        """Returns the whitening matrix for the specified fit window
+        
+        :param fit_range: The range of times in the fit window
+        :type fit_range: :class:`list` with two elements
+        :returns: :class:`numpy.ndarray`
+        """
+        
+        key = tuple(fit_range)
+        
+        if key not in self._whitening:
+            window = slice(*key)
+            self._whitening[key] \
+              = whitening_matrix(self.covariance[window, window])
+            
+        return self._whitening[key]
+
+class ChiSquared(object):
+    """The chi-squared of the two-state model for a fixed fit window, which
+    can be evaluated for many parameter vectors at once. Residuals are either
+    uncorrelated or whitened by the Cholesky factor of a covariance matrix,
+    and Gaussian priors may be added on any of the parameters"""
+    
+    def __init__(self, t, y, err=None, covariance=None, whitening=None,
+                 b_est=None, b_err_est=None, num_timeslices=None):
+        """Constructor
+        
+        :param t: The times in the fit window
+        :type t: :class:`numpy.ndarray`
+        :param y: The correlator in the fit window
+        :type y: :class:`numpy.ndarray`
+        :param err: The errors in the correlator, for an uncorrelated chi-squared
+        :type err: :class:`numpy.ndarray`
+        :param covariance: The covariance matrix of the correlator in the fit window
+        :type covariance: :class:`numpy.ndarray`
+        :param whitening: A precomputed whitening matrix, as returned by whitening_matrix
+        :type whitening: :class:`numpy.ndarray`
+        :param b_est: Estimated central values of the parameters for use as priors
+        :type b_est: :class:`list`
+        :param b_err_est: Estimated standard deviations of the parameters for use as priors
+        :type b_err_est: :class:`list`
+        :param num_timeslices: The temporal extent of the lattice, to use the cosh variant of the model
+        :type num_timeslices: :class:`int`
+        """
+        
+        self.t = np.asarray(t, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.num_timeslices = num_timeslices
+        
+        if whitening is None and covariance is not None:
+            whitening = whitening_matrix(covariance)
+        self.whitening = whitening
+        self.weights = None if err is None \
+          else 1.0 / np.asarray(err, dtype=np.float64)
+        
+        if b_est is None or b_err_est is None:
+            self.b_est = None
+            self.prior_weights = None
+        else:
+            self.b_est = np.asarray(b_est, dtype=np.float64)
+            self.prior_weights = 1.0 / np.asarray(b_err_est, dtype=np.float64)
+            
+    def residuals(self, b):
+        """Computes the whitened residuals, followed by those of any priors
+        
+        :param b: The parameters, with the four parameters along the last axis
+        :type b: :class:`numpy.ndarray`
+        :returns: :class:`numpy.ndarray`
+        """
+        
+        b = np.asarray(b, dtype=np.float64)
+        r = self.y - two_state_model(b, self.t, self.num_timeslices)
+        
+        if self.whitening is not None:
+            r = np.dot(r, self.whitening.T)
+        elif self.weights is not None:
+            r = r * self.weights
+            
+        if self.b_est is not None:
+            r = np.concatenate([r, (b - self.b_est) * self.prior_weights],
+                               axis=-1)
+            
+        return r
+    
+    def __call__(self, b):
+        """Computes the chi-squared for a single parameter vector, or for
+        each row of an array of them
+        
+        :param b: The parameters, with the four parameters along the last axis
+        :type b: :class:`numpy.ndarray`
+        :returns: :class:`float` or :class:`numpy.ndarray`
+        """
+        
+        return np.sum(self.residuals(b)**2, axis=-1)
+
+def _solve(matrices, right_hand_sides):
+    """Solves a stack of linear systems, each with one or more right-hand
+    sides, falling back on the pseudo-inverse if any of them are singular"""
+    
+    vectors = right_hand_sides.ndim < matrices.ndim
+    if vectors:
+        right_hand_sides = right_hand_sides[..., np.newaxis]
+    
+    try:
+        solutions = np.linalg.solve(matrices, right_hand_sides)
+    except np.linalg.LinAlgError:
+        solutions = np.matmul(np.linalg.pinv(matrices), right_hand_sides)
+        
+    return solutions[..., 0] if vectors else solutions
+
+def _levenberg_marquardt(residuals, b, max_iterations, tolerance):
+    """Minimizes the sum of squared residuals for a stack of independent
+    problems at once. residuals(b, samples, jacobian) should return the
+    residuals of the given samples, and their Jacobian if requested"""
+    
+    num_samples, num_params = b.shape
+    all_samples = np.arange(num_samples)
+    active = np.ones(num_samples, dtype=bool)
+    chi_squared = np.sum(residuals(b, all_samples)**2, axis=1)
+    damping = 1e-3 * np.ones(num_samples)
+    converged = np.zeros(num_samples, dtype=bool)
+    num_evaluations = num_samples
+    
+    for iteration in xrange(max_iterations):
+        if not active.any():
+            break
+        
+        indices = all_samples[active]
+        r, jacobian = residuals(b[active], indices, jacobian=True)
+        num_evaluations += 2 * indices.size
+        
+        # Solve the damped normal equations for all active samples at once
+        jtj = np.einsum('sti,stj->sij', jacobian, jacobian)
+        gradient = -np.einsum('sti,st->si', jacobian, r)
+        diagonal = np.maximum(np.diagonal(jtj, axis1=1, axis2=2), 1e-300)
+        damped = jtj + damping[active, np.newaxis, np.newaxis] \
+          * diagonal[:, :, np.newaxis] * np.eye(num_params)
+        step = _solve(damped, gradient)
+            
+        trial = b[active] + step
+        with np.errstate(over="ignore", invalid="ignore"):
+            trial_chi_squared = np.sum(residuals(trial, indices)**2, axis=1)
+        accepted = trial_chi_squared < chi_squared[active]
+        accepted &= np.isfinite(trial_chi_squared)
+        
+        small_step = np.sqrt(np.sum(step**2, axis=1)) \
+          <= tolerance * (np.sqrt(np.sum(b[active]**2, axis=1)) + tolerance)
+        small_change = chi_squared[active] - trial_chi_squared \
+          <= tolerance * chi_squared[active]
+        # The residuals are orthogonal to the columns of the Jacobian at a
+        # minimum, whether or not the steps are accepted. A step can remove
+        # about the square of the cosine between them from the chi-squared,
+        # so compare it with the square root of the tolerance
+        small_gradient = np.all(
+            np.abs(gradient) <= np.sqrt(tolerance * diagonal
+                                        * chi_squared[active, np.newaxis]),
+            axis=1)
+        
+        accepted_indices = indices[accepted]
+        b[accepted_indices] = trial[accepted]
+        chi_squared[accepted_indices] = trial_chi_squared[accepted]
+        damping[accepted_indices] /= 10
+        damping[indices[~accepted]] *= 10
+        
+        # A rejected step may only be small because the damping has grown,
+        # so only accepted steps are taken to show convergence
+        done = (accepted & (small_step | small_change)) | small_gradient
+        converged[indices[done]] = True
+        # Samples whose damping blows up can no longer make progress
+        active[indices[done | (damping[indices] > 1e16)]] = False
+        
+    instrumentation.count("nfev.levenberg_marquardt", num_evaluations)
+        
+    return b, chi_squared, converged
+
+def batched_two_state_fit(t, y, err, b_init, num_timeslices=None,
+                          max_iterations=200, tolerance=1e-10):
+    """Fits the two-state model to many correlators at once using the
+    Levenberg-Marquardt algorithm, advancing every fit together with stacked
+    arrays and the analytic Jacobian
+    
+    :param t: The times over which to fit
+    :type t: :class:`numpy.ndarray`
+    :param y: The correlators to fit, shaped (n_samples, t.size)
+    :type y: :class:`numpy.ndarray`
+    :param err: The errors in the correlators, shaped (t.size,) or like y
+    :type err: :class:`numpy.ndarray`
+    :param b_init: The initial parameters, shared or one set per sample
+    :type b_init: :class:`numpy.ndarray`
+    :param num_timeslices: The temporal extent of the lattice, to fit the cosh variant of the model
+    :type num_timeslices: :class:`int`
+    :param max_iterations: The maximum number of iterations
+    :type max_iterations: :class:`int`
+    :param tolerance: The relative tolerance in the chi-squared and parameters
+    :type tolerance: :class:`float`
+    :returns: :class:`tuple` of the fitted parameters shaped (n_samples, 4), their chi-squared values and per-sample convergence flags
+    """
+    
+    t = np.asarray(t, dtype=np.float64)
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    weights = 1.0 / np.broadcast_to(np.asarray(err, dtype=np.float64),
+                                    y.shape)
+    
+    b = np.array(np.broadcast_to(b_init, (y.shape[0], 4)), dtype=np.float64)
+    
+    def residuals(b, samples, jacobian=False):
+        r = (y[samples] - two_state_model(b, t, num_timeslices)) \
+          * weights[samples]
+        if not jacobian:
+            return r
+        return r, -two_state_jacobian(b, t, num_timeslices) \
+          * weights[samples, :, np.newaxis]
+    
+    return _levenberg_marquardt(residuals, b, max_iterations, tolerance)
+
+def _priors(b_est, b_err_est):
+    """Splits priors on the four two-state parameters into the central values
+    and inverse widths of the amplitude and energy priors. Parameters without
+    a prior have an infinite width"""
+    
+    if b_est is None or b_err_est is None:
+        return np.zeros(2), np.zeros(2), np.zeros(2), np.zeros(2)
+    
+    b_est = np.asarray(b_est, dtype=np.float64)
+    inverse_widths = 1.0 / np.asarray(b_err_est, dtype=np.float64)
+    
+    return b_est[::2], inverse_widths[::2], b_est[1::2], inverse_widths[1::2]
+
+def _whitener(err, whitening, shape):
+    """Returns a function that whitens the residual-like arrays of the
+    given samples, shaped (n_samples, n_t) or (n_samples, n_t, n), either by
+    the supplied errors or by a whitening matrix"""
+    
+    if whitening is not None:
+        return lambda x, samples: np.einsum('ut,st...->su...', whitening, x)
+    
+    weights = 1.0 / np.broadcast_to(np.asarray(err, dtype=np.float64), shape)
+    
+    def whiten(x, samples):
+        w = weights[samples]
+        return x * (w if x.ndim == 2 else w[..., np.newaxis])
+    
+    return whiten
+
+def _projection(energies, t, y, whiten, samples, num_timeslices,
+                amplitude_est, amplitude_precision):
+    """Computes the whitened basis of exponentials for each pair of energies
+    and the amplitudes that minimize the chi-squared for them, given the
+    whitened correlators y"""
+    
+    basis, derivatives = _exponentials(energies, t, num_timeslices)
+    basis = whiten(np.swapaxes(basis, -1, -2), samples)
+    derivatives = whiten(np.swapaxes(derivatives, -1, -2), samples)
+    
+    normal = np.einsum('sti,stj->sij', basis, basis) \
+      + np.diag(amplitude_precision**2)
+    projection = np.einsum('sti,st->si', basis, y) \
+      + amplitude_precision**2 * amplitude_est
+    
+    return _solve(normal, projection), basis, derivatives, normal
+
+def variable_projection_amplitudes(energies, t, y, err=None,
+                                   num_timeslices=None, b_est=None,
+                                   b_err_est=None, covariance=None,
+                                   whitening=None):
+    """Computes the amplitudes that minimize the two-state chi-squared for the
+    supplied energies, using a closed-form weighted least-squares solve
+    
+    :param energies: The ground and excited state energies, shaped (n_samples, 2)
+    :type energies: :class:`numpy.ndarray`
+    :param t: The times over which to fit
+    :type t: :class:`numpy.ndarray`
+    :param y: The correlators to fit, shaped (n_samples, t.size)
+    :type y: :class:`numpy.ndarray`
+    :param err: The errors in the correlators, shaped (t.size,) or like y
+    :type err: :class:`numpy.ndarray`
+    :param num_timeslices: The temporal extent of the lattice, to use the cosh variant of the model
+    :type num_timeslices: :class:`int`
+    :param b_est: Estimated central values of the four parameters for use as priors
+    :type b_est: :class:`list`
+    :param b_err_est: Estimated standard deviations of the four parameters for use as priors
+    :type b_err_est: :class:`list`
+    :param covariance: The covariance matrix of the correlators, for a correlated fit
+    :type covariance: :class:`numpy.ndarray`
+    :param whitening: A precomputed whitening matrix, as returned by whitening_matrix
+    :type whitening: :class:`numpy.ndarray`
+    :returns: :class:`numpy.ndarray` shaped (n_samples, 2)
+    """
+    
+    t = np.asarray(t, dtype=np.float64)
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    energies = np.array(np.broadcast_to(energies, (y.shape[0], 2)),
+                        dtype=np.float64)
+    if whitening is None and covariance is not None:
+        whitening = whitening_matrix(covariance)
+    whiten = _whitener(err, whitening, y.shape)
+    samples = np.arange(y.shape[0])
+    amplitude_est, amplitude_precision = _priors(b_est, b_err_est)[:2]
+    
+    return _projection(energies, t, whiten(y, samples), whiten, samples,
+                       num_timeslices, amplitude_est, amplitude_precision)[0]
+
+def variable_projection_fit(t, y, err, energies_init, num_timeslices=None,
+                            b_est=None, b_err_est=None, max_iterations=200,
+                            tolerance=1e-10, covariance=None, whitening=None):
+    """Fits the two-state model to many correlators at once by variable
+    projection. Only the two energies are searched for non-linearly, with the
+    optimal amplitudes for each pair of energies found by a linear
+    least-squares solve
+    
+    :param t: The times over which to fit
+    :type t: :class:`numpy.ndarray`
+    :param y: The correlators to fit, shaped (n_samples, t.size)
+    :type y: :class:`numpy.ndarray`
+    :param err: The errors in the correlators, shaped (t.size,) or like y, ignored for correlated fits
+    :type err: :class:`numpy.ndarray`
+    :param energies_init: The initial ground and excited state energies, shared or one pair per sample
+    :type energies_init: :class:`numpy.ndarray`
+    :param num_timeslices: The temporal extent of the lattice, to fit the cosh variant of the model
+    :type num_timeslices: :class:`int`
+    :param b_est: Estimated central values of the four parameters for use as priors
+    :type b_est: :class:`list`
+    :param b_err_est: Estimated standard deviations of the four parameters for use as priors
+    :type b_err_est: :class:`list`
+    :param max_iterations: The maximum number of iterations
+    :type max_iterations: :class:`int`
+    :param tolerance: The relative tolerance in the chi-squared and energies
+    :type tolerance: :class:`float`
+    :param covariance: The covariance matrix of the correlators, for a correlated fit
+    :type covariance: :class:`numpy.ndarray`
+    :param whitening: A precomputed whitening matrix, as returned by whitening_matrix
+    :type whitening: :class:`numpy.ndarray`
+    :returns: :class:`tuple` of the fitted parameters shaped (n_samples, 4), their chi-squared values and per-sample convergence flags
+    """
+    
+    t = np.asarray(t, dtype=np.float64)
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    if whitening is None and covariance is not None:
+        whitening = whitening_matrix(covariance)
+    whiten = _whitener(err, whitening, y.shape)
+    all_samples = np.arange(y.shape[0])
+    whitened_y = whiten(y, all_samples)
+    amplitude_est, amplitude_precision, energy_est, energy_precision \
+      = _priors(b_est, b_err_est)
+    
+    energies = np.array(np.broadcast_to(energies_init, (y.shape[0], 2)),
+                        dtype=np.float64)
+    
+    def residuals(energies, samples, jacobian=False):
+        amplitudes, basis, derivatives, normal \
+          = _projection(energies, t, whitened_y[samples], whiten, samples,
+                        num_timeslices, amplitude_est, amplitude_precision)
+        data_residuals = whitened_y[samples] \
+          - np.einsum('sti,si->st', basis, amplitudes)
+        r = np.concatenate([
+            data_residuals,
+            amplitude_precision * (amplitudes - amplitude_est),
+            energy_precision * (energies - energy_est)], axis=1)
+        if not jacobian:
+            return r
+        # Differentiate the normal equations to find how the optimal
+        # amplitudes vary with each energy, as in Golub and Pereyra
+        amplitude_derivatives = _solve(
+            normal,
+            np.einsum('sti,st->si', derivatives, data_residuals)[:, :, np.newaxis]
+            * np.eye(2)
+            - np.einsum('stk,stj->skj', basis, derivatives)
+            * amplitudes[:, np.newaxis, :])
+        return r, np.concatenate([
+            -derivatives * amplitudes[:, np.newaxis, :]
+            - np.einsum('stk,skj->stj', basis, amplitude_derivatives),
+            amplitude_precision[:, np.newaxis] * amplitude_derivatives,
+            np.broadcast_to(np.diag(energy_precision),
+                            (energies.shape[0], 2, 2))], axis=1)
+    
+    energies, chi_squared, converged \
+      = _levenberg_marquardt(residuals, energies, max_iterations, tolerance)
+    amplitudes = _projection(energies, t, whitened_y, whiten, all_samples,
+                             num_timeslices, amplitude_est,
+                             amplitude_precision)[0]
+    
+    b = np.empty((y.shape[0], 4))
+    b[:, ::2] = amplitudes
+    b[:, 1::2] = energies
+    
+    return b, chi_squared, converged
+
+def fit_samples(t, central, samples, err, b_init, num_timeslices=None,
+                **kwargs):
+    """Fits the two-state model to the central correlator and then to every
+    resampled correlator, warm-starting the samples from the central fit
+    
+    :param t: The times over which to fit
+    :type t: :class:`numpy.ndarray`
+    :param central: The central correlator
+    :type central: :class:`numpy.ndarray`
+    :param samples: The resampled correlators, shaped (n_samples, t.size)
+    :type samples: :class:`numpy.ndarray`
+    :param err: The errors in the correlator
+    :type err: :class:`numpy.ndarray`
+    :param b_init: The initial parameters for the central fit
+    :type b_init: :class:`numpy.ndarray`
+    :param num_timeslices: The temporal extent of the lattice, to fit the cosh variant of the model
+    :type num_timeslices: :class:`int`
+    :returns: :class:`tuple` of the central parameters, the sample parameters and the sample convergence flags
+    """
+    
+    central_b, central_chi_squared, central_converged \
+      = batched_two_state_fit(t, central, err, b_init, num_timeslices,
+                              **kwargs)
+    sample_b, sample_chi_squared, sample_converged \
+      = batched_two_state_fit(t, samples, err, central_b[0], num_timeslices,
+                              **kwargs)
+      
+    return central_b[0], sample_b, sample_converged
+
+def chi_squared_p_value(chi_squared, dof):
+    """Computes the probability of finding a chi-squared at least as large as
+    the one supplied with the given number of degrees of freedom, i.e. the
+    regularized upper incomplete gamma function Q(dof / 2, chi_squared / 2)
+    
+    :param chi_squared: The chi-squared
+    :type chi_squared: :class:`float`
+    :param dof: The number of degrees of freedom
+    :type dof: :class:`int`
+    :returns: :class:`float`
+    """
+    
+    if dof <= 0 or not np.isfinite(chi_squared):
+        return np.nan
+    if chi_squared <= 0:
+        return 1.0
+    
+    a = dof / 2.0
+    x = chi_squared / 2.0
+    prefactor = math.exp(a * math.log(x) - x - math.lgamma(a))
+    
+    if x < a + 1:
+        # Series for the lower incomplete gamma function
+        term = total = 1.0 / a
+        n = a
+        while abs(term) > abs(total) * 1e-15:
+            n += 1
+            term *= x / n
+            total += term
+        return max(1.0 - prefactor * total, 0.0)
+    
+    # Continued fraction for the upper incomplete gamma function, evaluated
+    # with the modified Lentz algorithm
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1.0 / tiny
+    d = 1.0 / b
+    fraction = d
+    i = 0
+    while True:
+        i += 1
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1.0 / d
+        delta = d * c
+        fraction *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+        
+    return prefactor * fraction
+
+scan_dtype = np.dtype([("t_min", np.int64), ("t_max", np.int64),
+                       ("params", np.float64, 4), ("errors", np.float64, 4),
+                       ("chi_squared", np.float64), ("dof", np.int64),
+                       ("chi_squared_dof", np.float64),
+                       ("p_value", np.float64), ("converged", np.bool_)])
+
+def _scan_chunk(job):
+    """Fits a run of neighbouring windows in turn, warm-starting each one
+    from the fit to the window before it"""
+    
+    (windows, correlator, samples, err, covariance_windows, energies,
+     num_timeslices, b_est, b_err_est) = job
+    
+    t_all = np.arange(correlator.size, dtype=np.float64)
+    table = np.zeros(len(windows), dtype=scan_dtype)
+    # Each prior adds a term to the chi-squared, counting as one more data
+    # point in the degrees of freedom
+    num_priors = 0 if b_est is None or b_err_est is None else len(b_est)
+    
+    for row, (t_min, t_max) in zip(table, windows):
+        window = slice(t_min, t_max)
+        t = t_all[window]
+        whitening = None if covariance_windows is None \
+          else covariance_windows.whitening((t_min, t_max))
+        
+        b, chi_squared, converged \
+          = variable_projection_fit(t, correlator[window], err[window],
+                                    energies, num_timeslices, b_est,
+                                    b_err_est, whitening=whitening)
+        
+        if samples is None:
+            # Take the errors from the curvature of the chi-squared
+            whiten = _whitener(err[window], whitening, (1, t.size))
+            jacobian = whiten(two_state_jacobian(b, t, num_timeslices), [0])
+            if b_est is not None and b_err_est is not None:
+                jacobian = np.concatenate(
+                    [jacobian, np.diag(1.0 / np.asarray(b_err_est))
+                     [np.newaxis]], axis=1)
+            covariance = np.linalg.pinv(np.dot(jacobian[0].T, jacobian[0]))
+            errors = np.sqrt(np.abs(np.diag(covariance)))
+        else:
+            sample_b, sample_chi_squared, sample_converged \
+              = variable_projection_fit(t, samples[:, window], err[window],
+                                        b[0, 1::2], num_timeslices, b_est,
+                                        b_err_est, whitening=whitening)
+            errors = resampling.jackknife_error(sample_b)
+            converged &= sample_converged.all()
+            
+        dof = t.size + num_priors - 4
+        row["t_min"] = t_min
+        row["t_max"] = t_max
+        row["params"] = b[0]
+        row["errors"] = errors
+        row["chi_squared"] = chi_squared[0]
+        row["dof"] = dof
+        row["chi_squared_dof"] = chi_squared[0] / dof if dof > 0 else np.nan
+        row["p_value"] = chi_squared_p_value(chi_squared[0], dof)
+        row["converged"] = converged[0]
+        
+        if converged[0]:
+            energies = b[0, 1::2]
+            
+    return table
+
+def scan_windows(correlator, windows, samples=None, err=None, covariance=None,
+                 energies_init=(0.5, 1.0), num_timeslices=None, b_est=None,
+                 b_err_est=None, correlated=False, workers=1):
+    """Performs a two-state fit to the supplied correlator in each of the
+    specified fit windows, for choosing a fit range. Windows are fitted in
+    order of t_min and t_max, each one warm-started from the one before, and
+    correlated fits take their whitening matrices from sub-blocks of the
+    covariance matrix of the full correlator. Each fit evaluates the
+    exponentials at its own energies, so these aren't shared between windows
+    
+    :param correlator: The central value of the correlator
+    :type correlator: :class:`numpy.ndarray`
+    :param windows: The fit windows, each a pair (t_min, t_max) as in range(t_min, t_max)
+    :type windows: :class:`list`
+    :param samples: Jackknife samples of the correlator shaped (n_samples, T), from which to compute errors
+    :type samples: :class:`numpy.ndarray`
+    :param err: The errors in the correlator
+    :type err: :class:`numpy.ndarray`
+    :param covariance: The covariance matrix of the correlator, for correlated fits
+    :type covariance: :class:`numpy.ndarray`
+    :param energies_init: The initial ground and excited state energies for the first window
+    :type energies_init: :class:`tuple`
+    :param num_timeslices: The temporal extent of the lattice, to fit the cosh variant of the model
+    :type num_timeslices: :class:`int`
+    :param b_est: Estimated central values of the four parameters for use as priors
+    :type b_est: :class:`list`
+    :param b_err_est: Estimated standard deviations of the four parameters for use as priors
+    :type b_err_est: :class:`list`
+    :param correlated: Whether to perform correlated fits with the covariance estimated from the samples, if no covariance is supplied
+    :type correlated: :class:`bool`
+    :param workers: The number of processes to fit the windows with
+    :type workers: :class:`int`
+    :returns: :class:`numpy.ndarray` with dtype scan_dtype, one row per window in the order supplied, where the degrees of freedom count each prior as a data point
+    """
+    
+    correlator = np.asarray(correlator, dtype=np.float64)
+    if samples is not None:
+        samples = np.asarray(samples, dtype=np.float64)
+    
+    if correlated and covariance is None:
+        if samples is None:
+            raise ValueError("Correlated fits need either a covariance "
+                             "matrix or samples to estimate one from")
+        covariance = resampling.jackknife_covariance(samples)
+    
+    if err is None:
+        if covariance is not None:
+            err = np.sqrt(np.diag(covariance))
+        elif samples is not None:
+            err = resampling.jackknife_error(samples)
+        else:
+            err = np.ones(correlator.size)
+    err = np.asarray(err, dtype=np.float64)
+            
+    covariance_windows = None
+    if covariance is not None:
+        covariance_windows = covariance \
+          if isinstance(covariance, CovarianceWindows) \
+          else CovarianceWindows(covariance)
+    
+    windows = [tuple(window) for window in windows]
+    order = sorted(range(len(windows)), key=lambda i: windows[i])
+    chunks = [chunk for chunk in np.array_split(order, max(workers, 1))
+              if chunk.size > 0]
+    jobs = [([windows[i] for i in chunk], correlator, samples, err,
+             covariance_windows, np.asarray(energies_init, dtype=np.float64),
+             num_timeslices, b_est, b_err_est) for chunk in chunks]
+    
+    table = np.zeros(len(windows), dtype=scan_dtype)
+    if not jobs:
+        return table
+    
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            tables = pool.map(_scan_chunk, jobs)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        tables = map(_scan_chunk, jobs)
+        
+    table[np.concatenate(chunks)] = np.concatenate(tables)
+    
+    return table
@@ -0,0 +1,154 @@
+import numpy as np
+
+def correlator_matrix(connected_light, connected_strange, disconnected_ll,
+                      disconnected_ss, disconnected_ls, disconnected_sl=None,
+                      connected_factors=(1.0, 1.0),
+                      disconnected_factors=(-2.0, -1.0, -np.sqrt(2))):
+    """Assembles the 2x2 matrix of correlators between the light and strange
+    flavour states from the connected and disconnected pieces, which may
+    have any leading shape, such as resampling samples, with time along the
+    last axis. The light-strange element is symmetrized if the strange-light
+    ordering is also supplied.
+    
+    C_ll = c_l * connected_light + d_ll * disconnected_ll
+    C_ss = c_s * connected_strange + d_ss * disconnected_ss
+    C_ls = C_sl = d_ls * disconnected_ls
+    
+    :param connected_light: The connected light correlator
+    :type connected_light: :class:`numpy.ndarray`
+    :param connected_strange: The connected strange correlator
+    :type connected_strange: :class:`numpy.ndarray`
+    :param disconnected_ll: The disconnected correlator with "ll" order
+    :type disconnected_ll: :class:`numpy.ndarray`
+    :param disconnected_ss: The disconnected correlator with "ss" order
+    :type disconnected_ss: :class:`numpy.ndarray`
+    :param disconnected_ls: The disconnected correlator with "ls" order
+    :type disconnected_ls: :class:`numpy.ndarray`
+    :param disconnected_sl: The disconnected correlator with the strange trace at the source
+    :type disconnected_sl: :class:`numpy.ndarray`
+    :param connected_factors: The factors (c_l, c_s) multiplying the connected correlators
+    :type connected_factors: :class:`tuple`
+    :param disconnected_factors: The factors (d_ll, d_ss, d_ls) multiplying the disconnected correlators
+    :type disconnected_factors: :class:`tuple`
+    :returns: :class:`numpy.ndarray` with shape (..., T, 2, 2)
+    """
+    
+    c_l, c_s = connected_factors
+    d_ll, d_ss, d_ls = disconnected_factors
+    
+    off_diagonal = np.real(disconnected_ls)
+    if disconnected_sl is not None:
+        off_diagonal = (off_diagonal + np.real(disconnected_sl)) / 2
+    
+    light = c_l * np.real(connected_light) + d_ll * np.real(disconnected_ll)
+    strange = c_s * np.real(connected_strange) \
+      + d_ss * np.real(disconnected_ss)
+    mixed = d_ls * off_diagonal
+    light, strange, mixed = np.broadcast_arrays(light, strange, mixed)
+    
+    return np.stack([np.stack([light, mixed], axis=-1),
+                     np.stack([mixed, strange], axis=-1)], axis=-2)
+
+def _align(reference, vectors):
+    """Swaps each pair of eigenvectors where that improves their overlap with
+    the reference eigenvectors and flips their signs to match the reference,
+    returning the aligned vectors and where they were swapped"""
+    
+    overlaps = np.abs(np.einsum('...in,...im->...nm', reference, vectors))
+    swap = overlaps[..., 0, 1] + overlaps[..., 1, 0] \
+      > overlaps[..., 0, 0] + overlaps[..., 1, 1]
+    
+    vectors = np.where(swap[..., np.newaxis, np.newaxis], vectors[..., ::-1],
+                       vectors)
+    signs = np.sign(np.einsum('...in,...in->...n', reference, vectors))
+    signs[signs == 0] = 1
+    
+    return vectors * signs[..., np.newaxis, :], swap
+
+def solve_gevp(correlators, t0):
+    """Solves the generalized eigenvalue problem C(t) v = lambda(t, t0) C(t0) v
+    for every time and any leading dimensions at once. The states are
+    ordered by decreasing eigenvalue at t0 + 1 and then followed from one
+    time to the next by their overlap, so the ordering is consistent across
+    t. The eigenvectors are normalized so that v^T C(t0) v = 1.
+    
+    :param correlators: The correlator matrices, shaped (..., T, 2, 2)
+    :type correlators: :class:`numpy.ndarray`
+    :param t0: The reference time
+    :type t0: :class:`int`
+    :returns: :class:`tuple` of the principal correlators shaped (..., T, 2) and the eigenvectors shaped (..., T, 2, 2), with one eigenvector per column
+    """
+    
+    correlators = np.asarray(correlators, dtype=np.float64)
+    num_times = correlators.shape[-3]
+    
+    # Reduce to an ordinary symmetric eigenproblem with the Cholesky factor
+    # of C(t0), for all times and samples at once
+    cholesky = np.linalg.cholesky(correlators[..., t0, :, :])
+    inverse = np.linalg.inv(cholesky)[..., np.newaxis, :, :]
+    reduced = np.matmul(np.matmul(inverse, correlators),
+                        np.swapaxes(inverse, -1, -2))
+    reduced = (reduced + np.swapaxes(reduced, -1, -2)) / 2
+    eigenvalues, eigenvectors = np.linalg.eigh(reduced)
+    eigenvalues = eigenvalues[..., ::-1]
+    eigenvectors = eigenvectors[..., ::-1]
+    
+    # Follow the states outwards from t0 + 1, where they are ordered by
+    # their eigenvalues, since at t0 itself the eigenvectors are arbitrary
+    reference_time = min(t0 + 1, num_times - 1)
+    times = range(reference_time + 1, num_times) \
+      + range(reference_time - 1, -1, -1)
+    for t in times:
+        previous = t - 1 if t > reference_time else t + 1
+        eigenvectors[..., t, :, :], swap \
+          = _align(eigenvectors[..., previous, :, :],
+                   eigenvectors[..., t, :, :])
+        eigenvalues[..., t, :] = np.where(swap[..., np.newaxis],
+                                          eigenvalues[..., t, ::-1],
+                                          eigenvalues[..., t, :])
+        
+    generalized = np.matmul(np.swapaxes(inverse, -1, -2), eigenvectors)
+    
+    return eigenvalues, generalized
+
+def mixing_angles(correlators, eigenvectors, t0):
+    """Estimates the eta-eta' mixing angle in the light-strange basis from
+    the overlaps Z_n = C(t0) v_n of each state with the flavour states. The
+    eta gives tan(phi) = -Z_s / Z_l and the eta' gives tan(phi) = Z_l / Z_s.
+    
+    :param correlators: The correlator matrices, shaped (..., T, 2, 2)
+    :type correlators: :class:`numpy.ndarray`
+    :param eigenvectors: The generalized eigenvectors from solve_gevp
+    :type eigenvectors: :class:`numpy.ndarray`
+    :param t0: The reference time used to compute the eigenvectors
+    :type t0: :class:`int`
+    :returns: :class:`numpy.ndarray` shaped (..., T, 2), the angle from the eta and then from the eta' at each time, which is NaN at t0
+    """
+    
+    correlators = np.asarray(correlators, dtype=np.float64)
+    overlaps = np.matmul(correlators[..., t0:t0 + 1, :, :], eigenvectors)
+    
+    with np.errstate(divide="ignore", invalid="ignore"):
+        eta = np.arctan(-overlaps[..., 1, 0] / overlaps[..., 0, 0])
+        eta_prime = np.arctan(overlaps[..., 0, 1] / overlaps[..., 1, 1])
+    angles = np.stack([eta, eta_prime], axis=-1)
+    # Every vector solves the eigenproblem at t0, so there is no estimate
+    angles[..., t0, :] = np.nan
+        
+    return angles
+
+def gevp(correlators, t0):
+    """Solves the generalized eigenvalue problem for the 2x2 light-strange
+    correlator matrix, returning the principal correlators and mixing angle
+    estimates
+    
+    :param correlators: The correlator matrices, shaped (..., T, 2, 2), as returned by correlator_matrix
+    :type correlators: :class:`numpy.ndarray`
+    :param t0: The reference time
+    :type t0: :class:`int`
+    :returns: :class:`tuple` of the principal correlators shaped (..., T, 2) and the mixing angles shaped (..., T, 2)
+    """
+    
+    principal_correlators, eigenvectors = solve_gevp(correlators, t0)
+    
+    return principal_correlators, mixing_angles(correlators, eigenvectors, t0)
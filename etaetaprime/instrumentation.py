@@ -0,0 +1,217 @@
+import time
+import json
+import threading
+import functools
+
+# Instrumentation is opt-in. While disabled the timers and counters below do
+# nothing beyond checking this flag
+enabled = False
+
+def enable():
+    """Switches on the recording of stage timings and counters"""
+    global enabled
+    enabled = True
+
+def disable():
+    """Switches off the recording of stage timings and counters"""
+    global enabled
+    enabled = False
+
+class Records(object):
+    """The wall times spent in each stage of the analysis, along with
+    counters such as the bytes read, rows parsed, kernel invocations and
+    function evaluations
+    
+    Times are inclusive, so the time recorded for a stage includes that
+    spent in any stages it calls.
+    """
+    
+    def __init__(self):
+        
+        # Stage name -> [calls, total, minimum, maximum]
+        self.timings = {}
+        self.counters = {}
+    
+    def add_time(self, stage, elapsed):
+        """Records one call to the supplied stage taking elapsed seconds"""
+        
+        timing = self.timings.get(stage)
+        
+        if timing is None:
+            self.timings[stage] = [1, elapsed, elapsed, elapsed]
+        else:
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = min(timing[2], elapsed)
+            timing[3] = max(timing[3], elapsed)
+    
+    def add_count(self, name, amount=1):
+        """Adds the supplied amount to the named counter"""
+        self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def merge(self, other):
+        """Adds the timings and counters of another set of records, such as
+        those returned by a worker process, to these ones
+        
+        :param other: The records to add
+        :type other: :class:`Records`
+        """
+        
+        for stage, (calls, total, minimum, maximum) in other.timings.items():
+            timing = self.timings.get(stage)
+            
+            if timing is None:
+                self.timings[stage] = [calls, total, minimum, maximum]
+            else:
+                timing[0] += calls
+                timing[1] += total
+                timing[2] = min(timing[2], minimum)
+                timing[3] = max(timing[3], maximum)
+        
+        for name, amount in other.counters.items():
+            self.add_count(name, amount)
+    
+    def as_dict(self):
+        """Returns the records in a form that may be saved as JSON
+        
+        :returns: :class:`dict` with timings and counters
+        """
+        
+        return {"timings": dict((stage, {"calls": calls, "total": total,
+                                         "min": minimum, "max": maximum,
+                                         "mean": total / calls})
+                                for stage, (calls, total, minimum, maximum)
+                                in self.timings.items()),
+                "counters": dict(self.counters)}
+    
+    def json(self):
+        """Returns the records as a JSON report
+        
+        :returns: :class:`str`
+        """
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+    
+    def table(self):
+        """Returns a table of the timings, slowest stage first, followed by
+        the counters
+        
+        :returns: :class:`str`
+        """
+        
+        lines = ["{:<32} {:>8} {:>10} {:>10} {:>10}"
+                 .format("stage", "calls", "total (s)", "mean (ms)",
+                         "max (ms)")]
+        
+        for stage, (calls, total, minimum, maximum) \
+          in sorted(self.timings.items(), key=lambda item: -item[1][1]):
+            lines.append("{:<32} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}"
+                         .format(stage, calls, total, 1e3 * total / calls,
+                                 1e3 * maximum))
+        
+        if self.counters:
+            lines.append("")
+            lines.append("{:<32} {:>19}".format("counter", "total"))
+            for name, amount in sorted(self.counters.items()):
+                lines.append("{:<32} {:>19}".format(name, amount))
+        
+        return "\n".join(lines)
+
+_default = Records()
+# Each thread may collect its records apart from the others, so a thread
+# reading ahead in iter_ama doesn't record into the consumer's records
+_local = threading.local()
+
+def records():
+    """Returns the records currently being collected
+    
+    :returns: :class:`Records`
+    """
+    return getattr(_local, "records", None) or _default
+
+def reset():
+    """Clears the records currently being collected"""
+    
+    current = records()
+    current.timings.clear()
+    current.counters.clear()
+
+class capture(object):
+    """A context manager that collects the records made within it apart
+    from the others, returning the new records on entry. On exit the
+    records are added to the enclosing ones if merge is True.
+    
+    :param merge: Whether to add the collected records to the enclosing ones
+    :type merge: :class:`bool`
+    """
+    
+    def __init__(self, merge=True):
+        self.merge = merge
+    
+    def __enter__(self):
+        self._outer = getattr(_local, "records", None)
+        self.records = Records()
+        _local.records = self.records
+        return self.records
+    
+    def __exit__(self, *exc_info):
+        _local.records = self._outer
+        if self.merge:
+            records().merge(self.records)
+
+def count(name, amount=1):
+    """Adds the supplied amount to the named counter, if enabled
+    
+    :param name: The name of the counter
+    :type name: :class:`str`
+    :param amount: The amount to add
+    :type amount: :class:`int`
+    """
+    
+    if enabled:
+        records().add_count(name, amount)
+
+class timer(object):
+    """A context manager recording the wall time spent within it against
+    the named stage, if enabled
+    
+    :param stage: The name of the stage
+    :type stage: :class:`str`
+    """
+    
+    __slots__ = ("stage", "start")
+    
+    def __init__(self, stage):
+        self.stage = stage
+    
+    def __enter__(self):
+        self.start = time.time() if enabled else None
+    
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            records().add_time(self.stage, time.time() - self.start)
+
+def timed(stage=None):
+    """A decorator recording the wall time spent in each call to the
+    decorated function, if enabled
+    
+    :param stage: The name of the stage, by default the function name
+    :type stage: :class:`str`
+    """
+    
+    def decorator(function):
+        name = stage or function.__name__
+        
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                records().add_time(name, time.time() - start)
+        
+        return wrapper
+    
+    return decorator
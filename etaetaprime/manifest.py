@@ -0,0 +1,102 @@
+import os
+import json
+import fileio
+
+class Manifest(object):
+    """A record of the input file fingerprints and processing parameters
+    used for each configuration, for use in incremental runs
+    
+    The manifest is kept as a file of JSON lines that is appended to as each
+    configuration is processed, so an interrupted run loses at most the
+    configuration it was working on. Later lines take precedence over
+    earlier ones for the same configuration.
+    
+    :param path: The file in which to keep the manifest
+    :type path: :class:`str`
+    """
+    
+    def __init__(self, path):
+        
+        self.path = path
+        self.entries = {}
+        
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Skip any line left incomplete by an interrupted run
+                        continue
+                    self.entries[entry["config"]] = entry
+                    
+    def is_current(self, config, filenames, parameters):
+        """Determines whether the supplied configuration was processed from
+        the same input files with the same parameters. Input files that
+        were only touched have their new modification times recorded, so
+        they aren't hashed again on later runs
+        
+        :param config: The configuration number
+        :type config: :class:`int`
+        :param filenames: The input files for the configuration
+        :type filenames: :class:`list` of :class:`str`
+        :param parameters: The processing parameters
+        :type parameters: :class:`dict`
+        :returns: :class:`bool`
+        """
+        
+        entry = self.entries.get(config)
+        
+        if entry is None or entry["parameters"] != parameters \
+          or len(entry["inputs"]) != len(filenames):
+            return False
+        
+        inputs = []
+
+        for filename, recorded in zip(filenames, entry["inputs"]):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                return False
+            
+            if os.path.abspath(filename) != recorded["path"] \
+              or stat.st_size != recorded["size"]:
+                return False
+            # Only hash the file if it has been touched since it was recorded
+            current = recorded
+            if stat.st_mtime != recorded["mtime"]:
+                current = fileio.fingerprint(filename)
+                if current["sha1"] != recorded["sha1"]:
+                    return False
+            inputs.append(current)
+
+        if inputs != entry["inputs"]:
+            self._append(dict(entry, inputs=inputs))
+            
+        return True
+    
+    def record(self, config, fingerprints, parameters):
+        """Records the input file fingerprints and processing parameters for
+        the supplied configuration, appending them to the manifest file
+        
+        :param config: The configuration number
+        :type config: :class:`int`
+        :param fingerprints: The fingerprints of the input files, as computed by fileio.fingerprint
+        :type fingerprints: :class:`list` of :class:`dict`
+        :param parameters: The processing parameters
+        :type parameters: :class:`dict`
+        """
+        
+        self._append({"config": config, "inputs": fingerprints,
+                      "parameters": parameters})
+
+    def _append(self, entry):
+        """Appends the supplied entry to the manifest file, where it takes
+        precedence over any earlier one for the same configuration"""
+
+        self.entries[entry["config"]] = entry
+        
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry, sort_keys=True) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
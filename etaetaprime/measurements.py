@@ -1,10 +1,15 @@
 import numpy as np
-import pyQCD
 import scipy.optimize as spop
 import minimizers
+import fitting
+import effmass
+import instrumentation
 
+@instrumentation.timed()
 def constrained_two_state_fit(twopoint, correlator, fit_range, b_init,
-                              b_est=None, b_err_est=None, stddev=None):
+                              b_est=None, b_err_est=None, stddev=None,
+                              covariance=None, max_restarts=20,
+                              tolerance=1e-6, full_output=False):
     """Performs a constrained fit on the supplied two-point function
     
     :param twopoint: TwoPoint object containing the correlators
@@ -13,50 +18,72 @@ def constrained_two_state_fit(twopoint, correlator, fit_range, b_init,
     :type correlator: :class:`str`
     :param fit_range: The ranger of times over which to perform the fit
     :type fit_range: :class:`list` with two elements
-    :param b_init: Initial estimate for the fitted parameters
-    :type b_init: :class:`list`
+    :param b_init: Initial estimate for the fitted parameters, or the full output of a previous fit to warm-start from
+    :type b_init: :class:`list` or :class:`dict`
     :param b_est: Estimated central value for use when performing a constrained fit
     :type b_est: :class:`list`
     :param b_err_est: Estimated standard deviation for use when performing a constrained fit
     :type b_err_est: :class:`list`
     :param stddev: The standard deviation in the specified correlator
     :type stddev: :class:`numpy.ndarray`
-    :returns: :class:`list` containing the fitted masses and square amplitudes
+    :param covariance: The covariance matrix of the correlator, or a CovarianceWindows object wrapping it, for a correlated fit
+    :type covariance: :class:`numpy.ndarray` or :class:`fitting.CovarianceWindows`
+    :param max_restarts: The maximum number of times to restart the minimizer
+    :type max_restarts: :class:`int`
+    :param tolerance: The relative tolerance in the parameters and chi-squared between restarts
+    :type tolerance: :class:`float`
+    :param full_output: Whether to return the full output of the minimizer
+    :type full_output: :class:`bool`
+    :returns: :class:`list` containing the fitted masses and square amplitudes, or :class:`dict` as returned by minimizers.minimize_with_restarts if full_output is True
     """
 
+    chi_squared = _chi_squared(twopoint, correlator, fit_range, b_est,
+                               b_err_est, stddev, covariance)
+
+    result = minimizers.minimize_with_restarts(chi_squared, b_init,
+                                               method="Powell",
+                                               max_restarts=max_restarts,
+                                               tolerance=tolerance,
+                                               objective_tolerance=tolerance)
+    
+    if full_output:
+        return result
+
+    result_values = result['x']
+    #result_values[0] /= 2 * result_values[1]
+    #result_values[2] /= 2 * result_values[3]
+    
+    return result_values
+
+def _chi_squared(twopoint, correlator, fit_range, b_est=None, b_err_est=None,
+                 stddev=None, covariance=None):
+    """Constructs the chi-squared objective for a two-state fit to the
+    specified correlator over the supplied fit range"""
+    
     t = np.arange(twopoint.T)
     correlator = getattr(twopoint, "{}_px0_py0_pz0".format(correlator))
     
-    if stddev == None:
+    if stddev is None:
         stddev = np.ones(twopoint.T)
     
     x = t[range(*fit_range)]
     y = correlator[range(*fit_range)]
     err = stddev[range(*fit_range)]
     
-    fit_function \
-      = lambda b, t: b[0] * np.exp(-b[1] * t) + b[2] * np.exp(-b[3] * t)
-
-    result = spop.minimize(pyQCD.TwoPoint._chi_squared, b_init,
-                           args=(x, y, err, fit_function, b_est, b_err_est),
-                           method="Powell")
-
-    for i in xrange(20):
-        result = spop.minimize(pyQCD.TwoPoint._chi_squared, result['x'],
-                               args=(x, y, err, fit_function, b_est, b_err_est),
-                               method="Powell")
-        
-    chi_square = pyQCD.TwoPoint._chi_squared(result['x'], x, y, err, fit_function,
-                                             b_est, b_err_est)
-
-    result_values = result['x']
-    #result_values[0] /= 2 * result_values[1]
-    #result_values[2] /= 2 * result_values[3]
+    if covariance is None:
+        return fitting.ChiSquared(x, y, err, b_est=b_est, b_err_est=b_err_est)
     
-    return result_values
+    if not isinstance(covariance, fitting.CovarianceWindows):
+        covariance = fitting.CovarianceWindows(covariance)
+        
+    return fitting.ChiSquared(x, y, whitening=covariance.whitening(fit_range),
+                              b_est=b_est, b_err_est=b_err_est)
 
+@instrumentation.timed()
 def two_state_grid_minimize(twopoint, correlator, fit_range, b_ranges,
-                              b_est=None, b_err_est=None, stddev=None):
+                            b_est=None, b_err_est=None, stddev=None,
+                            grid_points=None, adaptive=False, workers=1,
+                            covariance=None):
     """Performs a constrained fit on the supplied two-point function using the
     custom grid_search algorithm
     
@@ -74,30 +101,33 @@ def two_state_grid_minimize(twopoint, correlator, fit_range, b_ranges,
     :type b_err_est: :class:`list`
     :param stddev: The standard deviation in the specified correlator
     :type stddev: :class:`numpy.ndarray`
+    :param grid_points: The number of grid points to use for each parameter, by default 100, or that of adaptive_grid_search if adaptive is True. Fewer points give a coarser but much faster search
+    :type grid_points: :class:`int`
+    :param adaptive: Whether to use the adaptive grid search
+    :type adaptive: :class:`bool`
+    :param workers: The number of processes to use in the adaptive grid search
+    :type workers: :class:`int`
+    :param covariance: The covariance matrix of the correlator, or a CovarianceWindows object wrapping it, for a correlated fit
+    :type covariance: :class:`numpy.ndarray` or :class:`fitting.CovarianceWindows`
     :returns: :class:`list` containing the fitted masses and square amplitudes
     """
 
-    t = np.arange(twopoint.T)
-    correlator = getattr(twopoint, "{}_px0_py0_pz0".format(correlator))
-    
-    if stddev == None:
-        stddev = np.ones(twopoint.T)
-    
-    x = t[range(*fit_range)]
-    y = correlator[range(*fit_range)]
-    err = stddev[range(*fit_range)]
-    
-    fit_function \
-      = lambda b, t: b[0] * np.exp(-b[1] * t) + b[2] * np.exp(-b[3] * t)
+    chi_squared = _chi_squared(twopoint, correlator, fit_range, b_est,
+                               b_err_est, stddev, covariance)
 
-    result = minimizers.grid_search(pyQCD.TwoPoint._chi_squared, b_ranges,
-                                    args=(x, y, err, fit_function, b_est,
-                                          b_err_est), tolerance=1e-9, grid_points=100)
-    
-    print(result)
+    if adaptive:
+        kwargs = {} if grid_points is None else {"grid_points": grid_points}
+        result = minimizers.adaptive_grid_search(
+            chi_squared, b_ranges, vectorized=True, workers=workers,
+            **kwargs)['x']
+    else:
+        result = minimizers.grid_search(chi_squared, b_ranges, tolerance=1e-9,
+                                        grid_points=grid_points or 100,
+                                        vectorized=True)
     
     return result
 
+@instrumentation.timed()
 def two_state_fit_leastsq(twopoint, correlator, fit_range, b_init, stddev=None):
     """Performs a least squares two-state fit on the supplied two-point function
     
@@ -128,7 +158,9 @@ def two_state_fit_leastsq(twopoint, correlator, fit_range, b_init, stddev=None):
       = lambda b, t, Ct, err: \
       (Ct - b[0] * np.exp(-b[1] * t) - b[2] * np.exp(-b[3] * t)) / err
 
-    b, result = spop.leastsq(fit_function, b_init, args=(x, y, err))
+    b, cov, info, message, result \
+      = spop.leastsq(fit_function, b_init, args=(x, y, err), full_output=True)
+    instrumentation.count("nfev.leastsq", info["nfev"])
 
     for i in xrange(0):
         b, result = spop.leastsq(fit_function, b, args=(x, y, err))
@@ -139,6 +171,50 @@ def two_state_fit_leastsq(twopoint, correlator, fit_range, b_init, stddev=None):
     
     return result_values
 
+@instrumentation.timed()
+def two_state_fit_variable_projection(twopoint, correlator, fit_range,
+                                      energies_init, b_est=None,
+                                      b_err_est=None, stddev=None):
+    """Performs a two-state fit on the supplied two-point function by
+    variable projection, searching over the energies only and solving for the
+    amplitudes linearly
+    
+    :param twopoint: TwoPoint object containing the correlators
+    :type twopoint: :class:`TwoPoint` of :class:`BareTwoPoint`
+    :param correlator: Specification of the correlator to fit
+    :type correlator: :class:`str`
+    :param fit_range: The ranger of times over which to perform the fit
+    :type fit_range: :class:`list` with two elements
+    :param energies_init: Initial estimate for the ground and excited state energies
+    :type energies_init: :class:`list`
+    :param b_est: Estimated central value for use when performing a constrained fit
+    :type b_est: :class:`list`
+    :param b_err_est: Estimated standard deviation for use when performing a constrained fit
+    :type b_err_est: :class:`list`
+    :param stddev: The standard deviation in the specified correlator
+    :type stddev: :class:`numpy.ndarray`
+    :returns: :class:`list` containing the fitted masses and square amplitudes
+    """
+
+    t = np.arange(twopoint.T)
+    correlator = getattr(twopoint, "{}_px0_py0_pz0".format(correlator))
+    
+    if stddev is None:
+        stddev = np.ones(twopoint.T)
+    
+    x = t[range(*fit_range)]
+    y = correlator[range(*fit_range)]
+    err = stddev[range(*fit_range)]
+    
+    b, chi_squared, converged \
+      = fitting.variable_projection_fit(x, y, err, energies_init,
+                                        b_est=b_est, b_err_est=b_err_est)
+    
+    if not converged[0]:
+        print("Warning: variable projection fit did not converge.")
+    
+    return b[0]
+
 def separate_fits(twopoint, correlator, first_fit_range, second_fit_range,
                   stddev=None):
     """Fits the ground state and first excited state by performing a one-state
@@ -195,7 +271,7 @@ def excited_effmass(twopoint, fit_function, args):
     excited_correlator = getattr(twopoint, "{}_px0_py0_pz0".format(args[0])) \
       - fitting_results[0] * np.exp(-fitting_results[1] * np.arange(twopoint.T))
 
-    return np.log(np.abs(excited_correlator / np.roll(excited_correlator, -1)))
+    return effmass.effmass(np.abs(excited_correlator))
 
 def combined_effmass(twopoint, fit_function, args):
     """Computes the combinedeffective mass of the first two states based on the
@@ -219,6 +295,6 @@ def combined_effmass(twopoint, fit_function, args):
     combined_correlator = fitting_results[0] * np.exp(-fitting_results[1] * t) \
       + fitting_results[2] * np.exp(-fitting_results[3] * t)
 
-    return np.log(np.abs(combined_correlator / np.roll(combined_correlator, -1)))
+    return effmass.effmass(np.abs(combined_correlator))
 
 #def fit_all_correlators(twopoint, fit_range, )
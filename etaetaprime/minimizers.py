@@ -1,9 +1,43 @@
-import itertools
+import multiprocessing
 import numpy as np
-import IPython
+import scipy.optimize as spop
+import instrumentation
+
+def _grid_blocks(linspaces, block_size):
+    """Generates the points of the grid spanned by the supplied linspaces in
+    blocks of at most block_size points, in the same order as
+    itertools.product
+    
+    :param linspaces: The values of each parameter in the grid
+    :type linspaces: :class:`list` of :class:`numpy.ndarray`
+    :param block_size: The maximum number of points in each block
+    :type block_size: :class:`int`
+    :returns: generator of :class:`numpy.ndarray` shaped (n_points, n_params)
+    """
+    
+    shape = tuple(len(linspace) for linspace in linspaces)
+    num_points = int(np.prod(shape))
+    
+    for start in xrange(0, num_points, block_size):
+        indices = np.unravel_index(np.arange(start, min(start + block_size,
+                                                        num_points)), shape)
+        yield np.stack([linspace[index] for linspace, index
+                        in zip(linspaces, indices)], axis=-1)
+
+def _evaluate(function, points, args, vectorized):
+    """Evaluates the function at each row of points, treating NaNs as
+    infinitely bad"""
+    
+    if vectorized:
+        function_values = np.asarray(function(points, *args), dtype=np.float64)
+    else:
+        function_values = np.array([function(x, *args) for x in points],
+                                   dtype=np.float64)
+        
+    return np.where(np.isnan(function_values), np.inf, function_values)
 
 def grid_search(function, start_range, args=[], grid_points=10, tolerance=1e-6,
-                max_iterations=1000):
+                max_iterations=1000, vectorized=False, block_size=2**16):
     """Finds the minimimum value of the supplied function in the specified
     range
     
@@ -17,7 +51,11 @@ def grid_search(function, start_range, args=[], grid_points=10, tolerance=1e-6,
     :type tolerance: :class:`float`
     :param max_iterations: The maximum number of iterations
     :type max_iterations: :class:`int`
-    :returns: :class:`list`
+    :param vectorized: Whether the function accepts an array of parameters shaped (n_points, n_params) and returns all the values at once
+    :type vectorized: :class:`bool`
+    :param block_size: The number of grid points to generate and evaluate at a time
+    :type block_size: :class:`int`
+    :returns: :class:`tuple`
     """
     
     if type(start_range[0]) != list and type(start_range[0]) != tuple:
@@ -37,15 +75,20 @@ def grid_search(function, start_range, args=[], grid_points=10, tolerance=1e-6,
                      for r, g in zip(start_range, grid_points)]
         grid_step = [(x[1] - x[0]) / (y - 1)
                      for x, y in zip(start_range, grid_points)]
-        grid_values = list(itertools.product(*linspaces))
         old_parameters = new_parameters.copy()
-    
-        function_values = np.array(map(lambda x: function(x, *args),
-                                       grid_values))
         
-        new_minimum = function_values.min()
-        min_position = np.where(function_values == new_minimum)[0][0]
-        grid_value = grid_values[min_position]
+        new_minimum = np.inf
+        grid_value = None
+        
+        for points in _grid_blocks(linspaces, block_size):
+            function_values = _evaluate(function, points, args, vectorized)
+            instrumentation.count("nfev.grid_search", points.shape[0])
+            
+            min_position = np.argmin(function_values)
+            if grid_value is None or function_values[min_position] < new_minimum:
+                new_minimum = function_values[min_position]
+                grid_value = tuple(points[min_position])
+                
         new_parameters = np.array(grid_value)
         start_range = [[point - diff, point + diff]
                        for point, diff in zip(grid_value, grid_step)]
@@ -56,3 +99,254 @@ def grid_search(function, start_range, args=[], grid_points=10, tolerance=1e-6,
         print("Warning: max iterations reached.")
         
     return grid_value
+
+def _search_cell(cell):
+    """Evaluates the grid over a single cell, returning the best top_k points
+    found along with the curvature of the function along each axis at the
+    best point"""
+    
+    (function, args, vectorized, centre, widths, grid_points, top_k,
+     block_size) = cell
+    
+    linspaces = [np.linspace(c - w, c + w, g) if w > 0 else np.array([c])
+                 for c, w, g in zip(centre, widths, grid_points)]
+    steps = np.array([linspace[1] - linspace[0] if linspace.size > 1 else 0.0
+                      for linspace in linspaces])
+    
+    best_points = np.empty((0, len(centre)))
+    best_values = np.empty(0)
+    num_evaluations = 0
+    
+    for points in _grid_blocks(linspaces, block_size):
+        function_values = _evaluate(function, points, args, vectorized)
+        num_evaluations += points.shape[0]
+        
+        best_points = np.concatenate([best_points, points])
+        best_values = np.concatenate([best_values, function_values])
+        order = np.argsort(best_values, kind="mergesort")[:top_k]
+        best_points = best_points[order]
+        best_values = best_values[order]
+        
+    # Sample the neighbours of the best point along each axis to estimate
+    # the curvature there
+    offsets = np.diag(steps)
+    neighbours = np.concatenate([best_points[0] + offsets,
+                                 best_points[0] - offsets])
+    neighbour_values = _evaluate(function, neighbours, args, vectorized)
+    num_evaluations += neighbours.shape[0]
+    forward, backward = np.split(neighbour_values, 2)
+    
+    with np.errstate(divide="ignore", invalid="ignore"):
+        curvature = (forward + backward - 2 * best_values[0]) / steps**2
+        slope = (forward - backward) / (2 * steps)
+    curvature[steps == 0] = np.nan
+    slope[steps == 0] = np.nan
+    on_edge = (widths > 0) & np.isclose(np.abs(best_points[0] - centre),
+                                        widths)
+    
+    return (best_points, best_values, steps, curvature, slope, on_edge,
+            num_evaluations)
+
+def adaptive_grid_search(function, start_range, args=[], grid_points=10,
+                         top_k=4, tolerance=1e-6, objective_tolerance=1e-6,
+                         max_iterations=100, vectorized=False, workers=1,
+                         block_size=2**16, patience=3):
+    """Finds the minimum value of the supplied function in the specified range
+    by repeatedly refining grids around the best top_k candidates found so far.
+    Cells are recentred on their best point while it moves, and once it stops
+    moving their resolution shrinks according to the curvature observed about
+    it. A further cell extends each improvement of the best point in the same
+    direction, so that the search can follow valleys running across the axes.
+    The cells may be searched in parallel
+    
+    :param function: The function to minimize, which must be picklable if workers > 1
+    :type function: :class:`function`
+    :param start_range: Specification of the start and end range for each parameter
+    :type start_range: :class:`list` or :class:`tuple`
+    :param grid_points: Number of points to use in the grid for each parameter
+    :type grid_point: :class:`int` or :class:`list`
+    :param top_k: The number of candidate cells to refine in each iteration
+    :type top_k: :class:`int`
+    :param tolerance: The required relative tolerance in the parameters
+    :type tolerance: :class:`float`
+    :param objective_tolerance: The required relative tolerance in the function value
+    :type objective_tolerance: :class:`float`
+    :param max_iterations: The maximum number of iterations
+    :type max_iterations: :class:`int`
+    :param vectorized: Whether the function accepts an array of parameters shaped (n_points, n_params) and returns all the values at once
+    :type vectorized: :class:`bool`
+    :param workers: The number of processes to search the cells with
+    :type workers: :class:`int`
+    :param block_size: The number of grid points to generate and evaluate at a time
+    :type block_size: :class:`int`
+    :param patience: The number of iterations in a row that fail to improve the best value by more than the objective tolerance after which to stop
+    :type patience: :class:`int`
+    :returns: :class:`dict` containing the best parameters (x), the function value there (fun), the number of function evaluations (nfev), the number of iterations (nit), whether the tolerances were met (success) and a list describing each refinement (trace)
+    """
+    
+    if type(start_range[0]) != list and type(start_range[0]) != tuple:
+        start_range = [start_range]
+        
+    start_range = np.array(start_range, dtype=np.float64)
+    num_params = start_range.shape[0]
+    
+    if type(grid_points) != list:
+        grid_points = [grid_points for i in xrange(num_params)]
+    grid_points = np.array(grid_points)
+    
+    cells = [(start_range.mean(axis=1),
+              (start_range[:, 1] - start_range[:, 0]) / 2)]
+    
+    best_parameters = None
+    best_value = np.inf
+    num_evaluations = 0
+    trace = []
+    success = False
+    num_stalls = 0
+    
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    
+    try:
+        for iteration in xrange(max_iterations):
+            tasks = [(function, args, vectorized, centre, widths,
+                      np.where(widths > 0, grid_points, 1), top_k, block_size)
+                     for centre, widths in cells]
+            results = (pool.map(_search_cell, tasks) if pool is not None
+                       else map(_search_cell, tasks))
+            
+            points = np.concatenate([result[0] for result in results])
+            values = np.concatenate([result[1] for result in results])
+            origins = np.concatenate([np.repeat(i, result[1].size)
+                                      for i, result in enumerate(results)])
+            num_evaluations += sum(result[6] for result in results)
+            
+            # Keep the best top_k distinct candidates across all cells
+            order = np.argsort(values, kind="mergesort")
+            first = np.unique(points[order], axis=0, return_index=True)[1]
+            order = order[np.sort(first)][:top_k]
+            
+            old_value = best_value
+            old_parameters = best_parameters
+            if values[order[0]] <= best_value:
+                best_parameters = points[order[0]]
+                best_value = values[order[0]]
+            
+            new_cells = []
+            for i in order:
+                steps, curvature, slope = results[origins[i]][2:5]
+                on_edge = results[origins[i]][5]
+                centre, old_widths = tasks[origins[i]][3:5]
+                # Where the curvature is positive, the quadratic model about
+                # the best point locates the minimum to within a distance
+                # that can be smaller than a grid step
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    offset = np.abs(slope / curvature)
+                    widths = np.where((curvature > 0) & np.isfinite(offset),
+                                      np.clip(2 * offset, steps / 2, steps),
+                                      steps)
+                # While the best point is still moving the cell only halves,
+                # and where it lies on the edge of its cell the minimum may
+                # lie outside it, so the cell is recentred without shrinking
+                moved = np.abs(points[i] - centre) > steps
+                widths = np.where(moved, np.maximum(widths, old_widths / 2),
+                                  widths)
+                widths = np.where(on_edge, old_widths, widths)
+                scale = np.abs(points[i]) + tolerance
+                if (widths <= tolerance * scale).all():
+                    widths = np.zeros(num_params)
+                new_cells.append((points[i], widths))
+                
+            # Search as far again in the direction the best point last moved,
+            # as in the pattern move of Hooke and Jeeves
+            if old_parameters is not None and best_value < old_value:
+                step = best_parameters - old_parameters
+                new_cells.append((best_parameters + step,
+                                  np.maximum(new_cells[0][1],
+                                             np.abs(step) / 2)))
+            cells = new_cells
+            
+            trace.append({"iteration": iteration, "x": best_parameters,
+                          "fun": best_value, "nfev": num_evaluations,
+                          "num_cells": len(tasks), "widths": cells[0][1]})
+            
+            # Stop once the best cell has shrunk below the parameter
+            # tolerance, or once the best value has stalled, improving by no
+            # more than the objective tolerance for patience iterations
+            parameters_converged = (cells[0][1] == 0).all()
+            objective_scale = objective_tolerance * (np.abs(best_value)
+                                                     + objective_tolerance)
+            if old_value - best_value <= objective_scale:
+                num_stalls += 1
+            else:
+                num_stalls = 0
+            if parameters_converged or num_stalls >= patience:
+                success = True
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            
+    if not success:
+        print("Warning: max iterations reached.")
+        
+    instrumentation.count("nfev.adaptive_grid_search", num_evaluations)
+            
+    return {"x": best_parameters, "fun": best_value, "nfev": num_evaluations,
+            "nit": len(trace), "success": success, "trace": trace}
+
+def minimize_with_restarts(function, x0, args=(), method="Powell",
+                           max_restarts=20, tolerance=1e-6,
+                           objective_tolerance=1e-8, **kwargs):
+    """Minimizes the supplied function with scipy.optimize.minimize,
+    restarting the minimizer from its last result until the parameters and
+    function value stop changing between restarts
+    
+    :param function: The function to minimize
+    :type function: :class:`function`
+    :param x0: The initial parameters, or the result of a previous minimization to warm-start from
+    :type x0: :class:`list`, :class:`numpy.ndarray` or :class:`dict`
+    :param args: Additional arguments to pass to the function
+    :type args: :class:`tuple`
+    :param method: The scipy minimization method to use
+    :type method: :class:`str`
+    :param max_restarts: The maximum number of times to restart the minimizer
+    :type max_restarts: :class:`int`
+    :param tolerance: The required relative tolerance in the parameters between restarts
+    :type tolerance: :class:`float`
+    :param objective_tolerance: The required relative tolerance in the function value between restarts
+    :type objective_tolerance: :class:`float`
+    :returns: :class:`dict` containing the best parameters (x), the function value there (fun), the total number of function evaluations (nfev), the number of restarts used (restarts) and whether the tolerances were met (success)
+    """
+    
+    if isinstance(x0, dict):
+        x0 = x0["x"]
+    
+    result = spop.minimize(function, x0, args=args, method=method, **kwargs)
+    num_evaluations = result.nfev
+    success = bool(result.success) if max_restarts == 0 else False
+    restarts = 0
+    
+    while restarts < max_restarts:
+        new_result = spop.minimize(function, result.x, args=args,
+                                   method=method, **kwargs)
+        num_evaluations += new_result.nfev
+        restarts += 1
+        
+        parameters_converged \
+          = (np.abs(new_result.x - result.x)
+             <= tolerance * (np.abs(result.x) + tolerance)).all()
+        objective_converged = np.abs(new_result.fun - result.fun) \
+          <= objective_tolerance * (np.abs(result.fun) + objective_tolerance)
+          
+        if new_result.fun <= result.fun:
+            result = new_result
+            
+        if parameters_converged and objective_converged:
+            success = True
+            break
+        
+    instrumentation.count("nfev.minimize_with_restarts", num_evaluations)
+        
+    return {"x": np.atleast_1d(result.x), "fun": float(result.fun),
+            "nfev": num_evaluations, "restarts": restarts, "success": success}
@@ -0,0 +1,167 @@
+import numpy as np
+
+def jackknife_samples(data, block_size=1):
+    """Computes the leave-one-out, or leave-one-block-out, means of the
+    supplied data from the total sum, without looping over the samples.
+    Configurations beyond the last complete block are discarded.
+    
+    :param data: The data to resample, with configurations along the first axis
+    :type data: :class:`numpy.ndarray`
+    :param block_size: The number of consecutive configurations in each block
+    :type block_size: :class:`int`
+    :returns: :class:`numpy.ndarray` of the jackknife means, one per block
+    """
+    
+    data = np.asarray(data)
+    num_blocks = data.shape[0] // block_size
+    
+    if num_blocks < 2:
+        raise ValueError("Need at least two blocks of {} configurations, "
+                         "found {} configurations"
+                         .format(block_size, data.shape[0]))
+    
+    block_sums = data[:num_blocks * block_size] \
+      .reshape((num_blocks, block_size) + data.shape[1:]).sum(axis=1)
+    total = block_sums.sum(axis=0)
+    
+    return (total - block_sums) / float((num_blocks - 1) * block_size)
+
+def jackknife_error(samples):
+    """Computes the jackknife estimate of the standard error from the
+    supplied jackknife samples
+    
+    :param samples: The jackknife samples, with samples along the first axis
+    :type samples: :class:`numpy.ndarray`
+    :returns: :class:`numpy.ndarray`
+    """
+    
+    samples = np.asarray(samples)
+    num_samples = samples.shape[0]
+    deviations = samples - samples.mean(axis=0)
+    
+    return np.sqrt((num_samples - 1) / float(num_samples)
+                   * np.sum(np.abs(deviations)**2, axis=0))
+
+def jackknife_covariance(samples):
+    """Computes the jackknife estimate of the covariance matrix from the
+    supplied jackknife samples
+    
+    :param samples: The jackknife samples, shaped (n_samples, n)
+    :type samples: :class:`numpy.ndarray`
+    :returns: :class:`numpy.ndarray` shaped (n, n)
+    """
+    
+    samples = np.asarray(samples)
+    num_samples = samples.shape[0]
+    deviations = samples - samples.mean(axis=0)
+    
+    return (num_samples - 1) / float(num_samples) \
+      * np.dot(deviations.T, deviations.conj())
+
+def bootstrap_indices(num_configs, num_samples, seed=None):
+    """Draws the configuration indices for a set of bootstrap samples
+    
+    :param num_configs: The number of configurations in the ensemble
+    :type num_configs: :class:`int`
+    :param num_samples: The number of bootstrap samples
+    :type num_samples: :class:`int`
+    :param seed: The seed for the random number stream, making the samples reproducible
+    :type seed: :class:`int`
+    :returns: :class:`numpy.ndarray` of indices shaped (num_samples, num_configs)
+    """
+    
+    random_state = np.random.RandomState(seed)
+    
+    return random_state.randint(0, num_configs, (num_samples, num_configs))
+
+def bootstrap_samples(data, indices):
+    """Computes the bootstrap means of the supplied data for the supplied
+    index matrix. The indices are turned into counts of each configuration
+    per sample, so the means come from a single matrix product rather than
+    materialising every resampled ensemble
+    
+    :param data: The data to resample, with configurations along the first axis
+    :type data: :class:`numpy.ndarray`
+    :param indices: The indices returned by bootstrap_indices
+    :type indices: :class:`numpy.ndarray`
+    :returns: :class:`numpy.ndarray` of the bootstrap means, one per sample
+    """
+    
+    data = np.asarray(data)
+    indices = np.asarray(indices)
+    num_samples, sample_size = indices.shape
+    num_configs = data.shape[0]
+    
+    counts = np.zeros((num_samples, num_configs))
+    np.add.at(counts, (np.arange(num_samples)[:, np.newaxis], indices), 1)
+    
+    means = np.dot(counts, data.reshape((num_configs, -1))) / sample_size
+    
+    return means.reshape((num_samples,) + data.shape[1:])
+
+def bootstrap_error(samples):
+    """Computes the bootstrap estimate of the standard error from the
+    supplied bootstrap samples
+    
+    :param samples: The bootstrap samples, with samples along the first axis
+    :type samples: :class:`numpy.ndarray`
+    :returns: :class:`numpy.ndarray`
+    """
+    
+    return np.std(np.asarray(samples), axis=0, ddof=1)
+
+def jackknife(data, estimator=None, block_size=1):
+    """Applies the supplied estimator to the ensemble mean and to every
+    jackknife sample at once. The estimator must act on arrays with samples
+    along the first axis, such as an effective mass or a ratio of
+    correlators, so no loop over samples is needed.
+    
+    :param data: The data to resample, with configurations along the first axis
+    :type data: :class:`numpy.ndarray`
+    :param estimator: The function applied to the means, the identity if not given
+    :type estimator: :class:`function`
+    :param block_size: The number of consecutive configurations in each block
+    :type block_size: :class:`int`
+    :returns: :class:`tuple` of the central value, jackknife error and jackknife samples of the estimator
+    """
+    
+    if estimator is None:
+        estimator = lambda x: x
+        
+    data = np.asarray(data)
+    samples = estimator(jackknife_samples(data, block_size))
+    central = estimator(data.mean(axis=0)[np.newaxis])[0]
+    
+    return central, jackknife_error(samples), samples
+
+def bootstrap(data, estimator=None, num_samples=1000, seed=None,
+              indices=None):
+    """Applies the supplied estimator to the ensemble mean and to every
+    bootstrap sample at once. The estimator must act on arrays with samples
+    along the first axis.
+    
+    :param data: The data to resample, with configurations along the first axis
+    :type data: :class:`numpy.ndarray`
+    :param estimator: The function applied to the means, the identity if not given
+    :type estimator: :class:`function`
+    :param num_samples: The number of bootstrap samples
+    :type num_samples: :class:`int`
+    :param seed: The seed for the random number stream
+    :type seed: :class:`int`
+    :param indices: Previously drawn bootstrap indices, used in place of drawing new ones
+    :type indices: :class:`numpy.ndarray`
+    :returns: :class:`tuple` of the central value, bootstrap error and bootstrap samples of the estimator
+    """
+    
+    if estimator is None:
+        estimator = lambda x: x
+        
+    data = np.asarray(data)
+    
+    if indices is None:
+        indices = bootstrap_indices(data.shape[0], num_samples, seed)
+        
+    samples = estimator(bootstrap_samples(data, indices))
+    central = estimator(data.mean(axis=0)[np.newaxis])[0]
+    
+    return central, bootstrap_error(samples), samples
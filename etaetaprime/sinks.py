@@ -0,0 +1,141 @@
+import numpy as np
+import ensemble
+
+class NpySink(object):
+    """Saves the correlators for each configuration in a separate numpy
+    binary, as run_all does. Where run_one returns several trace orderings,
+    they are saved together in a .npz file, with the correlators stored
+    under keys such as "ll_ama" and "ls_sloppy"
+    
+    :param output_prefix: The common prefix used for the output data files
+    :type output_prefix: :class:`str`
+    """
+    
+    def __init__(self, output_prefix):
+        self.output_prefix = output_prefix
+        
+    def write(self, config, correlators):
+        """Saves the correlators for the supplied configuration"""
+        
+        filename = "{}{}".format(self.output_prefix, config)
+        
+        if isinstance(correlators, dict):
+            np.savez(filename, **dict(("{}_{}".format(order, quantity), value)
+                                      for order, values in correlators.items()
+                                      for quantity, value
+                                      in zip(ensemble.quantities, values)))
+        else:
+            np.save(filename, correlators)
+        
+    def close(self):
+        pass
+    
+class RunningStatistics(object):
+    """Accumulates the mean and covariance of a correlator over an ensemble
+    in constant memory, using Welford's algorithm
+    
+    The exact and sloppy restricted correlators of disconnected diagrams are
+    only defined on the exact timeslices, and are nan elsewhere. Each
+    timeslice, and each pair of timeslices in the covariance, is therefore
+    averaged over the configurations on which it is defined.
+    
+    :param num_timeslices: The temporal extent of the lattice
+    :type num_timeslices: :class:`int`
+    :param quantity: The correlator to accumulate, one of "ama", "exact", "sloppy_restricted" or "sloppy"
+    :type quantity: :class:`str`
+    """
+    
+    def __init__(self, num_timeslices, quantity="ama"):
+        
+        self.num_timeslices = num_timeslices
+        self.quantity = quantity
+        self.count = 0
+        # The number of configurations on which each timeslice is defined
+        self.counts = np.zeros(num_timeslices, dtype=np.int64)
+        self._mean = np.zeros(num_timeslices, dtype=np.complex)
+        # The covariance of timeslices t and t' is taken over the
+        # configurations on which both are defined, with the means of the
+        # two timeslices over those configurations
+        shape = (num_timeslices, num_timeslices)
+        self._pair_counts = np.zeros(shape, dtype=np.int64)
+        self._row_mean = np.zeros(shape, dtype=np.complex)
+        self._column_mean = np.zeros(shape, dtype=np.complex)
+        self._m2 = np.zeros(shape, dtype=np.complex)
+        
+    def write(self, config, correlators):
+        """Adds the correlators for the supplied configuration"""
+        
+        if isinstance(correlators, dict):
+            raise ValueError("RunningStatistics accumulates a single trace "
+                             "ordering, but configuration {} has the "
+                             "orderings {}".format(config,
+                                                   sorted(correlators)))
+        
+        values = ensemble.dense_correlators(correlators, self.num_timeslices)
+        value = values[ensemble.quantities.index(self.quantity)]
+        
+        defined = ~np.isnan(value)
+        value = np.where(defined, value, 0)
+        
+        self.count += 1
+        self.counts += defined
+        delta = np.where(defined, value - self._mean, 0)
+        self._mean += delta / np.maximum(self.counts, 1)
+        
+        both = np.outer(defined, defined)
+        self._pair_counts += both
+        pair_counts = np.maximum(self._pair_counts, 1)
+        
+        row_delta = np.where(both, value[:, None] - self._row_mean, 0)
+        self._row_mean += row_delta / pair_counts
+        self._column_mean += np.where(both, value[None, :]
+                                      - self._column_mean, 0) / pair_counts
+        self._m2 += row_delta * np.where(both, np.conj(value[None, :]
+                                                       - self._column_mean), 0)
+        
+    def close(self):
+        pass
+        
+    @property
+    def mean(self):
+        """The mean of the correlator, nan on timeslices never defined"""
+        return np.where(self.counts > 0, self._mean, np.nan)
+    
+    @property
+    def covariance(self):
+        """The sample covariance of the correlator, nan where fewer than two
+        configurations define both timeslices"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self._pair_counts > 1,
+                            self._m2 / (self._pair_counts - 1), np.nan)
+    
+    @property
+    def error(self):
+        """The standard error in the mean of the correlator"""
+        return np.sqrt(np.diag(self.covariance).real / self.counts)
+        
+def consume(results, sinks):
+    """Passes each of the supplied (configuration, correlators) results, such
+    as those yielded by iter_ama, to all of the supplied sinks. A sink may be
+    any object with write(config, correlators) and close() methods, such as
+    an ensemble store
+    
+    :param results: The configurations and their correlators
+    :type results: iterable of :class:`tuple`
+    :param sinks: The sinks to write the results to
+    :type sinks: :class:`list`
+    :returns: :class:`int` giving the number of configurations consumed
+    """
+    
+    count = 0
+    
+    try:
+        for config, correlators in results:
+            for sink in sinks:
+                sink.write(config, correlators)
+            count += 1
+    finally:
+        for sink in sinks:
+            sink.close()
+            
+    return count
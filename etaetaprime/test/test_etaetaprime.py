@@ -1,12 +1,30 @@
 import sys, os
+import bz2
+import gzip
+import json
 import itertools
 import numpy as np
 import numpy.random as npr
 sys.path.insert(0, os.path.abspath('../..'))
 
 import etaetaprime
+from etaetaprime import ama
 from etaetaprime import fileio
 from etaetaprime import correlators
+from etaetaprime import cache
+from etaetaprime import ensemble
+from etaetaprime import manifest
+from etaetaprime import sinks
+from etaetaprime import resampling
+from etaetaprime import fitting
+from etaetaprime import effmass
+from etaetaprime import gevp
+from etaetaprime import instrumentation
+from etaetaprime import measurements
+from etaetaprime import minimizers
+from etaetaprime import fastfunctions
+from etaetaprime.fastfunctions import numpy_converters
+from etaetaprime.fastfunctions import numpy_combinatorics
 
 data_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data')
 
@@ -37,6 +55,116 @@ class TestFileIO:
         for i, j in itertools.product(range(nrows), range(ncols)):
             assert numpy_array[i, j] == input_list[i][j]
                 
+    def test_numpy_converter(self):
+
+        input_list = npr.rand(7, 3).tolist()
+
+        assert (numpy_converters.toarr(input_list)
+                == fileio.converters.toarr(input_list)).all()
+
+    def test_parse_columns(self):
+
+        filename = "{}/connected_test_data".format(data_dir)
+        expected = np.array(fileio.file_to_list(filename))
+
+        for chunk_size in [10, 1000, 2**20]:
+            data = fileio.parse_columns(filename, 4, chunk_size)
+
+            assert data.shape == (9216, 4)
+            assert (data == expected).all()
+
+        assert (fileio.parse_columns(filename) == expected).all()
+
+    def test_parse_columns_ragged(self, tmpdir):
+
+        filename = str(tmpdir.join("data"))
+
+        with open(filename, "w") as f:
+            f.write("1 2 3\n\n4 5 6\n7 8 9")
+        assert (fileio.parse_columns(filename)
+                == np.arange(1, 10).reshape(3, 3)).all()
+
+        # The values make whole rows, but the lines are ragged, including
+        # where a blank line would make up the count of lines
+        for contents, num_columns in [("1 2 3\n4 5\n6\n", 3),
+                                      ("1 2\n3 4 5 6\n\n", 2),
+                                      ("1 2 3\n4\n", 2)]:
+            with open(filename, "w") as f:
+                f.write(contents)
+            try:
+                fileio.parse_columns(filename, num_columns)
+            except ValueError:
+                pass
+            else:
+                assert False
+
+    def test_parse_compressed(self, tmpdir):
+
+        filename = "{}/connected_test_data".format(data_dir)
+        expected = fileio.parse_columns(filename)
+        with open(filename, "rb") as f:
+            contents = f.read()
+
+        assert fileio.compression(filename) is None
+
+        for kind, module in [("gzip", gzip), ("bz2", bz2)]:
+            compressed = str(tmpdir.join("data." + kind))
+            if kind == "gzip":
+                with gzip.GzipFile(compressed, "wb") as f:
+                    f.write(contents)
+            else:
+                with open(compressed, "wb") as f:
+                    f.write(bz2.compress(contents))
+
+            assert fileio.compression(compressed) == kind
+            for chunk_size in [1000, 2**20]:
+                data = fileio.parse_columns(compressed, 4, chunk_size)
+                assert (data == expected).all()
+                # Hashing the file as it's parsed hashes the compressed bytes
+                with fileio.recording() as fingerprints:
+                    data = fileio.parse_columns(compressed, 4, chunk_size)
+                assert (data == expected).all()
+                assert fingerprints.values() == [fileio.fingerprint(compressed)]
+            assert fileio.file_to_list(compressed)[:5] \
+              == expected[:5].tolist()
+
+            # Corrupt or truncated files mustn't be taken for missing ones
+            with open(compressed, "rb") as f:
+                data = f.read()
+            for damaged in [data[:len(data) // 2],
+                            data[:-12] + b"\0" * 8 + data[-4:]]:
+                with open(compressed, "wb") as f:
+                    f.write(damaged)
+                for parse in [fileio.parse_columns, fileio.file_to_list]:
+                    try:
+                        parse(compressed)
+                    except ValueError:
+                        pass
+                    else:
+                        assert False
+                try:
+                    with fileio.recording():
+                        fileio.parse_columns(compressed)
+                except ValueError:
+                    pass
+                else:
+                    assert False
+
+        compressed = str(tmpdir.join("data.xz"))
+        if fileio.lzma is None:
+            with open(compressed, "wb") as f:
+                f.write(b"\xfd7zXZ\x00")
+            try:
+                fileio.load_data(compressed)
+            except ImportError:
+                pass
+            else:
+                assert False
+        else:
+            with open(compressed, "wb") as f:
+                f.write(fileio.lzma.compress(contents))
+            assert (fileio.load_data(compressed) == expected).all()
+
     def test_load_data(self):
         
         data = fileio.load_data("{}/connected_test_data".format(data_dir))
@@ -74,6 +202,187 @@ class TestFileIO:
         assert (split[2] == np.array([2 + 3j, 2 - 1j])).all()
         assert (split[3] == random).all()
         
+class TestCache:
+
+    def test_file_cache(self, tmpdir, monkeypatch):
+
+        filename = str(tmpdir.join("traces"))
+        data = npr.rand(96, 5)
+        np.savetxt(filename, data)
+
+        file_cache = cache.FileCache(str(tmpdir.join("cache")))
+
+        first = fileio.load_traces(filename, file_cache)
+        second = fileio.load_traces(filename, file_cache)
+
+        assert isinstance(second, np.memmap)
+        assert (first == fileio.load_traces(filename)).all()
+        assert (second == first).all()
+
+        # Touching the file shouldn't invalidate the cached traces, but the
+        # new modification time is recorded
+        os.utime(filename, (0, 0))
+        touched = fileio.load_traces(filename, file_cache)
+
+        assert isinstance(touched, np.memmap)
+        meta_path = file_cache._paths(filename, fileio.load_traces)[1]
+        with open(meta_path) as f:
+            assert json.load(f) == fileio.fingerprint(filename)
+
+        # Changing the file should invalidate the cached traces, even if the
+        # size and modification time stay the same
+        with open(filename) as f:
+            contents = f.read()
+        with open(filename, "w") as f:
+            f.write(contents.replace("1", "2").replace("e-", "e+"))
+        os.utime(filename, (0, 0))
+        third = fileio.load_traces(filename, file_cache)
+
+        assert not isinstance(third, np.memmap)
+        assert (third == fileio.load_traces(filename)).all()
+        assert not (third == first).all()
+
+        # A file of another size is parsed without being read again to hash
+        # it, and the replaced entry no longer counts towards the size of the
+        # cache
+        np.savetxt(filename, 2 * data[:50])
+        monkeypatch.setattr(fileio, "fingerprint", None)
+        fourth = fileio.load_traces(filename, file_cache)
+        monkeypatch.undo()
+
+        assert np.allclose(fourth[:, 1:].real, 2 * first[:50, 1:].real)
+        assert isinstance(fileio.load_traces(filename, file_cache), np.memmap)
+        assert file_cache._size == file_cache.size()
+
+        # Shrinking the cache should evict the oldest entry
+        correlators = str(tmpdir.join("correlators"))
+        np.savetxt(correlators, npr.rand(96, 4))
+        fileio.load_correlators(correlators, file_cache)
+        file_cache.max_size = file_cache.size() - 1
+        file_cache.evict()
+
+        assert len(tmpdir.join("cache").listdir()) == 2
+
+class TestEnsemble:
+
+    def test_dense_correlators(self):
+
+        sloppy_restricted = np.array([[0, 4, 8], npr.rand(3)])
+        correlators = [npr.rand(10), npr.rand(3), sloppy_restricted,
+                       npr.rand(10)]
+
+        dense = ensemble.dense_correlators(correlators, 10)
+
+        assert dense.shape == (4, 10)
+        assert (dense[0] == correlators[0]).all()
+        assert (dense[1, [0, 4, 8]] == correlators[1]).all()
+        assert (dense[2, [0, 4, 8]] == sloppy_restricted[1]).all()
+        assert np.isnan(dense[1:3, 1]).all()
+
+        # Three point functions don't fit the two point layout
+        try:
+            ensemble.dense_correlators(npr.rand(4, 5, 2, 10), 10)
+        except ValueError:
+            pass
+        else:
+            assert False
+
+    def test_ensemble_store(self, tmpdir):
+
+        path = str(tmpdir.join("store"))
+        store = ensemble.EnsembleStore.create(path, [0, 2], 10, order="ls",
+                                              num_sources=3)
+
+        results = dict((i, [npr.rand(10) for j in range(4)])
+                       for i in [0, 2, 4])
+        for i in [2, 0, 4]:
+            store.write(i, results[i])
+        store.flush()
+
+        store = ensemble.EnsembleStore(path)
+
+        assert len(store) == 3
+        assert (store.configs == [0, 2, 4]).all()
+        assert store.filled.all()
+        assert store.attributes["order"] == "ls"
+        assert store.attributes["num_sources"] == 3
+        assert isinstance(store["ama"], np.memmap)
+        assert store["ama"].shape == (3, 10)
+
+        for i in [0, 2, 4]:
+            for j, quantity in enumerate(ensemble.quantities):
+                assert (store[quantity][store.index(i)] == results[i][j]).all()
+
+        # Growing the store writes new files over the old ones, leaving the
+        # arrays already mapped intact
+        store = ensemble.EnsembleStore(path, "r+")
+        mapped = store["ama"]
+        before = np.array(mapped)
+        for i in range(6, 20, 2):
+            results[i] = [npr.rand(10) for j in range(4)]
+            store.write(i, results[i])
+        store.flush()
+
+        assert (mapped == before).all()
+        assert not [name for name in os.listdir(path) if ".tmp" in name]
+
+        store = ensemble.EnsembleStore(path)
+
+        assert (store.configs == sorted(results)).all()
+        assert store.filled.all()
+        for i in results:
+            for j, quantity in enumerate(ensemble.quantities):
+                assert (store[quantity][store.index(i)] == results[i][j]).all()
+
+        # A store can't hold three point functions, which run_all rejects
+        # before processing any configurations
+        try:
+            correlators.run_all("exact", "sloppy", "prefix", "", 0, 4, 2,
+                                store=ensemble.EnsembleStore(path, "r+"),
+                                function=ama.run3pt,
+                                function_args=(10, 2, 3))
+        except ValueError:
+            pass
+        else:
+            assert False
+
+    def test_running_statistics(self):
+
+        T = 10
+
+        # The exact correlator is only defined on the exact timeslices,
+        # which differ between configurations
+        exact = np.full((4, T), np.nan)
+        results = []
+        for i, timeslices in enumerate([[0, 4, 8], [0, 4], [0, 4, 8],
+                                        [0, 8]]):
+            values = npr.rand(len(timeslices))
+            exact[i, timeslices] = values
+            results.append([npr.rand(T), values,
+                            np.array([timeslices, npr.rand(len(timeslices))]),
+                            npr.rand(T)])
+
+        statistics = sinks.RunningStatistics(T, "exact")
+        sinks.consume(enumerate(results), [statistics])
+
+        assert (statistics.counts[[0, 4, 8]] == [4, 3, 3]).all()
+        assert np.allclose(statistics.mean[[0, 4, 8]],
+                           np.nanmean(exact[:, [0, 4, 8]], axis=0))
+        assert np.isnan(statistics.mean[1])
+        assert np.isclose(statistics.covariance[0, 4],
+                          np.cov(exact[:3, [0, 4]], rowvar=False)[0, 1])
+        assert np.isclose(statistics.covariance[4, 8],
+                          np.cov(exact[[0, 2], :][:, [4, 8]],
+                                 rowvar=False)[0, 1])
+
+        # Several trace orderings can't be accumulated together
+        try:
+            statistics.write(4, {"ll": results[0], "ls": results[1]})
+        except ValueError:
+            pass
+        else:
+            assert False
+
 class TestCorrelators:
 
     def test_cython_diff(self):
@@ -109,6 +418,41 @@ class TestCorrelators:
                           - (prods[i, 0] + prods[(i + 2) % 4, 1]) / 2) \
                           < tolerance
         
+    def test_bin_prods(self):
+
+        T = 12
+
+        a = npr.rand(5) + 1j * npr.rand(5)
+        b = npr.rand(7) + 1j * npr.rand(7)
+        ta = npr.choice(T, 5, replace=False)
+        tb = npr.choice(T, 7, replace=False)
+
+        diffs = (ta[:, np.newaxis] - tb) % T
+        prods = np.outer(a, b)
+        timeslices = np.unique(diffs)
+        expected = correlators.combinatorics.av_prods(timeslices, diffs, prods)
+
+        for module in [correlators.combinatorics, numpy_combinatorics]:
+            sums, frequency = module.bin_prods(a, b, ta, tb, T)
+
+            assert frequency.sum() == 35
+            assert (frequency.nonzero()[0] == timeslices).all()
+            assert np.allclose(sums[timeslices] / frequency[timeslices],
+                               expected)
+
+        assert (numpy_combinatorics.diff(ta, tb, T) == diffs).all()
+        assert np.allclose(numpy_combinatorics.av_prods(timeslices, diffs,
+                                                        prods), expected)
+
+        # Repeated timeslices should accumulate, as in the outer product
+        ta = np.array([0, 3, 3, 11, 14])
+        sums, frequency = numpy_combinatorics.bin_prods(a, b, ta, tb, T)
+        diffs = (ta[:, np.newaxis] - tb) % T
+        assert (frequency == np.bincount(diffs.ravel(), minlength=T)).all()
+        expected = np.bincount(diffs.ravel(), prods.real.ravel(), T) \
+          + 1j * np.bincount(diffs.ravel(), prods.imag.ravel(), T)
+        assert np.allclose(sums, expected)
+
     def test_combine_traces(self):
 
         T = 96
@@ -136,6 +480,28 @@ class TestCorrelators:
         assert (np.abs(combined_trace[1].real - expected_trace)
                 < tolerance).all()
 
+    def test_combine_traces_fft(self):
+
+        T = 96
+
+        trace1 = npr.rand(T) + 1j * npr.rand(T)
+        trace2 = npr.rand(T) + 1j * npr.rand(T)
+        timeslices1 = np.sort(npr.choice(T, 7, replace=False))
+        timeslices2 = np.sort(npr.choice(T, 11, replace=False))
+
+        for args in [(trace1, trace2, np.arange(T), np.arange(T)),
+                     (trace1[timeslices1], trace2, timeslices1, np.arange(T)),
+                     (trace1[timeslices1], trace2[timeslices2],
+                      timeslices1, timeslices2)]:
+            direct = correlators.combine_traces(*args, num_timeslices=T,
+                                                method="direct")
+            fft = correlators.combine_traces(*args, num_timeslices=T,
+                                             method="fft")
+
+            assert fft.shape == direct.shape
+            assert (fft[0] == direct[0]).all()
+            assert np.allclose(fft[1], direct[1], rtol=1e-10, atol=1e-12)
+
     def test_ama(self):
         
         a = npr.rand(10)
@@ -205,3 +571,999 @@ class TestCorrelators:
         assert disconnected_correlators[0].size == 10
         assert disconnected_correlators[1].size == 20
         assert disconnected_correlators[2].size == 10
+
+    def test_parse_disconnected_baseline(self):
+
+        T = 12
+
+        def combine_traces(first_trace, second_trace, first_timeslices,
+                           second_timeslices):
+            # The original outer product method, which only reads as many
+            # trace values as there are timeslices
+            diffs = (first_timeslices[:, np.newaxis]
+                     - second_timeslices[np.newaxis, :]) % T
+            prods = np.outer(first_trace, second_trace)[:, :diffs.shape[1]]
+            timeslices = np.unique(diffs)
+            return np.array([timeslices,
+                             [prods[diffs == t].mean() for t in timeslices]])
+
+        def parse_disconnected(exact_data, sloppy_data, order):
+            # The original pairing of the traces in each ordering
+            sloppy_l, sloppy_s = sloppy_data[:, 1], sloppy_data[:, 2]
+            exact_t_l, exact_t_s, exact_l, exact_s \
+              = fileio.split_traces(exact_data)
+            sloppy_t = np.arange(T)
+            first = {"ll": "l", "ss": "s", "ls": "l"}[order]
+            exact_first, exact_t_first, sloppy_first \
+              = {"l": (exact_l, exact_t_l, sloppy_l),
+                 "s": (exact_s, exact_t_s, sloppy_s)}[first]
+            if order == "ll":
+                second_restricted = sloppy_l[exact_t_l]
+                exact_second, exact_t_second, sloppy_second \
+                  = exact_l, exact_t_l, sloppy_l
+            else:
+                second_restricted = sloppy_s
+                exact_second, exact_t_second, sloppy_second \
+                  = exact_s, exact_t_s, sloppy_s
+            return (combine_traces(exact_first, exact_second, exact_t_first,
+                                   exact_t_second)[1],
+                    combine_traces(sloppy_first[exact_t_first],
+                                   second_restricted, exact_t_first,
+                                   exact_t_second),
+                    combine_traces(sloppy_first, sloppy_second, sloppy_t,
+                                   sloppy_t)[1])
+
+        # Neither exact trace covers every timeslice
+        exact_data = np.zeros((T, 3))
+        exact_data[:, 0] = np.arange(T)
+        exact_data[[1, 4, 5, 9], 1] = npr.rand(4)
+        exact_data[[0, 3, 7], 2] = npr.rand(3)
+        sloppy_data = np.zeros((T, 3))
+        sloppy_data[:, 0] = np.arange(T)
+        sloppy_data[:, 1:3] = npr.rand(T, 2)
+
+        for order in ["ll", "ss", "ls"]:
+            expected = parse_disconnected(exact_data, sloppy_data, order)
+            for method in ["fft", "direct"]:
+                result = correlators.parse_disconnected(exact_data,
+                                                        sloppy_data, T,
+                                                        order, method)
+                assert np.allclose(result[0], expected[0])
+                assert np.allclose(result[1], expected[1])
+                assert np.allclose(result[2], expected[2])
+
+            results = correlators.parse_disconnected(exact_data, sloppy_data,
+                                                     T, [order, "ll"])
+            assert np.allclose(results[order][1], expected[1])
+
+    def test_parse_disconnected_batch(self):
+
+        T = 10
+        num_configs = 4
+
+        exact_data = np.zeros((num_configs, T, 3))
+        sloppy_data = np.zeros((num_configs, T, 3))
+        exact_data[:, :, 0] = np.arange(T)
+        sloppy_data[:, :, 0] = np.arange(T)
+        sloppy_data[:, :, 1:3] = npr.rand(num_configs, T, 2)
+        for i in range(num_configs):
+            exact_sources = npr.choice(T, 3, replace=False)
+            exact_data[i, exact_sources, 1] = npr.rand(3)
+            # Only some configurations have exact strange traces on every
+            # timeslice
+            exact_sources = npr.choice(T, T if i % 2 else 4, replace=False)
+            exact_data[i, exact_sources, 2] = npr.rand(exact_sources.size)
+
+        for order in ["ll", "ss", "ls"]:
+            results = correlators.parse_disconnected_batch(exact_data,
+                                                           sloppy_data,
+                                                           order)
+
+            assert len(results) == 4
+
+            for i in range(num_configs):
+                expected = correlators.parse_disconnected(exact_data[i],
+                                                          sloppy_data[i],
+                                                          T, order)
+                timeslices = np.int64(expected[1][0].real)
+
+                assert (results[0][i] == correlators.ama(*expected)).all()
+                assert (results[1][i, timeslices] == expected[0]).all()
+                assert (results[2][i, timeslices] == expected[1][1]).all()
+                assert (results[3][i] == expected[2]).all()
+
+    def test_run_all(self, tmpdir):
+
+        T = 16
+
+        for folder in ["exact", "sloppy"]:
+            tmpdir.mkdir(folder)
+
+        for i in [0, 2, 6]:
+            exact_data = np.zeros((T, 5))
+            exact_data[:, 0] = np.arange(T)
+            exact_data[::4, 1:3] = npr.rand(T // 4, 2)
+            exact_data[:, 3:5] = npr.rand(T, 2)
+            sloppy_data = np.zeros((T, 5))
+            sloppy_data[:, 0] = np.arange(T)
+            sloppy_data[:, 1:5] = npr.rand(T, 4)
+
+            np.savetxt(str(tmpdir.join("exact", "traces.{}".format(i))),
+                       exact_data)
+            np.savetxt(str(tmpdir.join("sloppy", "traces.{}".format(i))),
+                       sloppy_data)
+
+        for workers in [1, 2]:
+            output_prefix = str(tmpdir.join("out{}_".format(workers)))
+            skipped = correlators.run_all(str(tmpdir.join("exact")),
+                                          str(tmpdir.join("sloppy")),
+                                          "traces", output_prefix, 0, 8, 2,
+                                          num_timeslices=T, workers=workers)
+
+            assert skipped == [4, 8]
+
+        store = ensemble.EnsembleStore.create(str(tmpdir.join("store")),
+                                              range(0, 10, 2), T)
+        correlators.run_all(str(tmpdir.join("exact")),
+                            str(tmpdir.join("sloppy")), "traces", None,
+                            0, 8, 2, num_timeslices=T, store=store)
+
+        assert (store.filled == [True, True, False, True, False]).all()
+        # The store records how its results were computed, and appending
+        # results computed another way is refused
+        store = ensemble.EnsembleStore(str(tmpdir.join("store")), "r+")
+        assert store.attributes["num_timeslices"] == T
+        assert store.attributes["order"] == "ls"
+        assert store.attributes["connected"] is False
+        correlators.run_all(str(tmpdir.join("exact")),
+                            str(tmpdir.join("sloppy")), "traces", None,
+                            0, 8, 2, num_timeslices=T, store=store,
+                            num_sources={"exact": 2, "sloppy": T})
+        assert ensemble.EnsembleStore(str(tmpdir.join("store")))\
+          .attributes["num_sources"] == {"exact": 2, "sloppy": T}
+        for kwargs in [{"order": "ll"}, {"num_timeslices": 2 * T},
+                       {"num_sources": {"exact": 3, "sloppy": T}}]:
+            kwargs = dict({"num_timeslices": T}, **kwargs)
+            try:
+                correlators.run_all(str(tmpdir.join("exact")),
+                                    str(tmpdir.join("sloppy")), "traces",
+                                    None, 0, 8, 2, store=store, **kwargs)
+            except ValueError:
+                pass
+            else:
+                assert False
+
+        for i in [0, 2, 6]:
+            serial = np.load(str(tmpdir.join("out1_{}.npy".format(i))),
+                             allow_pickle=True)
+            parallel = np.load(str(tmpdir.join("out2_{}.npy".format(i))),
+                               allow_pickle=True)
+
+            for x, y in zip(serial, parallel):
+                assert (x == y).all()
+
+            assert (store["ama"][store.index(i)] == serial[0]).all()
+
+    def test_run_all_incremental(self, tmpdir, monkeypatch):
+
+        T = 8
+
+        for folder in ["exact", "sloppy"]:
+            tmpdir.mkdir(folder)
+            for i in range(3):
+                data = np.zeros((T, 5))
+                data[:, 0] = np.arange(T)
+                data[:, 1:5] = npr.rand(T, 4)
+                np.savetxt(str(tmpdir.join(folder, "traces.{}".format(i))),
+                           data)
+
+        output_prefix = str(tmpdir.join("out_"))
+        outputs = [tmpdir.join("out_{}.npy".format(i)) for i in range(3)]
+        run_manifest = manifest.Manifest(str(tmpdir.join("manifest")))
+
+        def run(order="ls"):
+            for output in outputs:
+                if output.exists():
+                    output.setmtime(0)
+            correlators.run_all(str(tmpdir.join("exact")),
+                                str(tmpdir.join("sloppy")), "traces",
+                                output_prefix, 0, 2, 1, num_timeslices=T,
+                                order=order, manifest=run_manifest)
+            return [output.mtime() > 0 for output in outputs]
+
+        # The inputs are hashed from the bytes read to process them
+        monkeypatch.setattr(fileio, "fingerprint", None)
+        assert run() == [True, True, True]
+        monkeypatch.undo()
+        assert run() == [False, False, False]
+
+        # Touching an input doesn't reprocess the config, and the new
+        # modification time is recorded so the input isn't hashed again
+        tmpdir.join("exact", "traces.0").setmtime(0)
+        assert run() == [False, False, False]
+        assert run_manifest.entries[0]["inputs"][0] \
+          == fileio.fingerprint(str(tmpdir.join("exact", "traces.0")))
+        monkeypatch.setattr(fileio, "fingerprint", None)
+        assert run() == [False, False, False]
+        monkeypatch.undo()
+
+        # Changing an input or removing an output reprocesses the config
+        data = np.loadtxt(str(tmpdir.join("sloppy", "traces.1")))
+        data[:, 1:5] *= 2
+        np.savetxt(str(tmpdir.join("sloppy", "traces.1")), data)
+        outputs[2].remove()
+
+        assert run() == [False, True, True]
+
+        # A manifest read back from disk resumes from the same point
+        run_manifest = manifest.Manifest(str(tmpdir.join("manifest")))
+
+        assert run() == [False, False, False]
+        assert run("ll") == [True, True, True]
+
+    def test_iter_ama(self, tmpdir):
+
+        T = 8
+
+        for folder in ["exact", "sloppy"]:
+            tmpdir.mkdir(folder)
+            for i in [0, 1, 3]:
+                data = np.zeros((T, 5))
+                data[:, 0] = np.arange(T)
+                data[:, 1:5] = npr.rand(T, 4)
+                np.savetxt(str(tmpdir.join(folder, "traces.{}".format(i))),
+                           data)
+
+        args = (str(tmpdir.join("exact")), str(tmpdir.join("sloppy")),
+                "traces", range(4))
+        expected = [(i, correlators.run_one(str(tmpdir.join("exact",
+                                                           "traces.{}"
+                                                           .format(i))),
+                                            str(tmpdir.join("sloppy",
+                                                            "traces.{}"
+                                                            .format(i))),
+                                            T))
+                    for i in [0, 1, 3]]
+
+        for kwargs in [{}, {"read_ahead": 1}, {"workers": 2},
+                       {"workers": 2, "read_ahead": 2}]:
+            skipped = []
+            results = list(correlators.iter_ama(*args, num_timeslices=T,
+                                                skipped=skipped, **kwargs))
+
+            assert skipped == [2]
+            assert [result[0] for result in results] == [0, 1, 3]
+            for result, expected_result in zip(results, expected):
+                for x, y in zip(result[1], expected_result[1]):
+                    assert (x == y).all()
+
+        statistics = sinks.RunningStatistics(T)
+        num_configs = sinks.consume(correlators.iter_ama(*args,
+                                                         num_timeslices=T),
+                                    [statistics])
+        ama_correlators = np.array([result[1][0] for result in expected])
+
+        assert num_configs == 3
+        assert np.allclose(statistics.mean, ama_correlators.mean(axis=0))
+        assert np.allclose(statistics.covariance,
+                           np.cov(ama_correlators, rowvar=False))
+
+    def test_parse_disconnected_orders(self):
+
+        T = 12
+
+        exact_data = np.zeros((T, 3))
+        exact_data[:, 0] = np.arange(T)
+        exact_data[::4, 1:3] = npr.rand(T // 4, 2)
+        sloppy_data = np.zeros((T, 3))
+        sloppy_data[:, 0] = np.arange(T)
+        sloppy_data[:, 1:3] = npr.rand(T, 2)
+
+        for method in ["fft", "direct"]:
+            results = correlators.parse_disconnected(exact_data, sloppy_data,
+                                                     T, ["ll", "ss", "ls"],
+                                                     method)
+            assert list(results) == ["ll", "ss", "ls"]
+
+            for order, result in results.items():
+                expected = correlators.parse_disconnected(exact_data,
+                                                          sloppy_data, T,
+                                                          order, method)
+                for x, y in zip(result, expected):
+                    assert (x == y).all()
+
+    def test_run_all_orders(self, tmpdir):
+
+        T = 16
+
+        for folder in ["exact", "sloppy"]:
+            tmpdir.mkdir(folder)
+            for i in range(2):
+                data = np.zeros((T, 5))
+                data[:, 0] = np.arange(T)
+                data[::4 if folder == "exact" else 1, 1:5] \
+                  = npr.rand(T // 4 if folder == "exact" else T, 4)
+                np.savetxt(str(tmpdir.join(folder, "traces.{}".format(i))),
+                           data)
+
+        args = (str(tmpdir.join("exact")), str(tmpdir.join("sloppy")),
+                "traces")
+        correlators.run_all(*(args + (str(tmpdir.join("all_")), 0, 1, 1)),
+                            num_timeslices=T, order=["ll", "ss", "ls"])
+
+        for order in ["ll", "ss", "ls"]:
+            correlators.run_all(*(args + (str(tmpdir.join(order + "_")),
+                                          0, 1, 1)),
+                                num_timeslices=T, order=order)
+
+            for i in range(2):
+                results = np.load(str(tmpdir.join("all_{}.npz".format(i))))
+                expected = np.load(str(tmpdir.join("{}_{}.npy"
+                                                   .format(order, i))),
+                                   allow_pickle=True)
+
+                for quantity, value in zip(ensemble.quantities, expected):
+                    assert (results["{}_{}".format(order, quantity)]
+                            == value).all()
+
+        store = ensemble.EnsembleStore.create(str(tmpdir.join("store")),
+                                              range(2), T)
+        try:
+            correlators.run_all(*(args + (None, 0, 1, 1)), num_timeslices=T,
+                                order=["ll", "ls"], store=store)
+        except ValueError:
+            pass
+        else:
+            assert False
+
+class TestAma:
+
+    def test_read3pt(self):
+
+        T = 6
+        separations = [3, 1]
+        num_src = 2
+
+        exact_data = np.zeros((len(separations) * num_src * T, 13))
+        sloppy_data = np.zeros((max(separations) + 1, T, T, 13))
+        sloppy_data[:, :, :, 0] = np.arange(max(separations) + 1)[:, None, None]
+        sloppy_data[:, :, :, 1] = np.arange(T)[:, None]
+        sloppy_data[:, :, :, 2] = np.arange(T)
+        sloppy_data[:, :, :, 3:] = npr.rand(max(separations) + 1, T, T, 10)
+        sloppy_values = sloppy_data[:, :, :, 3::2] \
+          + 1j * sloppy_data[:, :, :, 4::2]
+
+        expected = np.zeros((4, 5, len(separations), T), dtype=np.complex)
+
+        for i, separation in enumerate(separations):
+            sinks = npr.choice(T, num_src, replace=False)
+            for j, sink in enumerate(sinks):
+                block = exact_data[(i * num_src + j) * T:
+                                   (i * num_src + j + 1) * T]
+                block[:, 0] = separation
+                block[:, 1] = sink
+                block[:, 2] = np.arange(T)
+                block[:, 3:] = npr.rand(T, 10)
+                values = (block[:, 3::2] + 1j * block[:, 4::2]).T
+
+                expected[0, :, i] += values / num_src
+                expected[2, :, i] += (values - sloppy_values[separation,
+                                                             sink].T) / num_src
+
+            expected[1, :, i] = sloppy_values[separation].mean(axis=0).T
+
+        expected[3] = expected[1] + expected[2]
+
+        averages, output_separations \
+          = ama.read3pt(exact_data, sloppy_data.reshape((-1, 13)), T,
+                        len(separations), num_src, return_separations=True)
+
+        assert averages.shape == (4, 5, len(separations), T)
+        assert (output_separations == separations).all()
+        assert np.allclose(averages, expected)
+
+class TestResampling:
+
+    def test_jackknife(self):
+
+        data = npr.rand(12, 5)
+
+        for block_size in [1, 3]:
+            samples = resampling.jackknife_samples(data, block_size)
+            num_blocks = 12 // block_size
+
+            assert samples.shape == (num_blocks, 5)
+
+            for i in range(num_blocks):
+                kept = np.delete(data, range(i * block_size,
+                                             (i + 1) * block_size), axis=0)
+                assert np.allclose(samples[i], kept.mean(axis=0))
+
+        # For the mean the jackknife error is the standard error
+        central, error, samples = resampling.jackknife(data)
+
+        assert np.allclose(central, data.mean(axis=0))
+        assert np.allclose(error, data.std(axis=0, ddof=1) / np.sqrt(12))
+
+        central, error, samples \
+          = resampling.jackknife(data, lambda x: np.log(x[:, :-1] / x[:, 1:]))
+
+        assert samples.shape == (12, 4)
+        assert np.allclose(central, np.log(data.mean(axis=0)[:-1]
+                                           / data.mean(axis=0)[1:]))
+
+    def test_jackknife_covariance(self):
+
+        data = npr.rand(12, 5)
+        samples = resampling.jackknife_samples(data)
+        covariance = resampling.jackknife_covariance(samples)
+
+        assert covariance.shape == (5, 5)
+        assert np.allclose(np.sqrt(np.diag(covariance)),
+                           resampling.jackknife_error(samples))
+        assert np.allclose(covariance, np.cov(data, rowvar=False) / 12)
+
+    def test_bootstrap(self):
+
+        data = npr.rand(10, 4)
+        indices = resampling.bootstrap_indices(10, 50, seed=7)
+
+        assert indices.shape == (50, 10)
+        assert (indices == resampling.bootstrap_indices(10, 50, 7)).all()
+
+        samples = resampling.bootstrap_samples(data, indices)
+
+        assert np.allclose(samples, data[indices].mean(axis=1))
+
+        central, error, samples = resampling.bootstrap(data, seed=7,
+                                                       num_samples=50)
+
+        assert np.allclose(central, data.mean(axis=0))
+        assert np.allclose(error, data[indices].mean(axis=1).std(axis=0,
+                                                                 ddof=1))
+
+class TestFitting:
+
+    def test_two_state_jacobian(self):
+
+        t = np.arange(1, 10, dtype=np.float64)
+        b = npr.rand(3, 4) + 0.1
+
+        for num_timeslices in [None, 24]:
+            jacobian = fitting.two_state_jacobian(b, t, num_timeslices)
+            assert jacobian.shape == (3, 9, 4)
+
+            for i in range(4):
+                shift = np.zeros(4)
+                shift[i] = 1e-6
+                numerical \
+                  = (fitting.two_state_model(b + shift, t, num_timeslices)
+                     - fitting.two_state_model(b - shift, t, num_timeslices)) \
+                     / 2e-6
+                assert np.allclose(jacobian[..., i], numerical, rtol=1e-5)
+
+    def test_batched_two_state_fit(self):
+
+        t = np.arange(2, 20)
+        b = np.array([1.0, 0.3, 0.5, 0.9])
+
+        for num_timeslices in [None, 48]:
+            model = fitting.two_state_model(b, t, num_timeslices)
+            data = model * (1 + 0.01 * npr.randn(50, t.size))
+            err = data.std(axis=0) / np.sqrt(50)
+
+            samples = resampling.jackknife_samples(data)
+            central, sample_b, converged \
+              = fitting.fit_samples(t, data.mean(axis=0), samples, err,
+                                    [0.8, 0.25, 0.6, 1.0], num_timeslices)
+
+            assert converged.all()
+            assert sample_b.shape == (50, 4)
+            assert np.allclose(central, b, rtol=0.1)
+
+            # Each sample should agree with a fit on its own
+            single_b, chi_squared, single_converged \
+              = fitting.batched_two_state_fit(t, samples[3], err, central,
+                                              num_timeslices)
+            assert np.allclose(single_b[0], sample_b[3], rtol=1e-6)
+
+    def test_levenberg_marquardt_rejected_steps(self):
+
+        t = np.arange(20.0)
+        y = 2.0 * np.exp(-0.5 * t)
+        trial_chi_squared = []
+
+        def residuals(b, samples, jacobian=False):
+            ground_state = np.exp(-b[:, 1:2] * t)
+            r = y - b[:, 0:1] * ground_state
+            if not jacobian:
+                trial_chi_squared.append(np.sum(r**2))
+                return r
+            return r, np.stack([-ground_state,
+                                b[:, 0:1] * t * ground_state], axis=-1)
+
+        # Starting with too large an energy, the first steps overshoot and
+        # are rejected until the damping has grown
+        b, chi_squared, converged \
+          = fitting._levenberg_marquardt(residuals, np.array([[1.0, 10.0]]),
+                                         200, 1e-10)
+        best = trial_chi_squared[0]
+        rejected = 0
+        for trial in trial_chi_squared[1:]:
+            rejected += trial >= best
+            best = min(best, trial)
+
+        assert rejected > 3
+        assert converged.all()
+        assert np.allclose(b, [[2.0, 0.5]])
+
+        # Starting with a negative energy, the amplitude is driven to zero
+        # and the steps away from there are rejected until they are tiny,
+        # which doesn't make it a minimum
+        with np.errstate(over="ignore"):
+            b, chi_squared, converged \
+              = fitting._levenberg_marquardt(residuals,
+                                             np.array([[0.28, -1.44]]), 200,
+                                             1e-10)
+
+        assert chi_squared[0] > 1
+        assert not converged.any()
+
+    def test_variable_projection_fit(self):
+
+        t = np.arange(1, 16)
+        b = np.array([1.0, 0.3, 0.5, 0.9])
+        # Rare noise samples leave the excited state unresolved
+        random_state = npr.RandomState(0)
+
+        for num_timeslices in [None, 48]:
+            model = fitting.two_state_model(b, t, num_timeslices)
+            data = model * (1 + 0.02 * random_state.randn(20, t.size))
+            err = 0.02 * model
+
+            projected_b, projected_chi_squared, converged \
+              = fitting.variable_projection_fit(t, data, err, [0.2, 2.0],
+                                                num_timeslices)
+            full_b, full_chi_squared, full_converged \
+              = fitting.batched_two_state_fit(t, data, err, projected_b,
+                                              num_timeslices)
+
+            assert converged.all()
+            assert np.allclose(projected_b, full_b, rtol=1e-4)
+            assert np.allclose(projected_chi_squared, full_chi_squared)
+
+            amplitudes = fitting.variable_projection_amplitudes(
+                projected_b[:, 1::2], t, data, err, num_timeslices)
+            assert np.allclose(amplitudes, projected_b[:, ::2])
+
+            # Priors should pull the parameters towards the estimates
+            b_est = [0.9, 0.29, 0.6, 1.0]
+            b_err_est = [1e-6, 1e-6, 1e-6, 1e-6]
+            constrained_b, chi_squared, converged \
+              = fitting.variable_projection_fit(t, data, err, [0.3, 0.9],
+                                                num_timeslices, b_est,
+                                                b_err_est)
+            assert converged.all()
+            assert np.allclose(constrained_b, b_est, atol=1e-4)
+
+    def test_chi_squared(self):
+
+        t = np.arange(2, 10)
+        b = npr.rand(5, 4) + 0.1
+        y = fitting.two_state_model([1.0, 0.3, 0.5, 0.9], t)
+        err = 0.1 * y
+        samples = npr.randn(50, t.size)
+        covariance = np.cov(samples, rowvar=False) * np.outer(err, err)
+
+        # Uncorrelated
+        chi_squared = fitting.ChiSquared(t, y, err)
+        expected = np.sum(((y - fitting.two_state_model(b, t)) / err)**2,
+                          axis=1)
+        assert np.allclose(chi_squared(b), expected)
+        assert np.allclose(chi_squared(b[0]), expected[0])
+
+        # Correlated, with priors
+        b_est = [1.0, 0.3, 0.5, 0.9]
+        b_err_est = [0.1, 0.2, 0.3, 0.4]
+        chi_squared = fitting.ChiSquared(t, y, covariance=covariance,
+                                         b_est=b_est, b_err_est=b_err_est)
+        residuals = y - fitting.two_state_model(b, t)
+        expected = np.einsum('si,ij,sj->s', residuals,
+                             np.linalg.inv(covariance), residuals) \
+          + np.sum(((b - b_est) / b_err_est)**2, axis=1)
+        assert np.allclose(chi_squared(b), expected)
+
+        # The whitening matrices should be cached for each window
+        windows = fitting.CovarianceWindows(covariance)
+        whitening = windows.whitening([2, 6])
+        assert windows.whitening((2, 6)) is whitening
+        assert np.allclose(np.dot(whitening.T, whitening),
+                           np.linalg.inv(covariance[2:6, 2:6]))
+
+    def test_chi_squared_p_value(self):
+
+        import math
+
+        for chi_squared in [0.1, 1.0, 4.0, 30.0]:
+            assert np.allclose(fitting.chi_squared_p_value(chi_squared, 2),
+                               np.exp(-chi_squared / 2))
+            assert np.allclose(fitting.chi_squared_p_value(chi_squared, 1),
+                               math.erfc(np.sqrt(chi_squared / 2)))
+
+        assert fitting.chi_squared_p_value(0.0, 3) == 1.0
+        assert np.isnan(fitting.chi_squared_p_value(1.0, 0))
+
+    def test_scan_windows(self):
+
+        t = np.arange(24)
+        b = np.array([1.0, 0.3, 0.5, 0.9])
+        data = fitting.two_state_model(b, t) \
+          * (1 + 0.02 * npr.randn(40, t.size))
+        samples = resampling.jackknife_samples(data)
+        windows = [(3, 15), (1, 12), (2, 12), (1, 15)]
+
+        table = fitting.scan_windows(data.mean(axis=0), windows,
+                                     samples=samples)
+
+        assert table.shape == (4,)
+        assert [tuple(row) for row in table[["t_min", "t_max"]]] == windows
+        assert table["converged"].all()
+        assert (table["dof"] == [8, 7, 6, 10]).all()
+        assert np.allclose(table["chi_squared_dof"],
+                           table["chi_squared"] / table["dof"])
+        assert (table["errors"] > 0).all()
+
+        for row in table:
+            window = slice(row["t_min"], row["t_max"])
+            err = resampling.jackknife_error(samples)[window]
+            expected = fitting.variable_projection_fit(
+                t[window], data.mean(axis=0)[window], err, [0.3, 0.9])[0]
+            assert np.allclose(row["params"], expected[0], rtol=1e-4)
+
+        # Correlated fits in parallel should agree with those done serially
+        serial = fitting.scan_windows(data.mean(axis=0), windows,
+                                      samples=samples, correlated=True)
+        parallel = fitting.scan_windows(data.mean(axis=0), windows,
+                                        samples=samples, correlated=True,
+                                        workers=2)
+        assert np.allclose(serial["params"], parallel["params"])
+        assert np.allclose(serial["p_value"], parallel["p_value"])
+
+        # Each prior counts as a data point in the degrees of freedom
+        table = fitting.scan_windows(data.mean(axis=0), windows[:1],
+                                     b_est=b, b_err_est=0.1 * b)
+        assert (table["dof"] == [12]).all()
+
+        for workers in [1, 2]:
+            table = fitting.scan_windows(data.mean(axis=0), [],
+                                         workers=workers)
+            assert table.shape == (0,)
+            assert table.dtype == fitting.scan_dtype
+
+class TestEffmass:
+
+    def test_effmass(self):
+
+        T = 32
+        t = np.arange(T)
+        masses = np.array([0.3, 0.5, 0.7])[:, np.newaxis]
+        amplitudes = npr.rand(3, 1) + 0.5
+
+        correlators = {"log": amplitudes * np.exp(-masses * t),
+                       "cosh": amplitudes * np.cosh(masses * (T / 2.0 - t)),
+                       "sinh": amplitudes * np.sinh(masses * (T / 2.0 - t))}
+
+        for kind, correlator in correlators.items():
+            result = effmass.effmass(correlator, kind)
+            assert result.shape == (3, T)
+            # The last timeslice has no neighbour, so is undefined
+            assert np.isnan(result[:, -1]).all()
+            defined = np.isfinite(result)
+            assert np.allclose(result[defined],
+                               np.broadcast_to(masses, result.shape)[defined])
+
+        # The sinh variant is undefined where sinh vanishes
+        result = effmass.effmass(correlators["sinh"], "sinh")
+        assert np.isnan(result[:, 15:17]).all()
+        assert np.isfinite(result[:, :15]).all()
+        assert np.isfinite(effmass.effmass(correlators["cosh"], "cosh")[:, :-1]
+                           ).all()
+
+    def test_subtract_ground_state(self):
+
+        T = 16
+        t = np.arange(T)
+        correlators = np.exp(-0.3 * t) + 0.5 * np.exp(-0.9 * t) \
+          + np.zeros((4, 1))
+        excited = effmass.subtract_ground_state(correlators, np.ones(4), 0.3)
+        assert np.allclose(excited, 0.5 * np.exp(-0.9 * t))
+        assert np.allclose(effmass.effmass(excited)[:, :-1], 0.9)
+
+        periodic = fitting.two_state_model([1.0, 0.3, 0.5, 0.9], t, T)
+        excited = effmass.subtract_ground_state(periodic, 1.0, 0.3, T)
+        assert np.allclose(excited, 0.5 * (np.exp(-0.9 * t)
+                                           + np.exp(-0.9 * (T - t))))
+
+    def test_jackknife_effmass(self):
+
+        t = np.arange(12)
+        data = np.exp(-0.4 * t) * (1 + 0.01 * npr.randn(20, 12))
+        samples = resampling.jackknife_samples(data)
+
+        central, error = effmass.jackknife_effmass(samples)
+        assert np.allclose(central, effmass.effmass(data.mean(axis=0)),
+                           equal_nan=True)
+        assert np.allclose(error[:-1], resampling.jackknife_error(
+            np.log(samples[:, :-1] / samples[:, 1:])))
+
+class TestGevp:
+
+    def test_correlator_matrix(self):
+
+        pieces = [npr.rand(3, 8) for i in range(6)]
+        matrix = gevp.correlator_matrix(*pieces[:5])
+
+        assert matrix.shape == (3, 8, 2, 2)
+        assert np.allclose(matrix[..., 0, 0], pieces[0] - 2 * pieces[2])
+        assert np.allclose(matrix[..., 1, 1], pieces[1] - pieces[3])
+        assert np.allclose(matrix[..., 0, 1], -np.sqrt(2) * pieces[4])
+        assert np.allclose(matrix[..., 1, 0], matrix[..., 0, 1])
+
+        matrix = gevp.correlator_matrix(*pieces, connected_factors=(2, 3),
+                                        disconnected_factors=(1, 1, 1))
+        assert np.allclose(matrix[..., 0, 0], 2 * pieces[0] + pieces[2])
+        assert np.allclose(matrix[..., 1, 1], 3 * pieces[1] + pieces[3])
+        assert np.allclose(matrix[..., 1, 0], (pieces[4] + pieces[5]) / 2)
+
+    def test_gevp(self):
+
+        t = np.arange(20)
+        angle = 0.7
+        energies = np.array([0.3, 0.6])
+        # Columns hold the overlaps of the eta and eta' with the light and
+        # strange states
+        overlaps = np.array([[1.2 * np.cos(angle), 0.8 * np.sin(angle)],
+                             [-1.2 * np.sin(angle), 0.8 * np.cos(angle)]])
+        correlators = np.einsum('in,jn,tn->tij', overlaps, overlaps,
+                                np.exp(-np.outer(t, energies)))
+        samples = correlators * (1 + 1e-3 * npr.rand(5, 1, 1, 1))
+
+        principal_correlators, angles = gevp.gevp(samples, 2)
+
+        assert principal_correlators.shape == (5, 20, 2)
+        assert angles.shape == (5, 20, 2)
+        assert np.allclose(principal_correlators[:, 2], 1.0)
+        # With exactly two states the principal correlators are pure
+        # exponentials and the angles are exact away from t0
+        expected = np.exp(-np.outer(t - 2, energies))
+        assert np.allclose(principal_correlators, expected)
+        assert np.isnan(angles[:, 2]).all()
+        assert np.allclose(np.delete(angles, 2, axis=1), angle)
+
+        # The states should keep their order even where the eigenvalues
+        # are ordered differently before t0
+        principal_correlators, eigenvectors \
+          = gevp.solve_gevp(correlators, 2)
+        assert (principal_correlators[3:, 0]
+                > principal_correlators[3:, 1]).all()
+        assert (principal_correlators[:2, 0]
+                < principal_correlators[:2, 1]).all()
+        metric = np.einsum('tin,ij,tjm->tnm', eigenvectors, correlators[2],
+                           eigenvectors)
+        assert np.allclose(metric, np.eye(2))
+
+class TestFastfunctions:
+
+    def test_backend(self):
+
+        backend = fastfunctions._Backend("no_such_module", "numpy_converters")
+        assert backend.toarr is numpy_converters.toarr
+        assert backend.module is numpy_converters
+
+        backend = fastfunctions._Backend("no_such_module")
+        try:
+            backend.toarr
+        except ImportError:
+            pass
+        else:
+            assert False
+
+class TestMinimizers:
+
+    def test_grid_search(self):
+
+        function = lambda b: np.sum((np.asarray(b) - [0.3, 0.7])**2, axis=-1)
+        ranges = [[0.0, 1.0], [0.0, 1.0]]
+
+        expected = minimizers.grid_search(function, ranges, tolerance=1e-9)
+        assert np.allclose(expected, [0.3, 0.7], atol=1e-6)
+
+        for block_size in [1, 7, 2**16]:
+            result = minimizers.grid_search(function, ranges, tolerance=1e-9,
+                                            vectorized=True,
+                                            block_size=block_size)
+            assert result == expected
+
+    def test_grid_blocks(self):
+
+        linspaces = [np.linspace(0, 1, 3), np.array([2.0]),
+                     np.linspace(-1, 1, 4)]
+        expected = np.array(list(itertools.product(*linspaces)))
+
+        for block_size in [1, 5, 12, 100]:
+            blocks = list(minimizers._grid_blocks(linspaces, block_size))
+            assert all(block.shape[0] <= block_size for block in blocks)
+            assert (np.concatenate(blocks) == expected).all()
+
+    def test_grid_search_two_state(self):
+
+        b = [1.0, 0.3, 0.5, 0.9]
+        t = np.arange(2, 14)
+        chi_squared = fitting.ChiSquared(t, fitting.two_state_model(b, t),
+                                         np.ones(t.size))
+        ranges = [[0.5, 1.5], [0.1, 0.5], [0.2, 0.8], [0.6, 1.2]]
+
+        # Evaluating blocks of points at once finds the same point as
+        # evaluating them one at a time
+        expected = minimizers.grid_search(chi_squared, ranges, grid_points=6,
+                                          max_iterations=3)
+        result = minimizers.grid_search(chi_squared, ranges, grid_points=6,
+                                        max_iterations=3, vectorized=True,
+                                        block_size=100)
+        assert np.allclose(result, expected)
+
+    def test_adaptive_grid_search(self):
+
+        function = lambda b: 1 + np.sum((b - [0.3, 0.7, -0.2])**2
+                                        * [1.0, 10.0, 100.0], axis=-1)
+        ranges = [[0.0, 1.0], [0.0, 1.0], [-1.0, 1.0]]
+
+        result = minimizers.adaptive_grid_search(function, ranges,
+                                                 vectorized=True,
+                                                 objective_tolerance=1e-12)
+
+        assert result["success"]
+        assert np.allclose(result["x"], [0.3, 0.7, -0.2], atol=1e-4)
+        assert result["nit"] == len(result["trace"])
+        assert result["nfev"] == result["trace"][-1]["nfev"]
+        # The best value found should never get worse
+        values = [entry["fun"] for entry in result["trace"]]
+        assert (np.diff(values) <= 0).all()
+
+    def test_adaptive_grid_search_two_state(self):
+
+        b = [1.0, 0.3, 0.5, 0.9]
+        t = np.arange(2, 14)
+        y = fitting.two_state_model(b, t)
+        chi_squared = fitting.ChiSquared(t, y, 0.01 * y)
+
+        for ranges in [[[0.5, 1.5], [0.1, 0.5], [0.2, 0.8], [0.6, 1.2]],
+                       [[0.0, 2.0], [0.0, 1.0], [0.0, 1.0], [0.0, 2.0]]]:
+            result = minimizers.adaptive_grid_search(chi_squared, ranges,
+                                                     vectorized=True)
+
+            # The valley in the chi-squared runs across the axes, so the
+            # search must follow it rather than crawl along it
+            assert result["success"]
+            assert result["nit"] < 30
+            assert np.allclose(result["x"], b, rtol=1e-3)
+
+        result = minimizers.adaptive_grid_search(chi_squared, ranges,
+                                                 vectorized=True, workers=2)
+        assert result["success"]
+        assert np.allclose(result["x"], b, rtol=1e-3)
+
+    def test_minimize_with_restarts(self):
+
+        function = lambda b: np.sum((b - [1.0, 2.0])**2)
+
+        result = minimizers.minimize_with_restarts(function, [0.0, 0.0])
+        assert result["success"]
+        assert result["restarts"] < 20
+        assert np.allclose(result["x"], [1.0, 2.0])
+
+        warm = minimizers.minimize_with_restarts(function, result,
+                                                 max_restarts=0)
+        assert warm["restarts"] == 0
+        assert warm["nfev"] < result["nfev"]
+
+class TwoPoint(object):
+    """A stand-in for the pyQCD TwoPoint object, holding one correlator"""
+
+    def __init__(self, correlator):
+        self.T = correlator.size
+        self.pion_px0_py0_pz0 = correlator
+
+class TestMeasurements:
+
+    def test_constrained_two_state_fit(self):
+
+        b = [1.0, 0.3, 0.5, 0.9]
+        correlator = fitting.two_state_model(b, np.arange(32))
+        twopoint = TwoPoint(correlator)
+
+        result = measurements.constrained_two_state_fit(
+            twopoint, "pion", [2, 14], [0.9, 0.25, 0.6, 1.0],
+            stddev=0.01 * correlator, full_output=True)
+
+        assert result["success"]
+        assert 0 < result["restarts"] < 20
+        assert np.allclose(result["x"], b, rtol=1e-3)
+
+        # Warm-starting from the converged fit needs no restarts
+        warm = measurements.constrained_two_state_fit(
+            twopoint, "pion", [2, 14], result, stddev=0.01 * correlator,
+            max_restarts=0, full_output=True)
+        assert warm["restarts"] == 0
+        assert np.allclose(warm["x"], result["x"], rtol=1e-4)
+
+class TestInstrumentation:
+
+    def test_records(self):
+
+        @instrumentation.timed("stage")
+        def function(x):
+            instrumentation.count("items", x)
+            return x
+
+        instrumentation.disable()
+        with instrumentation.capture() as records:
+            assert function(2) == 2
+        assert records.timings == {} and records.counters == {}
+
+        instrumentation.enable()
+        try:
+            with instrumentation.capture(merge=False) as first:
+                function(2)
+                function(3)
+            with instrumentation.capture(merge=False) as second:
+                with instrumentation.timer("stage"):
+                    instrumentation.count("items")
+        finally:
+            instrumentation.disable()
+
+        assert first.timings["stage"][0] == 2
+        assert first.counters == {"items": 5}
+
+        first.merge(second)
+        assert first.timings["stage"][0] == 3
+        assert first.counters == {"items": 6}
+
+        report = json.loads(first.json())
+        assert report["timings"]["stage"]["calls"] == 3
+        assert "stage" in first.table()
+
+    def test_run_all(self, tmpdir):
+
+        T = 16
+
+        for folder in ["exact", "sloppy"]:
+            tmpdir.mkdir(folder)
+
+        for i in range(3):
+            data = np.zeros((T, 5))
+            data[:, 0] = np.arange(T)
+            data[:, 1:5] = npr.rand(T, 4)
+            for folder in ["exact", "sloppy"]:
+                np.savetxt(str(tmpdir.join(folder, "traces.{}".format(i))),
+                           data)
+
+        reports = []
+        for workers in [1, 2]:
+            report = str(tmpdir.join("report{}.json".format(workers)))
+            correlators.run_all(str(tmpdir.join("exact")),
+                                str(tmpdir.join("sloppy")), "traces",
+                                str(tmpdir.join("out_")), 0, 2, 1,
+                                num_timeslices=T, workers=workers,
+                                report=report)
+            with open(report) as f:
+                reports.append(json.load(f))
+
+        assert not instrumentation.enabled
+
+        for report in reports:
+            assert report["timings"]["parse_columns"]["calls"] == 6
+            assert report["timings"]["run_one"]["calls"] == 3
+            assert report["timings"]["write"]["calls"] == 3
+            assert report["counters"]["rows_parsed"] == 6 * T
+            assert report["counters"] == reports[0]["counters"]
@@ -0,0 +1,18 @@
+# Builds the cython kernels in etaetaprime.fastfunctions ahead of time, e.g.
+#
+#     python setup.py build_ext --inplace
+#
+# If they are not built the pure numpy versions are used instead.
+from distutils.core import setup
+from distutils.extension import Extension
+from Cython.Build import cythonize
+import numpy as np
+
+extensions = [Extension("etaetaprime.fastfunctions.{}".format(name),
+                        ["etaetaprime/fastfunctions/{}.pyx".format(name)],
+                        include_dirs=[np.get_include()])
+              for name in ["combinatorics", "converters"]]
+
+setup(name="etaetaprime",
+      packages=["etaetaprime", "etaetaprime.fastfunctions"],
+      ext_modules=cythonize(extensions))